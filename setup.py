@@ -52,6 +52,7 @@ setup(
         'bin/swift-container-server',
         'bin/swift-container-sync',
         'bin/swift-container-updater',
+        'bin/swift-db-bench',
         'bin/swift-dispersion-populate',
         'bin/swift-dispersion-report',
         'bin/swift-drive-audit',
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import cPickle as pickle
 import os
 import random
 from logging import DEBUG
@@ -20,14 +21,18 @@ from math import sqrt
 from time import time
 
 from eventlet import GreenPool, sleep, Timeout
+from eventlet.semaphore import Semaphore
 
 import swift.common.db
 from swift.account.server import DATADIR
 from swift.common.db import AccountBroker
 from swift.common.direct_client import ClientException, \
-    direct_delete_container, direct_delete_object, direct_get_container
+    direct_bulk_delete_objects, direct_delete_container, \
+    direct_delete_object, direct_get_container
+from swift.common.http import is_success, HTTP_METHOD_NOT_ALLOWED
 from swift.common.ring import Ring
-from swift.common.utils import get_logger, whataremyips, TRUE_VALUES
+from swift.common.utils import get_logger, whataremyips, TRUE_VALUES, \
+    ratelimit_sleep, write_pickle
 from swift.common.daemon import Daemon
 
 
@@ -73,6 +78,13 @@ class AccountReaper(Daemon):
         swift.common.db.DB_PREALLOCATION = \
             conf.get('db_preallocation', 'f').lower() in TRUE_VALUES
         self.delay_reaping = int(conf.get('delay_reaping') or 0)
+        self.bulk_delete_size = int(conf.get('bulk_delete_size', 100))
+        self.objects_per_second = float(conf.get('objects_per_second', 0))
+        self.ratelimit_lock = Semaphore()
+        self.ratelimit_running_time = 0
+        self.progress = {'marker': '', 'containers': {}}
+        self.progress_file = None
+        self.bulk_delete_unsupported = set()
 
     def get_account_ring(self):
         """ The account :class:`swift.common.ring.Ring` for the cluster. """
@@ -192,6 +204,11 @@ class AccountReaper(Daemon):
         this function is called with the same parameters). This isn't likely
         since the listing comes from the local database.
 
+        How far the pass has got, in containers and in the objects of each
+        container being reaped, is kept in a <db_file>.reaper file next to the
+        account database; a pass that is cut short, say by a restart, is
+        picked up from there rather than started over.
+
         After the process completes (successfully or not) statistics about what
         was accomplished will be logged.
 
@@ -217,6 +234,9 @@ class AccountReaper(Daemon):
             return False
         account = info['account']
         self.logger.info(_('Beginning pass on account %s'), account)
+        self.progress_file = broker.db_file + '.reaper'
+        self.progress = self.load_progress()
+        self.bulk_delete_unsupported = set()
         self.stats_return_codes = {}
         self.stats_containers_deleted = 0
         self.stats_objects_deleted = 0
@@ -225,7 +245,7 @@ class AccountReaper(Daemon):
         self.stats_containers_possibly_remaining = 0
         self.stats_objects_possibly_remaining = 0
         try:
-            marker = ''
+            marker = self.progress['marker']
             while True:
                 containers = \
                     list(broker.list_containers_iter(1000, marker, None, None,
@@ -241,6 +261,11 @@ class AccountReaper(Daemon):
                     self.logger.exception(
                         _('Exception with containers for account %s'), account)
                 marker = containers[-1][0]
+                self.progress['marker'] = marker
+                self.save_progress()
+            # The next pass starts over with what is left of the account.
+            self.progress = {'marker': '', 'containers': {}}
+            self.save_progress()
             log = 'Completed pass on account %s' % account
         except (Exception, Timeout):
             self.logger.exception(
@@ -311,7 +336,7 @@ class AccountReaper(Daemon):
         part, nodes = self.get_container_ring().get_nodes(account, container)
         node = nodes[-1]
         pool = GreenPool(size=self.object_concurrency)
-        marker = ''
+        marker = self.progress['containers'].get(container, '')
         while True:
             objects = None
             try:
@@ -335,14 +360,16 @@ class AccountReaper(Daemon):
                 for obj in objects:
                     if isinstance(obj['name'], unicode):
                         obj['name'] = obj['name'].encode('utf8')
-                    pool.spawn(self.reap_object, account, container, part,
-                               nodes, obj['name'])
-                pool.waitall()
+                self.reap_objects(account, container, part, nodes,
+                                  [obj['name'] for obj in objects], pool)
             except (Exception, Timeout):
                 self.logger.exception(_('Exception with objects for container '
                     '%(container)s for account %(account)s'),
                     {'container': container, 'account': account})
             marker = objects[-1]['name']
+            self.progress['containers'][container] = marker
+            self.save_progress()
+        self.progress['containers'].pop(container, None)
         successes = 0
         failures = 0
         for node in nodes:
@@ -406,33 +433,229 @@ class AccountReaper(Daemon):
         failures = 0
         for node in nodes:
             cnode = container_nodes.pop()
+            if self.delete_object(node, self.object_entry(
+                    part, account, container, obj, container_partition,
+                    cnode)):
+                successes += 1
+            else:
+                failures += 1
+        self.object_reaped(successes, failures)
+
+    def reap_objects(self, account, container, container_partition,
+                     container_nodes, objs, pool):
+        """
+        Deletes the given objects, at most self.objects_per_second of them a
+        second across all the containers being reaped. The deletes for each
+        object server device are sent up to self.bulk_delete_size at a time
+        in BULK_DELETE requests; if bulk_delete_size is 0, :func:`reap_object`
+        is called for each object instead.
+
+        :param account: The name of the account for the objects.
+        :param container: The name of the container for the objects.
+        :param container_partition: The partition for the container on the
+                                    container ring.
+        :param container_nodes: The primary node dicts for the container.
+        :param objs: The names of the objects to delete.
+        :param pool: The GreenPool to send the deletes with.
+        """
+        if not self.bulk_delete_size:
+            for obj in objs:
+                self.ratelimit(1)
+                pool.spawn(self.reap_object, account, container,
+                           container_partition, container_nodes, obj)
+            pool.waitall()
+            return
+        results = dict((obj, [0, 0]) for obj in objs)
+        batches = {}
+        replicas = 1
+        for obj in objs:
+            cnodes = list(container_nodes)
+            part, nodes = \
+                self.get_object_ring().get_nodes(account, container, obj)
+            replicas = len(nodes)
+            for node in nodes:
+                batches.setdefault(
+                    (node['ip'], node['port'], node['device']),
+                    (node, []))[1].append(self.object_entry(
+                        part, account, container, obj, container_partition,
+                        cnodes.pop()))
+        for node, entries in batches.itervalues():
+            for i in xrange(0, len(entries), self.bulk_delete_size):
+                batch = entries[i:i + self.bulk_delete_size]
+                self.ratelimit(len(batch) / float(replicas))
+                pool.spawn(self.bulk_delete_objects, node, batch, results)
+        pool.waitall()
+        for obj in objs:
+            self.object_reaped(*results[obj])
+
+    def bulk_delete_objects(self, node, entries, results):
+        """
+        Deletes objects on an object server device with a BULK_DELETE
+        request, or with a DELETE for each if the object server does not
+        support them; such object servers are remembered for the rest of the
+        pass on the account.
+
+        :param node: The node dict of the device.
+        :param entries: The objects to delete, as made by
+                        :func:`object_entry`.
+        :param results: Dict of object name to [successes, failures] that is
+                        updated with how the deletes went.
+        """
+        statuses = None
+        if (node['ip'], node['port']) not in self.bulk_delete_unsupported:
             try:
-                direct_delete_object(node, part, account, container, obj,
+                # Each object's delete may take up to node_timeout to update
+                # its container.
+                statuses = direct_bulk_delete_objects(node, entries,
                     conn_timeout=self.conn_timeout,
-                    response_timeout=self.node_timeout,
-                    headers={'X-Container-Host': '%(ip)s:%(port)s' % cnode,
-                             'X-Container-Partition': str(container_partition),
-                             'X-Container-Device': cnode['device']})
-                successes += 1
-                self.stats_return_codes[2] = \
-                    self.stats_return_codes.get(2, 0) + 1
-                self.logger.increment('return_codes.2')
+                    response_timeout=self.node_timeout * len(entries))
             except ClientException, err:
-                if self.logger.getEffectiveLevel() <= DEBUG:
-                    self.logger.exception(
-                        _('Exception with %(ip)s:%(port)s/%(device)s'), node)
-                failures += 1
-                self.logger.increment('objects_failures')
-                self.stats_return_codes[err.http_status / 100] = \
-                    self.stats_return_codes.get(err.http_status / 100, 0) + 1
-                self.logger.increment(
-                    'return_codes.%d' % (err.http_status / 100,))
-            if successes > failures:
-                self.stats_objects_deleted += 1
-                self.logger.increment('objects_deleted')
-            elif not successes:
-                self.stats_objects_remaining += 1
-                self.logger.increment('objects_remaining')
+                self.return_code(err.http_status)
+                if err.http_status == HTTP_METHOD_NOT_ALLOWED:
+                    self.bulk_delete_unsupported.add(
+                        (node['ip'], node['port']))
+                else:
+                    if self.logger.getEffectiveLevel() <= DEBUG:
+                        self.logger.exception(
+                            _('Exception with %(ip)s:%(port)s/%(device)s'),
+                            node)
+                    statuses = [None] * len(entries)
+            except (Exception, Timeout):
+                self.logger.exception(
+                    _('Exception with %(ip)s:%(port)s/%(device)s'), node)
+                statuses = [None] * len(entries)
+        if statuses is None:
+            for entry in entries:
+                if self.delete_object(node, entry):
+                    results[entry['obj']][0] += 1
+                else:
+                    results[entry['obj']][1] += 1
+            return
+        for entry, status in zip(entries, statuses):
+            if status is not None:
+                self.return_code(status)
+            if status is not None and is_success(status):
+                results[entry['obj']][0] += 1
             else:
-                self.stats_objects_possibly_remaining += 1
-                self.logger.increment('objects_possibly_remaining')
+                results[entry['obj']][1] += 1
+                self.logger.increment('objects_failures')
+
+    def object_entry(self, part, account, container, obj,
+                     container_partition, cnode):
+        """
+        Describes the delete of an object replica, as sent in a BULK_DELETE
+        request; see :func:`swift.obj.server.ObjectController.BULK_DELETE`.
+
+        :param part: The partition for the object on the object ring.
+        :param account: The name of the account for the object.
+        :param container: The name of the container for the object.
+        :param obj: The name of the object to delete.
+        :param container_partition: The partition for the container on the
+                                    container ring.
+        :param cnode: The container node dict the object server is to update.
+        :returns: dict of {'partition', 'account', 'container', 'obj',
+                  'container_host', 'container_partition',
+                  'container_device'}
+        """
+        return {'partition': part, 'account': account,
+                'container': container, 'obj': obj,
+                'container_host': '%(ip)s:%(port)s' % cnode,
+                'container_partition': container_partition,
+                'container_device': cnode['device']}
+
+    def delete_object(self, node, entry):
+        """
+        Deletes an object replica with a DELETE request.
+
+        :param node: The node dict of the object server device.
+        :param entry: The delete, as made by :func:`object_entry`.
+        :returns: True if the object was deleted
+        """
+        try:
+            direct_delete_object(node, entry['partition'], entry['account'],
+                entry['container'], entry['obj'],
+                conn_timeout=self.conn_timeout,
+                response_timeout=self.node_timeout,
+                headers={'X-Container-Host': entry['container_host'],
+                         'X-Container-Partition':
+                            str(entry['container_partition']),
+                         'X-Container-Device': entry['container_device']})
+            self.return_code(200)
+            return True
+        except ClientException, err:
+            if self.logger.getEffectiveLevel() <= DEBUG:
+                self.logger.exception(
+                    _('Exception with %(ip)s:%(port)s/%(device)s'), node)
+            self.logger.increment('objects_failures')
+            self.return_code(err.http_status)
+            return False
+
+    def object_reaped(self, successes, failures):
+        """
+        Updates the stats with how the deletes of an object went.
+
+        :param successes: The number of replicas deleted.
+        :param failures: The number of replicas not deleted.
+        """
+        if successes > failures:
+            self.stats_objects_deleted += 1
+            self.logger.increment('objects_deleted')
+        elif not successes:
+            self.stats_objects_remaining += 1
+            self.logger.increment('objects_remaining')
+        else:
+            self.stats_objects_possibly_remaining += 1
+            self.logger.increment('objects_possibly_remaining')
+
+    def return_code(self, status):
+        """
+        Counts a response status in the stats.
+
+        :param status: The HTTP status of the response.
+        """
+        self.stats_return_codes[status / 100] = \
+            self.stats_return_codes.get(status / 100, 0) + 1
+        self.logger.increment('return_codes.%d' % (status / 100,))
+
+    def ratelimit(self, objects):
+        """
+        Sleeps as needed to keep to self.objects_per_second across all of the
+        containers being reaped.
+
+        :param objects: The number of objects about to be deleted.
+        """
+        with self.ratelimit_lock:
+            self.ratelimit_running_time = ratelimit_sleep(
+                self.ratelimit_running_time, self.objects_per_second,
+                incr_by=objects)
+
+    def load_progress(self):
+        """
+        Loads how far the last pass on the account being reaped got; see
+        :func:`reap_account`.
+
+        :returns: dict of {'marker': last container done, 'containers':
+                  dict of container name to last object done}
+        """
+        try:
+            with open(self.progress_file, 'rb') as fp:
+                return pickle.load(fp)
+        except Exception:
+            return {'marker': '', 'containers': {}}
+
+    def save_progress(self):
+        """
+        Records how far the pass on the account being reaped has got, or
+        removes the record once there is nothing to resume.
+        """
+        if not self.progress_file:
+            return
+        try:
+            if self.progress['marker'] or self.progress['containers']:
+                write_pickle(self.progress, self.progress_file,
+                             os.path.dirname(self.progress_file),
+                             pickle.HIGHEST_PROTOCOL)
+            elif os.path.exists(self.progress_file):
+                os.unlink(self.progress_file)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR updating %s'), self.progress_file)
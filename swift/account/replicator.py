@@ -13,6 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sqlite3
+
+from eventlet import Timeout
+
 from swift.account import server as account_server
 from swift.common import db, db_replicator
 
@@ -22,3 +26,29 @@ class AccountReplicator(db_replicator.Replicator):
     brokerclass = db.AccountBroker
     datadir = account_server.DATADIR
     default_port = 6002
+
+    def __init__(self, conf):
+        db_replicator.Replicator.__init__(self, conf)
+        self.usage_prefix_delimiter = conf.get('usage_prefix_delimiter')
+        if self.usage_prefix_delimiter and not db.prefix_stat_supported():
+            self.logger.warning(
+                _('usage_prefix_delimiter needs SQLite %(needed)s or later, '
+                  'not %(version)s; per-prefix usage totals are not built'),
+                {'needed': '.'.join(map(str, db.PREFIX_STAT_SQLITE_VERSION)),
+                 'version': sqlite3.sqlite_version})
+            self.usage_prefix_delimiter = None
+
+    def _maintain_db(self, broker):
+        """
+        Builds the DB's per-prefix usage totals for usage_prefix_delimiter,
+        if set and not built yet, for the account server to report.
+        """
+        db_replicator.Replicator._maintain_db(self, broker)
+        if not self.usage_prefix_delimiter:
+            return
+        try:
+            if broker.build_prefix_stat(self.usage_prefix_delimiter):
+                self.logger.increment('prefix_stat_built')
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR building prefix totals for %s'),
+                                  broker.db_file)
@@ -35,7 +35,8 @@ from swift.common.utils import get_logger, get_param, hash_path, public, \
     validate_device_partition, json
 from swift.common.constraints import ACCOUNT_LISTING_LIMIT, \
     check_mount, check_float, check_utf8, FORMAT2CONTENT_TYPE
-from swift.common.db_replicator import ReplicatorRpc
+from swift.common.db_replicator import ReplicatorRpc, \
+    load_replicate_args
 from swift.common.http import HTTPInsufficientStorage
 
 
@@ -56,6 +57,8 @@ class AccountController(object):
             conf.get('auto_create_account_prefix') or '.'
         swift.common.db.DB_PREALLOCATION = \
             conf.get('db_preallocation', 'f').lower() in TRUE_VALUES
+        swift.common.db.configure_db_connections(conf)
+        self.usage_prefix_delimiter = conf.get('usage_prefix_delimiter')
 
     def _get_account_broker(self, drive, part, account):
         hsh = hash_path(account)
@@ -63,6 +66,26 @@ class AccountController(object):
         db_path = os.path.join(self.root, drive, db_dir, hsh + '.db')
         return AccountBroker(db_path, account=account, logger=self.logger)
 
+    def _prefix_usage_headers(self, broker, usage_prefix):
+        """
+        Returns the headers reporting the usage of the containers whose
+        names start with usage_prefix, if usage_prefix_delimiter is set,
+        usage_prefix ends with it and the account DB's totals for it have
+        been built by the replicator; an empty dict otherwise. Raises
+        ValueError if usage_prefix has more than one segment, since only
+        the first segment of container names is totaled.
+        """
+        if not self.usage_prefix_delimiter or not usage_prefix or \
+                not usage_prefix.endswith(self.usage_prefix_delimiter):
+            return {}
+        info = broker.get_prefix_info(usage_prefix,
+                                      self.usage_prefix_delimiter)
+        if info is None:
+            return {}
+        return {'X-Account-Prefix-Container-Count': info['container_count'],
+                'X-Account-Prefix-Object-Count': info['object_count'],
+                'X-Account-Prefix-Bytes-Used': info['bytes_used']}
+
     @public
     def DELETE(self, req):
         """Handle HTTP DELETE request."""
@@ -192,6 +215,17 @@ class AccountController(object):
             container_ts = broker.get_container_timestamp(container)
             if container_ts is not None:
                 headers['X-Container-Timestamp'] = container_ts
+        try:
+            headers.update(self._prefix_usage_headers(
+                broker, get_param(req, 'usage_prefix')))
+        except UnicodeDecodeError, err:
+            self.logger.increment('HEAD.errors')
+            return HTTPBadRequest(body='parameters not utf8',
+                                  content_type='text/plain', request=req)
+        except ValueError, err:
+            self.logger.increment('HEAD.errors')
+            return HTTPBadRequest(body=str(err), content_type='text/plain',
+                                  request=req)
         headers.update((key, value)
             for key, (value, timestamp) in broker.metadata.iteritems()
             if value != '')
@@ -246,10 +280,16 @@ class AccountController(object):
             marker = get_param(req, 'marker', '')
             end_marker = get_param(req, 'end_marker')
             query_format = get_param(req, 'format')
+            resp_headers.update(self._prefix_usage_headers(
+                broker, get_param(req, 'usage_prefix')))
         except UnicodeDecodeError, err:
             self.logger.increment('GET.errors')
             return HTTPBadRequest(body='parameters not utf8',
                                   content_type='text/plain', request=req)
+        except ValueError, err:
+            self.logger.increment('GET.errors')
+            return HTTPBadRequest(body=str(err), content_type='text/plain',
+                                  request=req)
         if query_format:
             req.accept = FORMAT2CONTENT_TYPE.get(query_format.lower(),
                                                  FORMAT2CONTENT_TYPE['plain'])
@@ -298,6 +338,52 @@ class AccountController(object):
         self.logger.timing_since('GET.timing', start_time)
         return ret
 
+    @public
+    def UPDATE(self, req):
+        """
+        Handle HTTP UPDATE request: the container updater's reports for
+        several of the account's containers at once, as a JSON list of
+        {'name', 'put_timestamp', 'delete_timestamp', 'object_count',
+        'bytes_used'}, each the equivalent of a container PUT.
+        """
+        start_time = time.time()
+        try:
+            drive, part, account = split_path(unquote(req.path), 3)
+            validate_device_partition(drive, part)
+        except ValueError, err:
+            self.logger.increment('UPDATE.errors')
+            return HTTPBadRequest(body=str(err), content_type='text/plain',
+                                  request=req)
+        if self.mount_check and not check_mount(self.root, drive):
+            self.logger.increment('UPDATE.errors')
+            return HTTPInsufficientStorage(drive=drive, request=req)
+        try:
+            records = [{'name': rec['name'].encode('utf-8'),
+                        'put_timestamp': rec['put_timestamp'],
+                        'delete_timestamp': rec['delete_timestamp'],
+                        'object_count': rec['object_count'],
+                        'bytes_used': rec['bytes_used']}
+                       for rec in json.loads(req.body)]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.logger.increment('UPDATE.errors')
+            return HTTPBadRequest(body='Invalid UPDATE body',
+                                  content_type='text/plain', request=req)
+        broker = self._get_account_broker(drive, part, account)
+        if 'x-trans-id' in req.headers:
+            broker.pending_timeout = 3
+        if account.startswith(self.auto_create_account_prefix) and \
+                not os.path.exists(broker.db_file):
+            broker.initialize(normalize_timestamp(
+                req.headers.get('x-timestamp') or time.time()))
+        if not os.path.exists(broker.db_file) or \
+                (req.headers.get('x-account-override-deleted', 'no').lower()
+                 != 'yes' and broker.is_deleted()):
+            self.logger.timing_since('UPDATE.timing', start_time)
+            return HTTPNotFound(request=req)
+        broker.put_containers(records)
+        self.logger.timing_since('UPDATE.timing', start_time)
+        return HTTPAccepted(request=req)
+
     @public
     def REPLICATE(self, req):
         """
@@ -317,7 +403,7 @@ class AccountController(object):
             self.logger.increment('REPLICATE.errors')
             return HTTPInsufficientStorage(drive=drive, request=req)
         try:
-            args = json.load(req.environ['wsgi.input'])
+            args = load_replicate_args(req)
         except ValueError, err:
             self.logger.increment('REPLICATE.errors')
             return HTTPBadRequest(body=str(err), content_type='text/plain')
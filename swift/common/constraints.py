@@ -37,6 +37,10 @@ CONTAINER_LISTING_LIMIT = 10000
 ACCOUNT_LISTING_LIMIT = 10000
 MAX_ACCOUNT_NAME_LENGTH = 256
 MAX_CONTAINER_NAME_LENGTH = 256
+#: Max number of segments in a static large object manifest
+MAX_MANIFEST_SEGMENTS = 1000
+#: Max size in bytes of a static large object manifest as uploaded
+MAX_MANIFEST_SIZE = 2 * 1024 * 1024
 #: Query string format= values to their corresponding content-type values
 FORMAT2CONTENT_TYPE = {'plain': 'text/plain', 'json': 'application/json',
                        'xml': 'application/xml'}
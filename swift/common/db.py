@@ -16,6 +16,7 @@
 """ Database code for Swift """
 
 from __future__ import with_statement
+from collections import deque, OrderedDict
 from contextlib import contextmanager
 import hashlib
 import logging
@@ -26,6 +27,8 @@ import sys
 import time
 import cPickle as pickle
 import errno
+import struct
+import zlib
 from tempfile import mkstemp
 
 from eventlet import sleep, Timeout
@@ -40,10 +43,47 @@ from swift.common.exceptions import LockTimeout
 DB_PREALLOCATION = True
 #: Timeout for trying to connect to a DB
 BROKER_TIMEOUT = 25
+#: Journal mode for DB connections; None means DELETE, except that DBs
+#: already in WAL mode are left in it
+DB_JOURNAL_MODE = None
+#: Synchronous level for DB connections
+DB_SYNCHRONOUS = 'NORMAL'
+#: Page cache size for DB connections, if not SQLite's default
+DB_CACHE_SIZE = None
+#: Bytes of each DB to access through mmap, if not SQLite's default
+DB_MMAP_SIZE = None
 #: Pickle protocol to use
 PICKLE_PROTOCOL = 2
 #: Max number of pending entries
 PENDING_CAP = 131072
+#: Starts each entry of a .pending file; it is neither ':' nor in the base64
+#: alphabet, so it also tells binary entries apart from old style ones
+PENDING_ENTRY_MARKER = '\xff'
+#: Follows the marker: payload length and CRC32, network byte order
+PENDING_HEADER = struct.Struct('!II')
+#: First SQLite version with instr(), which the prefix_stat triggers use
+PREFIX_STAT_SQLITE_VERSION = (3, 7, 15)
+#: Longest payload a binary pending entry is trusted to have; a header
+#: claiming more is taken to be corrupt
+PENDING_ENTRY_MAX_LENGTH = 1 << 20
+#: Rows a delimiter listing steps over to get past a subdirectory before it
+#: queries again from the end of the subdirectory instead
+DELIMITER_SCAN_ROWS = 8
+#: Object rows as they will be once the entries in the temporary
+#: object_pending table are committed, for listings that read the .pending
+#: file in memory; formatted with the filter for object rows to consider
+PENDING_OBJECT_SOURCE = '''(
+    SELECT name, created_at, size, content_type, etag, deleted
+    FROM object WHERE NOT EXISTS (
+        SELECT 1 FROM object_pending
+        WHERE object_pending.name = object.name AND
+              object_pending.created_at > object.created_at)
+    UNION ALL
+    SELECT name, created_at, size, content_type, etag, deleted
+    FROM object_pending WHERE NOT EXISTS (
+        SELECT 1 FROM object
+        WHERE object.name = object_pending.name AND
+              object.created_at >= object_pending.created_at%s))'''
 
 
 def utf8encode(*args):
@@ -119,6 +159,39 @@ def chexor(old, name, timestamp):
     return response.encode('hex')
 
 
+def encode_pending_entry(entry):
+    """
+    Encodes an entry to append to a .pending file: PENDING_ENTRY_MARKER,
+    then PENDING_HEADER with the length and CRC32 of the pickled entry, then
+    the pickled entry itself.
+
+    :param entry: tuple to encode
+    :returns: the encoded entry
+    """
+    payload = pickle.dumps(entry, protocol=PICKLE_PROTOCOL)
+    return PENDING_ENTRY_MARKER + PENDING_HEADER.pack(
+        len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def prefix_stat_supported():
+    """
+    Returns whether this SQLite can build prefix_stat tables; see
+    :func:`AccountBroker.create_prefix_stat_table`.
+    """
+    return sqlite3.sqlite_version_info >= PREFIX_STAT_SQLITE_VERSION
+
+
+def _instr(string, substring):
+    """
+    Stands in for SQLite's instr() on versions that lack it, so account DBs
+    whose prefix_stat triggers were created by a newer SQLite can still be
+    written to.
+    """
+    if string is None or substring is None:
+        return None
+    return string.find(substring) + 1
+
+
 def get_db_connection(path, timeout=30, okay_to_create=False):
     """
     Returns a properly configured SQLite database connection.
@@ -141,11 +214,30 @@ def get_db_connection(path, timeout=30, okay_to_create=False):
                     'DB file created by connect?')
         conn.row_factory = sqlite3.Row
         conn.text_factory = str
-        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA synchronous = %s' % DB_SYNCHRONOUS)
         conn.execute('PRAGMA count_changes = OFF')
         conn.execute('PRAGMA temp_store = MEMORY')
-        conn.execute('PRAGMA journal_mode = DELETE')
+        journal_mode = DB_JOURNAL_MODE
+        if not journal_mode and \
+                conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            journal_mode = 'DELETE'
+        if journal_mode:
+            try:
+                # not retried when locked, unlike GreenDBConnection.execute
+                sqlite3.Connection.execute(
+                    conn, 'PRAGMA journal_mode = %s' % journal_mode)
+            except sqlite3.OperationalError, err:
+                # The DB is in use in its current mode; a later connection
+                # will change it.
+                if 'locked' not in str(err):
+                    raise
+        if DB_CACHE_SIZE is not None:
+            conn.execute('PRAGMA cache_size = %d' % DB_CACHE_SIZE)
+        if DB_MMAP_SIZE is not None:
+            conn.execute('PRAGMA mmap_size = %d' % DB_MMAP_SIZE)
         conn.create_function('chexor', 3, chexor)
+        if not prefix_stat_supported():
+            conn.create_function('instr', 2, _instr)
     except sqlite3.DatabaseError:
         import traceback
         raise DatabaseConnectionError(path, traceback.format_exc(),
@@ -153,6 +245,133 @@ def get_db_connection(path, timeout=30, okay_to_create=False):
     return conn
 
 
+class ConnectionPool(object):
+    """
+    Keeps DB connections open once a broker is done with them, so later
+    brokers of the same DB (typically for later requests) can use them
+    rather than connecting again and starting with a cold page cache. An
+    idle connection is only handed out again if the DB file it was opened
+    on is still the one at its path; DBs that were replaced (by an rsync,
+    say), quarantined or removed get new connections. The least recently
+    used connections are closed once more than max_size are idle.
+
+    :param max_size: number of idle connections to keep; 0 disables pooling
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        # path -> deque of (file identity, connection), most recent last
+        self._idle = {}
+        # id(connection) -> path of every idle connection, least recently
+        # used first
+        self._order = OrderedDict()
+
+    def _take(self, path):
+        """
+        Removes the most recently used idle connection for path from the
+        pool and returns its (file identity, connection), or None.
+        """
+        idle = self._idle.get(path)
+        if not idle:
+            return None
+        identity, conn = idle.pop()
+        if not idle:
+            del self._idle[path]
+        del self._order[id(conn)]
+        return identity, conn
+
+    def get(self, path, timeout=BROKER_TIMEOUT):
+        """
+        Returns a connection to the DB at path: an idle one if there is a
+        valid one, otherwise a new one from get_db_connection.
+
+        :param path: path to DB
+        :param timeout: timeout for new connections
+        """
+        if self.max_size <= 0:
+            return get_db_connection(path, timeout)
+        try:
+            stat = os.stat(path)
+            identity = (stat.st_dev, stat.st_ino)
+        except OSError:
+            identity = None
+        while True:
+            entry = self._take(path)
+            if entry is None:
+                break
+            if identity is not None and entry[0] == identity:
+                entry[1].timeout = timeout
+                return entry[1]
+            entry[1].close()
+        conn = get_db_connection(path, timeout)
+        conn.db_identity = identity
+        return conn
+
+    def put(self, path, conn):
+        """
+        Returns a connection got from :func:`get` to the pool.
+
+        :param path: path to DB
+        :param conn: DB connection, with no transaction open
+        """
+        identity = getattr(conn, 'db_identity', None)
+        if self.max_size <= 0 or identity is None:
+            conn.close()
+            return
+        self._idle.setdefault(path, deque()).append((identity, conn))
+        self._order[id(conn)] = path
+        while len(self._order) > self.max_size:
+            # a path's oldest idle connection is first in its deque
+            _junk, oldest_path = self._order.popitem(last=False)
+            idle = self._idle[oldest_path]
+            idle.popleft()[1].close()
+            if not idle:
+                del self._idle[oldest_path]
+
+    def close_idle(self, path):
+        """
+        Closes the idle connections to the DB at path, so that nothing in
+        this process holds it open.
+
+        :param path: path to DB
+        """
+        while True:
+            entry = self._take(path)
+            if entry is None:
+                return
+            entry[1].close()
+
+    def clear(self):
+        """Closes all idle connections."""
+        for path in self._idle.keys():
+            self.close_idle(path)
+
+
+def configure_db_connections(conf):
+    """
+    Applies the DB connection settings of a server's or daemon's config:
+    db_pool_size, db_journal_mode, db_synchronous, db_cache_size and
+    db_mmap_size.
+
+    :param conf: server configuration dict
+    """
+    global DB_CONNECTION_POOL, DB_JOURNAL_MODE, DB_SYNCHRONOUS, \
+        DB_CACHE_SIZE, DB_MMAP_SIZE
+    DB_CONNECTION_POOL.clear()
+    DB_CONNECTION_POOL = ConnectionPool(int(conf.get('db_pool_size', 0)))
+    DB_JOURNAL_MODE = conf.get('db_journal_mode') or None
+    DB_SYNCHRONOUS = conf.get('db_synchronous') or 'NORMAL'
+    DB_CACHE_SIZE = DB_MMAP_SIZE = None
+    if conf.get('db_cache_size'):
+        DB_CACHE_SIZE = int(conf['db_cache_size'])
+    if conf.get('db_mmap_size'):
+        DB_MMAP_SIZE = int(conf['db_mmap_size'])
+
+
+#: Pool of idle DB connections; see :func:`configure_db_connections`
+DB_CONNECTION_POOL = ConnectionPool()
+
+
 class DatabaseBroker(object):
     """Encapsulates working with a database."""
 
@@ -246,7 +465,7 @@ class DatabaseBroker(object):
                     raise DatabaseConnectionError(self.db_file,
                             'DB created by someone else while working?')
                 renamer(tmp_db_file, self.db_file)
-            self.conn = get_db_connection(self.db_file, self.timeout)
+            self.conn = DB_CONNECTION_POOL.get(self.db_file, self.timeout)
         else:
             self.conn = conn
 
@@ -298,13 +517,59 @@ class DatabaseBroker(object):
         self.logger.error(detail)
         raise sqlite3.DatabaseError(detail)
 
+    def _release(self, conn):
+        """
+        Keeps a connection the broker is done with for its next use, or
+        returns it to the connection pool when pooling is enabled.
+
+        :param conn: DB connection, with no transaction open
+        """
+        if DB_CONNECTION_POOL.max_size > 0 and self.db_file != ':memory:':
+            DB_CONNECTION_POOL.put(self.db_file, conn)
+        else:
+            self.conn = conn
+
+    def checkpoint(self, truncate=True):
+        """
+        Copies everything in the DB's write-ahead log, if it is in WAL mode,
+        into the DB file, so the file can be copied on its own. This
+        process's pooled connections to the DB are closed first, since they
+        keep the log in use.
+
+        :param truncate: if True, waits for any writer to finish and empties
+                         the log afterwards; must be False while holding the
+                         DB's lock
+        """
+        if self.db_file == ':memory:' or \
+                not os.path.exists(self.db_file + '-wal'):
+            return
+        DB_CONNECTION_POOL.close_idle(self.db_file)
+        conn = get_db_connection(self.db_file, self.timeout)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(%s)' %
+                         (truncate and 'TRUNCATE' or 'PASSIVE'))
+        finally:
+            conn.close()
+
+    def has_pending_wal(self):
+        """
+        Returns True if the DB's write-ahead log holds changes that have not
+        been copied into the DB file yet; after :func:`checkpoint`, the
+        log file may be left in place but empty.
+        """
+        try:
+            return os.path.getsize(self.db_file + '-wal') > 0
+        except OSError:
+            return False
+
     @contextmanager
     def get(self):
         """Use with the "with" statement; returns a database connection."""
         if not self.conn:
             if self.db_file != ':memory:' and os.path.exists(self.db_file):
                 try:
-                    self.conn = get_db_connection(self.db_file, self.timeout)
+                    self.conn = DB_CONNECTION_POOL.get(self.db_file,
+                                                       self.timeout)
                 except (sqlite3.DatabaseError, DatabaseConnectionError):
                     self.possibly_quarantine(*sys.exc_info())
             else:
@@ -314,7 +579,7 @@ class DatabaseBroker(object):
         try:
             yield conn
             conn.rollback()
-            self.conn = conn
+            self._release(conn)
         except sqlite3.DatabaseError:
             try:
                 conn.close()
@@ -330,7 +595,7 @@ class DatabaseBroker(object):
         """Use with the "with" statement; locks a database."""
         if not self.conn:
             if self.db_file != ':memory:' and os.path.exists(self.db_file):
-                self.conn = get_db_connection(self.db_file, self.timeout)
+                self.conn = DB_CONNECTION_POOL.get(self.db_file, self.timeout)
             else:
                 raise DatabaseConnectionError(self.db_file, "DB doesn't exist")
         conn = self.conn
@@ -345,7 +610,7 @@ class DatabaseBroker(object):
         try:
             conn.execute('ROLLBACK')
             conn.isolation_level = orig_isolation_level
-            self.conn = conn
+            self._release(conn)
         except (Exception, Timeout):
             logging.exception(
                 _('Broker error trying to rollback locked connection'))
@@ -482,6 +747,96 @@ class DatabaseBroker(object):
     def _commit_puts(self):
         pass    # stub to be overridden if need be
 
+    def _iter_pending(self, fp, chunk_size=65536, partial_ok=False):
+        """
+        Yields the entries of an open .pending file, decoding it a chunk at
+        a time. Binary entries (see :func:`encode_pending_entry`) are read
+        along with the ':'-delimited base64 pickles written by older
+        versions, even when both are in the same file, so existing .pending
+        files are committed as usual after an upgrade. Invalid entries are
+        logged and skipped. After a torn or corrupt binary entry, reading
+        resumes at the next PENDING_ENTRY_MARKER that starts an entry whose
+        CRC checks out, so the entries after it are not lost.
+
+        :param fp: file object positioned at the start of the .pending file
+        :param chunk_size: bytes to read at a time
+        :param partial_ok: if True, an entry cut short at the end of the file
+                           is skipped quietly, as it is when the file is read
+                           without the lock while an entry is being appended
+        """
+        buf = ''
+        while True:
+            chunk = fp.read(chunk_size)
+            buf += chunk
+            pos = 0
+            while pos < len(buf):
+                if buf[pos] == PENDING_ENTRY_MARKER:
+                    start = pos + 1 + PENDING_HEADER.size
+                    length = checksum = None
+                    if start <= len(buf):
+                        length, checksum = \
+                            PENDING_HEADER.unpack(buf[pos + 1:start])
+                    if length is None or \
+                            (length <= PENDING_ENTRY_MAX_LENGTH and
+                             start + length > len(buf)):
+                        if chunk:
+                            break
+                        # cut short by the end of the file
+                        if not partial_ok:
+                            self.logger.error(
+                                _('Truncated pending entry %(file)s: '
+                                  '%(entry)r'),
+                                {'file': self.pending_file,
+                                 'entry': buf[pos:]})
+                        pos = self._next_pending_marker(buf, pos)
+                        continue
+                    entry = buf[start:start + length]
+                    if length > PENDING_ENTRY_MAX_LENGTH or \
+                            zlib.crc32(entry) & 0xffffffff != checksum:
+                        self.logger.error(
+                            _('Invalid pending entry %(file)s: %(entry)r'),
+                            {'file': self.pending_file,
+                             'entry': buf[pos:start]})
+                        pos = self._next_pending_marker(buf, pos)
+                        continue
+                    pos = start + length
+                    decode = pickle.loads
+                else:
+                    # An old style entry runs up to the next entry
+                    ends = [i for i in (buf.find(':', pos + 1),
+                                        buf.find(PENDING_ENTRY_MARKER, pos))
+                            if i != -1]
+                    if not ends and chunk:
+                        break
+                    end = min(ends or [len(buf)])
+                    entry = buf[pos:end].lstrip(':')
+                    pos = end
+                    if not entry:
+                        continue
+                    decode = lambda e: pickle.loads(e.decode('base64'))
+                try:
+                    yield decode(entry)
+                except Exception:
+                    self.logger.exception(
+                        _('Invalid pending entry %(file)s: %(entry)r'),
+                        {'file': self.pending_file, 'entry': entry})
+            buf = buf[pos:]
+            if not chunk:
+                return
+
+    def _next_pending_marker(self, buf, pos):
+        """
+        Finds where to resume reading after the invalid binary pending entry
+        at pos.
+
+        :returns: the position of the next PENDING_ENTRY_MARKER in buf, or
+                  the end of buf if there is none
+        """
+        pos = buf.find(PENDING_ENTRY_MARKER, pos + 1)
+        if pos == -1:
+            return len(buf)
+        return pos
+
     def merge_syncs(self, sync_points, incoming=True):
         """
         Merge a list of sync points with the incoming sync table.
@@ -633,11 +988,82 @@ class DatabaseBroker(object):
                 raise
         return False
 
+    def build_reclaim_index(self):
+        """
+        Creates the index on (deleted, reclaim_timestamp_column) that
+        reclaims find rows along, on older DBs that lack it. Building it
+        holds the DB's write lock for as long as it takes, which is long on
+        a large DB, so it is not done as part of reclaiming; the replicator
+        does it within a time budget of its own.
+
+        :returns: True if the index had to be built, False otherwise
+        """
+        table = self.db_contains_type
+        column = self.reclaim_timestamp_column
+        index = 'ix_%s_deleted_%s' % (table, column)
+        with self.get() as conn:
+            if conn.execute('''
+                    SELECT 1 FROM sqlite_master
+                    WHERE type = 'index' AND name = ?
+                    ''', (index,)).fetchone():
+                return False
+            conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (deleted, %s)'
+                         % (index, table, column))
+            conn.commit()
+            return True
+
+    def _reclaim_rows(self, conn, timestamp_column, timestamp, batch_size,
+                      time_budget):
+        """
+        Deletes the rows of the db_contains_type table that are marked
+        deleted and whose timestamp_column is < timestamp, committing each
+        batch of batch_size rows on its own and yielding to other
+        greenthreads in between, so the DB is never locked for long. The
+        rows are found along the index on (deleted, timestamp_column), so a
+        later call picks up where one that ran out of time stopped without
+        reading any of the rows that are being kept; older DBs only have it
+        once :func:`build_reclaim_index` has been run on them.
+
+        :param conn: DB connection to reclaim the rows with
+        :param timestamp_column: column holding the time rows were deleted
+        :param timestamp: max timestamp of rows to delete
+        :param batch_size: rows to delete per transaction; None deletes
+                           them all in one
+        :param time_budget: seconds after which to stop, even if there are
+                            rows left; None for no limit
+        :returns: True if every row due was deleted
+        """
+        table = self.db_contains_type
+        if not batch_size:
+            conn.execute('''
+                DELETE FROM %s WHERE deleted = 1 AND %s < ?
+            ''' % (table, timestamp_column), (timestamp,))
+            conn.commit()
+            return True
+        deadline = time_budget and time.time() + time_budget
+        while True:
+            curs = conn.execute('''
+                DELETE FROM %s WHERE ROWID IN (
+                    SELECT ROWID FROM %s WHERE deleted = 1 AND %s < ?
+                    LIMIT ?)
+            ''' % (table, table, timestamp_column), (timestamp, batch_size))
+            conn.commit()
+            if curs.rowcount < batch_size:
+                return True
+            if deadline and time.time() >= deadline:
+                return False
+            sleep()
+
 
 class ContainerBroker(DatabaseBroker):
     """Encapsulates working with a container database."""
     db_type = 'container'
     db_contains_type = 'object'
+    reclaim_timestamp_column = 'created_at'
+    # when set, reads merge in the .pending file rather than committing it
+    pending_read_flush_size = None
+    # (.pending file identity, parsed entries) from the last _load_pending
+    _pending_cache = None
 
     def _initialize(self, conn, put_timestamp):
         """Creates a brand new database (tables, indices, triggers, etc.)"""
@@ -669,6 +1095,9 @@ class ContainerBroker(DatabaseBroker):
 
             CREATE INDEX ix_object_deleted_name ON object (deleted, name);
 
+            CREATE INDEX ix_object_deleted_created_at ON
+                object (deleted, created_at);
+
             CREATE TRIGGER object_insert AFTER INSERT ON object
             BEGIN
                 UPDATE container_stat
@@ -780,42 +1209,174 @@ class ContainerBroker(DatabaseBroker):
 
         :returns: True if the database has no active objects, False otherwise
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_for_read()
         with self.get() as conn:
             row = conn.execute(
                     'SELECT object_count from container_stat').fetchone()
-            return (row[0] == 0)
+            object_count = row[0]
+            if self._load_pending(conn):
+                object_count += self._pending_usage(conn)[0]
+            return (object_count == 0)
 
-    def _commit_puts(self, item_list=None):
-        """Handles commiting rows in .pending files."""
+    def _commit_puts_for_read(self):
+        """
+        Commits the .pending file ahead of a read. If pending_read_flush_size
+        is set, reads merge the .pending entries into their results in
+        memory instead (see :func:`_load_pending`), so the file is only
+        committed once it holds more than that many bytes, and only if that
+        can be done without waiting for the lock.
+        """
+        if self.pending_read_flush_size is None:
+            try:
+                self._commit_puts()
+            except LockTimeout:
+                if not self.stale_reads_ok:
+                    raise
+            return
+        try:
+            if os.path.getsize(self.pending_file) <= \
+                    self.pending_read_flush_size:
+                return
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            self._commit_puts(timeout=0)
+        except LockTimeout:
+            pass
+
+    def _load_pending(self, conn):
+        """
+        Reads the .pending file without taking the lock and loads the newest
+        entry for each name into the temporary object_pending table of conn,
+        for reads that merge them into their results. Nothing is loaded
+        unless pending_read_flush_size is set.
+
+        The file is parsed once for as long as its size and mtime stay the
+        same, so the several reads of one request share the work.
+
+        :param conn: DB connection the read will use
+        :returns: True if any entries were loaded
+        """
+        if self.pending_read_flush_size is None or \
+                self.db_file == ':memory:':
+            return False
+        try:
+            stat = os.stat(self.pending_file)
+            key = (self.pending_file, stat.st_ino, stat.st_size,
+                   stat.st_mtime)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            key = None
+        if key is None or not self._pending_cache or \
+                self._pending_cache[0] != key:
+            self._pending_cache = (key, self._read_pending_newest())
+        newest = self._pending_cache[1]
+        if not newest:
+            return False
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS object_pending (
+                name TEXT PRIMARY KEY,
+                created_at TEXT,
+                size INTEGER,
+                content_type TEXT,
+                etag TEXT,
+                deleted INTEGER
+            )''')
+        conn.execute('DELETE FROM object_pending')
+        conn.executemany('''
+            INSERT INTO object_pending (name, created_at, size, content_type,
+                etag, deleted)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', newest.itervalues())
+        return True
+
+    def _read_pending_newest(self):
+        """
+        Parses the .pending file for :func:`_load_pending`.
+
+        :returns: dict of object name to the newest entry for it
+        """
+        newest = {}
+        try:
+            with open(self.pending_file, 'rb') as fp:
+                for entry in self._iter_pending(fp, partial_ok=True):
+                    try:
+                        (name, timestamp, size, content_type, etag,
+                            deleted) = entry
+                    except Exception:
+                        continue    # logged when the file is committed
+                    if name not in newest or newest[name][1] < timestamp:
+                        newest[name] = entry
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        return newest
+
+    def _pending_usage(self, conn):
+        """
+        Works out how the entries loaded by :func:`_load_pending` would
+        change the object count and bytes used once committed.
+
+        :param conn: DB connection the entries were loaded with
+        :returns: tuple of (object count change, bytes used change)
+        """
+        query = '''
+            SELECT object_pending.deleted, object_pending.size,
+                   object.deleted, object.size
+            FROM object_pending LEFT JOIN object
+            ON object.name = object_pending.name%s
+            WHERE object.created_at IS NULL OR
+                  object.created_at < object_pending.created_at
+        '''
+        deleted_filter = ''
+        if self.get_db_version(conn) >= 1:
+            deleted_filter = ' AND object.deleted IN (0, 1)'
+        object_count = bytes_used = 0
+        curs = conn.execute(query % deleted_filter)
+        curs.row_factory = None
+        for deleted, size, old_deleted, old_size in curs:
+            if not deleted:
+                object_count += 1
+                bytes_used += size
+            if old_deleted == 0:
+                object_count -= 1
+                bytes_used -= old_size
+        return object_count, bytes_used
+
+    def _commit_puts(self, item_list=None, timeout=None):
+        """
+        Handles commiting rows in .pending files.
+
+        :param item_list: rows to merge along with the .pending file's
+        :param timeout: seconds to wait for the lock, if not pending_timeout
+        """
         if self.db_file == ':memory:' or not os.path.exists(self.pending_file):
             return
         if item_list is None:
             item_list = []
-        with lock_parent_directory(self.pending_file, self.pending_timeout):
+        if timeout is None:
+            timeout = self.pending_timeout
+        with lock_parent_directory(self.pending_file, timeout):
             self._preallocate()
             if not os.path.getsize(self.pending_file):
                 if item_list:
                     self.merge_items(item_list)
                 return
             with open(self.pending_file, 'r+b') as fp:
-                for entry in fp.read().split(':'):
-                    if entry:
-                        try:
-                            (name, timestamp, size, content_type, etag,
-                                deleted) = pickle.loads(entry.decode('base64'))
-                            item_list.append({'name': name, 'created_at':
-                                timestamp, 'size': size, 'content_type':
-                                content_type, 'etag': etag,
-                                'deleted': deleted})
-                        except Exception:
-                            self.logger.exception(
-                                _('Invalid pending entry %(file)s: %(entry)s'),
-                                {'file': self.pending_file, 'entry': entry})
+                for entry in self._iter_pending(fp):
+                    try:
+                        (name, timestamp, size, content_type, etag,
+                            deleted) = entry
+                        item_list.append({'name': name, 'created_at':
+                            timestamp, 'size': size, 'content_type':
+                            content_type, 'etag': etag, 'deleted': deleted})
+                    except Exception:
+                        self.logger.exception(
+                            _('Invalid pending entry %(file)s: %(entry)s'),
+                            {'file': self.pending_file, 'entry': entry})
                 if item_list:
                     self.merge_items(item_list)
                 try:
@@ -824,7 +1385,8 @@ class ContainerBroker(DatabaseBroker):
                     if err.errno != errno.ENOENT:
                         raise
 
-    def reclaim(self, object_timestamp, sync_timestamp):
+    def reclaim(self, object_timestamp, sync_timestamp, batch_size=None,
+                time_budget=None):
         """
         Delete rows from the object table that are marked deleted and
         whose created_at timestamp is < object_timestamp.  Also deletes rows
@@ -836,13 +1398,15 @@ class ContainerBroker(DatabaseBroker):
         :param object_timestamp: max created_at timestamp of object rows to
                                  delete
         :param sync_timestamp: max update_at timestamp of sync rows to delete
+        :param batch_size: object rows to delete per transaction; None
+                           deletes them all in one
+        :param time_budget: seconds to spend deleting object rows before
+                            leaving the rest to a later call; None for no
+                            limit
+        :returns: True if every object row due was deleted
         """
         self._commit_puts()
         with self.get() as conn:
-            conn.execute("""
-                    DELETE FROM object
-                    WHERE deleted = 1
-                    AND created_at < ?""", (object_timestamp,))
             try:
                 conn.execute('''
                     DELETE FROM outgoing_sync WHERE updated_at < ?
@@ -856,6 +1420,8 @@ class ContainerBroker(DatabaseBroker):
                     raise
             DatabaseBroker._reclaim(self, conn, object_timestamp)
             conn.commit()
+            return self._reclaim_rows(conn, 'created_at', object_timestamp,
+                                      batch_size, time_budget)
 
     def delete_object(self, name, timestamp):
         """
@@ -878,11 +1444,21 @@ class ContainerBroker(DatabaseBroker):
         :param deleted: if True, marks the object as deleted and sets the
                         deteleted_at timestamp to timestamp
         """
-        record = {'name': name, 'created_at': timestamp, 'size': size,
-                  'content_type': content_type, 'etag': etag,
-                  'deleted': deleted}
+        self.put_objects([{'name': name, 'created_at': timestamp,
+                           'size': size, 'content_type': content_type,
+                           'etag': etag, 'deleted': deleted}])
+
+    def put_objects(self, records):
+        """
+        Creates several objects in the DB at once; they are appended to the
+        .pending file with a single write under a single lock, or merged in
+        one go if the .pending file is already full.
+
+        :param records: list of dictionaries of {'name', 'created_at',
+                        'size', 'content_type', 'etag', 'deleted'}
+        """
         if self.db_file == ':memory:':
-            self.merge_items([record])
+            self.merge_items(records)
             return
         if not os.path.exists(self.db_file):
             raise DatabaseConnectionError(self.db_file, "DB doesn't exist")
@@ -893,17 +1469,15 @@ class ContainerBroker(DatabaseBroker):
             if err.errno != errno.ENOENT:
                 raise
         if pending_size > PENDING_CAP:
-            self._commit_puts([record])
+            self._commit_puts(list(records))
         else:
             with lock_parent_directory(
                     self.pending_file, self.pending_timeout):
                 with open(self.pending_file, 'a+b') as fp:
-                    # Colons aren't used in base64 encoding; so they are our
-                    # delimiter
-                    fp.write(':')
-                    fp.write(pickle.dumps(
-                        (name, timestamp, size, content_type, etag, deleted),
-                        protocol=PICKLE_PROTOCOL).encode('base64'))
+                    fp.write(''.join(encode_pending_entry(
+                        (rec['name'], rec['created_at'], rec['size'],
+                         rec['content_type'], rec['etag'], rec['deleted']))
+                        for rec in records))
                     fp.flush()
 
     def is_deleted(self, timestamp=None):
@@ -914,11 +1488,7 @@ class ContainerBroker(DatabaseBroker):
         """
         if self.db_file != ':memory:' and not os.path.exists(self.db_file):
             return True
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_for_read()
         with self.get() as conn:
             row = conn.execute('''
                 SELECT put_timestamp, delete_timestamp, object_count
@@ -926,10 +1496,14 @@ class ContainerBroker(DatabaseBroker):
             # leave this db as a tombstone for a consistency window
             if timestamp and row['delete_timestamp'] > timestamp:
                 return False
+            object_count = row['object_count']
+            if self._load_pending(conn):
+                object_count = (object_count or 0) + \
+                    self._pending_usage(conn)[0]
             # The container is considered deleted if the delete_timestamp
             # value is greater than the put_timestamp, and there are no
             # objects in the container.
-            return (row['object_count'] in (None, '', 0, '0')) and \
+            return (object_count in (None, '', 0, '0')) and \
                 (float(row['delete_timestamp']) > float(row['put_timestamp']))
 
     def get_info(self, include_metadata=False):
@@ -944,11 +1518,7 @@ class ContainerBroker(DatabaseBroker):
                   If include_metadata is set, metadata is included as a key
                   pointing to a dict of tuples of the metadata
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_for_read()
         with self.get() as conn:
             data = None
             trailing1 = 'metadata'
@@ -972,6 +1542,10 @@ class ContainerBroker(DatabaseBroker):
                     else:
                         raise
             data = dict(data)
+            if self._load_pending(conn):
+                object_count, bytes_used = self._pending_usage(conn)
+                data['object_count'] += object_count
+                data['bytes_used'] += bytes_used
             if include_metadata:
                 try:
                     data['metadata'] = json.loads(data.get('metadata', ''))
@@ -1066,11 +1640,7 @@ class ContainerBroker(DatabaseBroker):
         """
         (marker, end_marker, prefix, delimiter, path) = utf8encode(
             marker, end_marker, prefix, delimiter, path)
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_for_read()
         if path is not None:
             prefix = path
             if path:
@@ -1079,11 +1649,18 @@ class ContainerBroker(DatabaseBroker):
         elif delimiter and not prefix:
             prefix = ''
         orig_marker = marker
+        scan_rows = DELIMITER_SCAN_ROWS
         with self.get() as conn:
+            source = 'object'
+            if self._load_pending(conn):
+                deleted_filter = ''
+                if self.get_db_version(conn) >= 1:
+                    deleted_filter = ' AND object.deleted IN (0, 1)'
+                source = PENDING_OBJECT_SOURCE % deleted_filter
             results = []
             while len(results) < limit:
                 query = '''SELECT name, created_at, size, content_type, etag
-                           FROM object WHERE'''
+                           FROM %s WHERE''' % source
                 query_args = []
                 if end_marker:
                     query += ' name < ? AND'
@@ -1108,9 +1685,27 @@ class ContainerBroker(DatabaseBroker):
                 if not delimiter:
                     return [r for r in curs if r[0].startswith(prefix)]
                 rowcount = 0
+                # Rows under a subdirectory that has been listed (or left
+                # out, for path) are stepped over in the same query, as
+                # that is cheaper than a new query for small directories;
+                # past scan_rows of them, the query is rerun from marker,
+                # which is already past the subdirectory. scan_rows adapts
+                # to the sizes of the subdirectories seen so far.
+                skip_prefix = None
                 for row in curs:
                     rowcount += 1
-                    marker = name = row[0]
+                    name = row[0]
+                    if skip_prefix is not None:
+                        if name.startswith(skip_prefix):
+                            skipped += 1
+                            if skipped < scan_rows:
+                                continue
+                            scan_rows = max(scan_rows // 2, 1)
+                            curs.close()
+                            break
+                        scan_rows = min(scan_rows * 2, DELIMITER_SCAN_ROWS)
+                        skip_prefix = None
+                    marker = name
                     if len(results) >= limit or not name.startswith(prefix):
                         curs.close()
                         return results
@@ -1120,15 +1715,17 @@ class ContainerBroker(DatabaseBroker):
                             continue
                         if end >= 0 and len(name) > end + len(delimiter):
                             marker = name[:end] + chr(ord(delimiter) + 1)
-                            curs.close()
-                            break
+                            skip_prefix = name[:end + 1]
+                            skipped = 0
+                            continue
                     elif end > 0:
                         marker = name[:end] + chr(ord(delimiter) + 1)
                         dir_name = name[:end + 1]
                         if dir_name != orig_marker:
                             results.append([dir_name, '0', 0, None, ''])
-                        curs.close()
-                        break
+                        skip_prefix = dir_name
+                        skipped = 0
+                        continue
                     results.append(row)
                 if not rowcount:
                     break
@@ -1138,32 +1735,60 @@ class ContainerBroker(DatabaseBroker):
         """
         Merge items into the object table.
 
+        The items are staged in a temporary table and merged with a few
+        set-based statements rather than several statements per item; as
+        before, the newest record for each name wins and the object table's
+        triggers fire for every row deleted or inserted.
+
         :param item_list: list of dictionaries of {'name', 'created_at',
                           'size', 'content_type', 'etag', 'deleted'}
         :param source: if defined, update incoming_sync with the source
         """
+        newest = {}
+        max_rowid = -1
+        for index, rec in enumerate(item_list):
+            current = newest.get(rec['name'])
+            if current is None or current[1]['created_at'] < rec['created_at']:
+                newest[rec['name']] = (index, rec)
+            if source:
+                max_rowid = max(max_rowid, rec['ROWID'])
         with self.get() as conn:
-            max_rowid = -1
-            for rec in item_list:
-                query = '''
-                    DELETE FROM object
-                    WHERE name = ? AND (created_at < ?)
-                '''
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                conn.execute(query, (rec['name'], rec['created_at']))
-                query = 'SELECT 1 FROM object WHERE name = ?'
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                if not conn.execute(query, (rec['name'],)).fetchall():
-                    conn.execute('''
-                        INSERT INTO object (name, created_at, size,
-                            content_type, etag, deleted)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', ([rec['name'], rec['created_at'], rec['size'],
-                          rec['content_type'], rec['etag'], rec['deleted']]))
-                if source:
-                    max_rowid = max(max_rowid, rec['ROWID'])
+            deleted_filter = ''
+            if self.get_db_version(conn) >= 1:
+                deleted_filter = ' AND object.deleted IN (0, 1)'
+            conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS object_merge (
+                    name TEXT PRIMARY KEY,
+                    created_at TEXT,
+                    size INTEGER,
+                    content_type TEXT,
+                    etag TEXT,
+                    deleted INTEGER
+                )''')
+            conn.executemany('''
+                INSERT INTO object_merge (name, created_at, size,
+                    content_type, etag, deleted)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', ([rec['name'], rec['created_at'], rec['size'],
+                   rec['content_type'], rec['etag'], rec['deleted']]
+                  for _junk, rec in sorted(newest.itervalues())))
+            conn.execute('''
+                DELETE FROM object WHERE ROWID IN (
+                    SELECT object.ROWID FROM object_merge JOIN object
+                    ON object.name = object_merge.name%s
+                    WHERE object.created_at < object_merge.created_at)
+            ''' % deleted_filter)
+            conn.execute('''
+                INSERT INTO object (name, created_at, size, content_type,
+                    etag, deleted)
+                SELECT name, created_at, size, content_type, etag, deleted
+                FROM object_merge
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM object
+                    WHERE object.name = object_merge.name%s)
+                ORDER BY object_merge.ROWID
+            ''' % deleted_filter)
+            conn.execute('DELETE FROM object_merge')
             if source:
                 try:
                     conn.execute('''
@@ -1182,6 +1807,7 @@ class AccountBroker(DatabaseBroker):
     """Encapsulates working with a account database."""
     db_type = 'account'
     db_contains_type = 'container'
+    reclaim_timestamp_column = 'delete_timestamp'
 
     def _initialize(self, conn, put_timestamp):
         """
@@ -1216,6 +1842,9 @@ class AccountBroker(DatabaseBroker):
             CREATE INDEX ix_container_deleted_name ON
                 container (deleted, name);
 
+            CREATE INDEX ix_container_deleted_delete_timestamp ON
+                container (deleted, delete_timestamp);
+
             CREATE TRIGGER container_insert AFTER INSERT ON container
             BEGIN
                 UPDATE account_stat
@@ -1316,11 +1945,14 @@ class AccountBroker(DatabaseBroker):
             WHERE delete_timestamp < ? """, (timestamp, timestamp, timestamp))
 
     def _commit_puts(self, item_list=None):
-        """Handles commiting rows in .pending files."""
+        """
+        Handles commiting rows in .pending files.
+
+        :param item_list: rows to merge after the .pending file's, which are
+                          older
+        """
         if self.db_file == ':memory:' or not os.path.exists(self.pending_file):
             return
-        if item_list is None:
-            item_list = []
         with lock_parent_directory(self.pending_file, self.pending_timeout):
             self._preallocate()
             if not os.path.getsize(self.pending_file):
@@ -1328,22 +1960,22 @@ class AccountBroker(DatabaseBroker):
                     self.merge_items(item_list)
                 return
             with open(self.pending_file, 'r+b') as fp:
-                for entry in fp.read().split(':'):
-                    if entry:
-                        try:
-                            (name, put_timestamp, delete_timestamp,
-                                    object_count, bytes_used, deleted) = \
-                                pickle.loads(entry.decode('base64'))
-                            item_list.append({'name': name,
-                                      'put_timestamp': put_timestamp,
-                                      'delete_timestamp': delete_timestamp,
-                                      'object_count': object_count,
-                                      'bytes_used': bytes_used,
-                                      'deleted': deleted})
-                        except Exception:
-                            self.logger.exception(
-                                _('Invalid pending entry %(file)s: %(entry)s'),
-                                {'file': self.pending_file, 'entry': entry})
+                pending = []
+                for entry in self._iter_pending(fp):
+                    try:
+                        (name, put_timestamp, delete_timestamp,
+                                object_count, bytes_used, deleted) = entry
+                        pending.append({'name': name,
+                                  'put_timestamp': put_timestamp,
+                                  'delete_timestamp': delete_timestamp,
+                                  'object_count': object_count,
+                                  'bytes_used': bytes_used,
+                                  'deleted': deleted})
+                    except Exception:
+                        self.logger.exception(
+                            _('Invalid pending entry %(file)s: %(entry)s'),
+                            {'file': self.pending_file, 'entry': entry})
+                item_list = pending + (item_list or [])
                 if item_list:
                     self.merge_items(item_list)
                 try:
@@ -1368,7 +2000,8 @@ class AccountBroker(DatabaseBroker):
                     'SELECT container_count from account_stat').fetchone()
             return (row[0] == 0)
 
-    def reclaim(self, container_timestamp, sync_timestamp):
+    def reclaim(self, container_timestamp, sync_timestamp, batch_size=None,
+                time_budget=None):
         """
         Delete rows from the container table that are marked deleted and
         whose created_at timestamp is < container_timestamp.  Also deletes rows
@@ -1380,14 +2013,16 @@ class AccountBroker(DatabaseBroker):
         :param container_timestamp: max created_at timestamp of container rows
                                     to delete
         :param sync_timestamp: max update_at timestamp of sync rows to delete
+        :param batch_size: container rows to delete per transaction; None
+                           deletes them all in one
+        :param time_budget: seconds to spend deleting container rows before
+                            leaving the rest to a later call; None for no
+                            limit
+        :returns: True if every container row due was deleted
         """
 
         self._commit_puts()
         with self.get() as conn:
-            conn.execute('''
-                DELETE FROM container WHERE
-                deleted = 1 AND delete_timestamp < ?
-            ''', (container_timestamp,))
             try:
                 conn.execute('''
                     DELETE FROM outgoing_sync WHERE updated_at < ?
@@ -1401,6 +2036,9 @@ class AccountBroker(DatabaseBroker):
                     raise
             DatabaseBroker._reclaim(self, conn, container_timestamp)
             conn.commit()
+            return self._reclaim_rows(conn, 'delete_timestamp',
+                                      container_timestamp, batch_size,
+                                      time_budget)
 
     def get_container_timestamp(self, container_name):
         """
@@ -1462,15 +2100,41 @@ class AccountBroker(DatabaseBroker):
             with lock_parent_directory(self.pending_file,
                                        self.pending_timeout):
                 with open(self.pending_file, 'a+b') as fp:
-                    # Colons aren't used in base64 encoding; so they are our
-                    # delimiter
-                    fp.write(':')
-                    fp.write(pickle.dumps(
+                    fp.write(encode_pending_entry(
                         (name, put_timestamp, delete_timestamp, object_count,
-                         bytes_used, deleted),
-                        protocol=PICKLE_PROTOCOL).encode('base64'))
+                         bytes_used, deleted)))
                     fp.flush()
 
+    def put_containers(self, records):
+        """
+        Create or update several containers at once, as reported together
+        by the container updater; they are merged along with the rows of the
+        .pending file in a single merge_items call.
+
+        :param records: list of dictionaries of {'name', 'put_timestamp',
+                        'delete_timestamp', 'object_count', 'bytes_used'}
+        """
+        item_list = []
+        for rec in records:
+            if rec['delete_timestamp'] > rec['put_timestamp'] and \
+                    rec['object_count'] in (None, '', 0, '0'):
+                deleted = 1
+            else:
+                deleted = 0
+            item_list.append({'name': rec['name'],
+                              'put_timestamp': rec['put_timestamp'],
+                              'delete_timestamp': rec['delete_timestamp'],
+                              'object_count': rec['object_count'],
+                              'bytes_used': rec['bytes_used'],
+                              'deleted': deleted})
+        if self.db_file != ':memory:' and not os.path.exists(self.db_file):
+            raise DatabaseConnectionError(self.db_file, "DB doesn't exist")
+        if self.db_file == ':memory:' or \
+                not os.path.exists(self.pending_file):
+            self.merge_items(item_list)
+        else:
+            self._commit_puts(item_list)
+
     def can_delete_db(self, cutoff):
         """
         Check if the accont DB can be deleted.
@@ -1544,6 +2208,145 @@ class AccountBroker(DatabaseBroker):
                 FROM account_stat
             ''').fetchone())
 
+    def _prefix_stat_delimiter_sql(self, delimiter):
+        """
+        Returns delimiter quoted as an SQL string literal, for the
+        prefix_stat triggers.
+        """
+        return "'%s'" % delimiter.replace("'", "''")
+
+    def _has_prefix_stat(self, conn, delimiter):
+        """
+        Returns whether the DB has a prefix_stat table kept up to date for
+        delimiter, as recorded in its prefix_stat_info table.
+        """
+        try:
+            row = conn.execute(
+                'SELECT delimiter FROM prefix_stat_info').fetchone()
+        except sqlite3.OperationalError, err:
+            if 'no such table' not in str(err):
+                raise
+            return False
+        return bool(row) and row[0] == delimiter
+
+    def create_prefix_stat_table(self, conn, delimiter):
+        """
+        Create the prefix_stat table, which totals the usage of the
+        account's containers by the first segment of their names, up to and
+        including the first delimiter, the way account_stat totals all of
+        it. It is kept up to date by triggers on the container table, which
+        work the prefix out in plain SQL so any connection can write to the
+        DB; they use instr(), so this needs SQLite 3.7.15 or later (see
+        :func:`prefix_stat_supported`). The delimiter is recorded in the
+        prefix_stat_info table. Any prefix_stat table for another delimiter
+        is replaced, and the new one is filled in from the container table.
+
+        :param conn: DB connection object
+        :param delimiter: delimiter character ending the prefixes
+        """
+        conn.executescript("""
+            BEGIN;
+            DROP TRIGGER IF EXISTS prefix_stat_insert;
+            DROP TRIGGER IF EXISTS prefix_stat_delete;
+            DROP TABLE IF EXISTS prefix_stat;
+            DROP TABLE IF EXISTS prefix_stat_info;
+
+            CREATE TABLE prefix_stat_info (
+                delimiter TEXT
+            );
+            INSERT INTO prefix_stat_info (delimiter) VALUES (%(delimiter)s);
+
+            CREATE TABLE prefix_stat (
+                prefix TEXT PRIMARY KEY,
+                container_count INTEGER DEFAULT 0,
+                object_count INTEGER DEFAULT 0,
+                bytes_used INTEGER DEFAULT 0
+            );
+
+            INSERT INTO prefix_stat (prefix, container_count, object_count,
+                bytes_used)
+            SELECT substr(name, 1, instr(name, %(delimiter)s)),
+                SUM(1 - deleted), SUM(object_count), SUM(bytes_used)
+            FROM container
+            WHERE instr(name, %(delimiter)s) > 0
+            GROUP BY substr(name, 1, instr(name, %(delimiter)s));
+
+            CREATE TRIGGER prefix_stat_insert AFTER INSERT ON container
+            WHEN instr(new.name, %(delimiter)s) > 0
+            BEGIN
+                INSERT OR IGNORE INTO prefix_stat (prefix)
+                VALUES (substr(new.name, 1, instr(new.name, %(delimiter)s)));
+                UPDATE prefix_stat
+                SET container_count = container_count + (1 - new.deleted),
+                    object_count = object_count + new.object_count,
+                    bytes_used = bytes_used + new.bytes_used
+                WHERE prefix =
+                    substr(new.name, 1, instr(new.name, %(delimiter)s));
+            END;
+
+            CREATE TRIGGER prefix_stat_delete AFTER DELETE ON container
+            WHEN instr(old.name, %(delimiter)s) > 0
+            BEGIN
+                UPDATE prefix_stat
+                SET container_count = container_count - (1 - old.deleted),
+                    object_count = object_count - old.object_count,
+                    bytes_used = bytes_used - old.bytes_used
+                WHERE prefix =
+                    substr(old.name, 1, instr(old.name, %(delimiter)s));
+            END;
+            COMMIT;
+        """ % {'delimiter': self._prefix_stat_delimiter_sql(delimiter)})
+
+    def build_prefix_stat(self, delimiter):
+        """
+        Make sure the DB has a prefix_stat table for delimiter, building it
+        with one pass over the container table if not. The replicator calls
+        this so the pass is never made on behalf of a request.
+
+        :param delimiter: delimiter character ending the prefixes
+        :returns: True if the table had to be built, False otherwise
+        """
+        with self.get() as conn:
+            if self._has_prefix_stat(conn, delimiter):
+                return False
+            self.create_prefix_stat_table(conn, delimiter)
+            return True
+
+    def get_prefix_info(self, prefix, delimiter):
+        """
+        Get the usage of the account's containers whose names start with
+        prefix, from the prefix_stat table for delimiter. Only the first
+        segment of container names is totaled, so prefix must end with the
+        delimiter and contain no other.
+
+        :param prefix: container name prefix, ending with the delimiter
+        :param delimiter: delimiter character ending the prefixes
+        :returns: dict with keys: container_count, object_count, bytes_used;
+                  or None if the prefix_stat table for delimiter has not
+                  been built yet (see :func:`build_prefix_stat`)
+        :raises ValueError: if prefix is not a single segment ending with
+                            the delimiter
+        """
+        if prefix.find(delimiter) != len(prefix) - len(delimiter):
+            raise ValueError('usage prefix must be a single segment ending '
+                             'with %r' % delimiter)
+        try:
+            self._commit_puts()
+        except LockTimeout:
+            if not self.stale_reads_ok:
+                raise
+        with self.get() as conn:
+            if not self._has_prefix_stat(conn, delimiter):
+                return None
+            row = conn.execute('''
+                SELECT container_count, object_count, bytes_used
+                FROM prefix_stat WHERE prefix = ?
+            ''', (prefix,)).fetchone()
+            if not row:
+                return {'container_count': 0, 'object_count': 0,
+                        'bytes_used': 0}
+            return dict(row)
+
     def list_containers_iter(self, limit, marker, end_marker, prefix,
                              delimiter):
         """
@@ -1619,58 +2422,94 @@ class AccountBroker(DatabaseBroker):
                     break
             return results
 
+    def _merge_container_record(self, record, row):
+        """
+        Merges a container record with the one already known for its name.
+
+        :param record: list of [name, put_timestamp, delete_timestamp,
+                       object_count, bytes_used, deleted] being merged in
+        :param row: the same for the known record
+        :returns: the merged record
+        """
+        for i in xrange(5):
+            if record[i] is None and row[i] is not None:
+                record[i] = row[i]
+        if row[1] > record[1]:  # Keep newest put_timestamp
+            record[1] = row[1]
+        if row[2] > record[2]:  # Keep newest delete_timestamp
+            record[2] = row[2]
+        # If deleted, mark as such
+        if record[2] > record[1] and \
+                record[3] in (None, '', 0, '0'):
+            record[5] = 1
+        else:
+            record[5] = 0
+        return record
+
     def merge_items(self, item_list, source=None):
         """
         Merge items into the container table.
 
+        Items for the same name are merged with each other first; the
+        existing rows for the batch are then read, deleted and replaced with
+        a few set-based statements rather than several statements per item.
+        The container table's triggers fire for every row deleted or
+        inserted.
+
         :param item_list: list of dictionaries of {'name', 'put_timestamp',
                           'delete_timestamp', 'object_count', 'bytes_used',
                           'deleted'}
         :param source: if defined, update incoming_sync with the source
         """
+        records = {}
+        max_rowid = -1
+        for index, rec in enumerate(item_list):
+            record = [rec['name'], rec['put_timestamp'],
+                      rec['delete_timestamp'], rec['object_count'],
+                      rec['bytes_used'], rec['deleted']]
+            if rec['name'] in records:
+                record = self._merge_container_record(record,
+                                                      records[rec['name']][1])
+            # a name's row ends up where its last record was in the batch
+            records[rec['name']] = (index, record)
+            if source:
+                max_rowid = max(max_rowid, rec['ROWID'])
+        records = [record for _junk, record in sorted(records.itervalues())]
         with self.get() as conn:
-            max_rowid = -1
-            for rec in item_list:
-                record = [rec['name'], rec['put_timestamp'],
-                          rec['delete_timestamp'], rec['object_count'],
-                          rec['bytes_used'], rec['deleted']]
-                query = '''
-                    SELECT name, put_timestamp, delete_timestamp,
-                           object_count, bytes_used, deleted
-                    FROM container WHERE name = ?
-                '''
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                curs = conn.execute(query, (rec['name'],))
-                curs.row_factory = None
-                row = curs.fetchone()
-                if row:
-                    row = list(row)
-                    for i in xrange(5):
-                        if record[i] is None and row[i] is not None:
-                            record[i] = row[i]
-                    if row[1] > record[1]:  # Keep newest put_timestamp
-                        record[1] = row[1]
-                    if row[2] > record[2]:  # Keep newest delete_timestamp
-                        record[2] = row[2]
-                    # If deleted, mark as such
-                    if record[2] > record[1] and \
-                            record[3] in (None, '', 0, '0'):
-                        record[5] = 1
-                    else:
-                        record[5] = 0
-                conn.execute('''
-                    DELETE FROM container WHERE name = ? AND
-                                                deleted IN (0, 1)
-                ''', (record[0],))
-                conn.execute('''
-                    INSERT INTO container (name, put_timestamp,
-                        delete_timestamp, object_count, bytes_used,
-                        deleted)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', record)
-                if source:
-                    max_rowid = max(max_rowid, rec['ROWID'])
+            conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS container_merge (
+                    name TEXT PRIMARY KEY
+                )''')
+            conn.executemany(
+                'INSERT INTO container_merge (name) VALUES (?)',
+                ([record[0]] for record in records))
+            query = '''
+                SELECT container.name, put_timestamp, delete_timestamp,
+                       object_count, bytes_used, deleted
+                FROM container_merge JOIN container
+                ON container.name = container_merge.name
+            '''
+            if self.get_db_version(conn) >= 1:
+                query += ' AND deleted IN (0, 1)'
+            curs = conn.execute(query)
+            curs.row_factory = None
+            existing = {}
+            for row in curs:
+                existing.setdefault(row[0], row)
+            for record in records:
+                if record[0] in existing:
+                    self._merge_container_record(record, existing[record[0]])
+            conn.execute('''
+                DELETE FROM container WHERE deleted IN (0, 1) AND
+                    name IN (SELECT name FROM container_merge)
+            ''')
+            conn.executemany('''
+                INSERT INTO container (name, put_timestamp,
+                    delete_timestamp, object_count, bytes_used,
+                    deleted)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', records)
+            conn.execute('DELETE FROM container_merge')
             if source:
                 try:
                     conn.execute('''
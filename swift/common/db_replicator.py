@@ -21,9 +21,16 @@ import time
 import shutil
 import uuid
 import errno
+import cPickle as pickle
+from operator import itemgetter
 import re
+import signal
+import struct
+import zlib
+from tempfile import mkstemp
 
 from eventlet import GreenPool, sleep, Timeout
+from eventlet.semaphore import Semaphore
 from eventlet.green import subprocess
 import simplejson
 from webob import Response
@@ -33,7 +40,7 @@ from webob.exc import HTTPNotFound, HTTPNoContent, HTTPAccepted, \
 import swift.common.db
 from swift.common.utils import get_logger, whataremyips, storage_directory, \
     renamer, mkdirs, lock_parent_directory, TRUE_VALUES, unlink_older_than, \
-    dump_recon_cache, rsync_ip
+    dump_recon_cache, rsync_ip, write_pickle
 from swift.common import ring
 from swift.common.bufferedhttp import BufferedHTTPConnection
 from swift.common.exceptions import DriveNotMounted, ConnectionTimeout
@@ -41,6 +48,18 @@ from swift.common.daemon import Daemon
 
 
 DEBUG_TIMINGS_THRESHOLD = 10
+# REPLICATE request bodies at least this long are compressed, if the remote
+# server accepts that
+COMPRESS_MIN_SIZE = 4096
+# Content-Type of REPLICATE requests in the rows encoding; see
+# encode_replicate_rows
+ROWS_CONTENT_TYPE = 'application/x-swift-rows'
+# Per partition index of the dbs found to be in sync with all of their peers
+REPLICATED_FILE = 'replicated.pkl'
+# Fields of a db's replication info that are kept in REPLICATED_FILE; enough
+# to send a sync RPC without opening the db
+REPLICATED_INFO_KEYS = ('max_row', 'hash', 'id', 'created_at',
+                        'put_timestamp', 'delete_timestamp')
 
 
 def quarantine_db(object_file, server_type):
@@ -65,6 +84,125 @@ def quarantine_db(object_file, server_type):
         renamer(object_dir, quarantine_dir)
 
 
+def _is_rows(arg):
+    """Whether a REPLICATE argument is a list of rows, such as DB items."""
+    return isinstance(arg, list) and arg and \
+        set(map(type, arg)) == set([dict]) and \
+        set(map(len, arg)) == set([len(arg[0])])
+
+
+def encode_replicate_rows(args):
+    """
+    Encodes the arguments of a REPLICATE request more compactly than JSON,
+    for servers that accept the rows encoding. Each argument that is a list
+    of rows (dicts with the same keys) is sent a column at a time: columns
+    of integers as packed little-endian 64-bit values, columns of strings
+    as the UTF-8 strings joined by NULs, and any other column as JSON. The
+    other arguments, and the layout of the columns, go in a JSON header in
+    front of them, and the whole is deflated.
+
+    :param args: list of json-encodable objects
+    :returns: the encoded request body
+    """
+    header = {'args': [], 'rows': []}
+    columns = []
+    for index, arg in enumerate(args):
+        if not _is_rows(arg):
+            header['args'].append(arg)
+            continue
+        header['args'].append(None)
+        spec = []
+        for key in sorted(arg[0]):
+            values = map(itemgetter(key), arg)
+            types = set(map(type, values))
+            column = None
+            if types <= set([int, long]):
+                try:
+                    kind = 'int'
+                    column = struct.pack('<%dq' % len(values), *values)
+                except struct.error:
+                    pass
+            elif types <= set([str, unicode]):
+                if unicode in types:
+                    values = [isinstance(value, unicode) and
+                              value.encode('utf8') or value
+                              for value in values]
+                kind = 'str'
+                column = '\0'.join(values)
+                if column.count('\0') != len(values) - 1:
+                    column = None
+            if column is None:
+                kind, column = 'json', simplejson.dumps(values)
+            spec.append([key, kind, len(column)])
+            columns.append(column)
+        header['rows'].append([index, len(arg), spec])
+    header = simplejson.dumps(header)
+    return zlib.compress(struct.pack('!I', len(header)) + header +
+                         ''.join(columns), 1)
+
+
+def decode_replicate_rows(body):
+    """
+    Decodes the arguments of a REPLICATE request from the rows encoding
+    (see :func:`encode_replicate_rows`); strings in rows come back as UTF-8
+    encoded strs.
+
+    :param body: the request body
+    :returns: the list of arguments
+    :raises ValueError: if the body cannot be decoded
+    """
+    try:
+        body = zlib.decompress(body)
+        header_size = struct.unpack('!I', body[:4])[0]
+        header = simplejson.loads(body[4:4 + header_size])
+        args = header['args']
+        pos = 4 + header_size
+        for index, count, spec in header['rows']:
+            keys = []
+            columns = []
+            for key, kind, size in spec:
+                column = body[pos:pos + size]
+                pos += size
+                if kind == 'int':
+                    values = struct.unpack('<%dq' % (len(column) // 8),
+                                           column)
+                elif kind == 'str':
+                    values = column.split('\0')
+                else:
+                    values = simplejson.loads(column)
+                if len(values) != count:
+                    raise ValueError('column %s has %d values, not %d' %
+                                     (key, len(values), count))
+                keys.append(key)
+                columns.append(values)
+            args[index] = [dict(zip(keys, row)) for row in zip(*columns)]
+        return args
+    except (zlib.error, struct.error, KeyError, IndexError,
+            TypeError), err:
+        raise ValueError(str(err))
+
+
+def load_replicate_args(req):
+    """
+    Reads the arguments of a REPLICATE request: a JSON-encoded list, which
+    is deflated if the request's Content-Encoding says so, or a body in the
+    rows encoding (see :func:`encode_replicate_rows`).
+
+    :param req: webob.Request object
+    :returns: the list of arguments
+    :raises ValueError: if the body cannot be decoded
+    """
+    body = req.environ['wsgi.input'].read()
+    if req.headers.get('Content-Type') == ROWS_CONTENT_TYPE:
+        return decode_replicate_rows(body)
+    if req.headers.get('Content-Encoding') == 'deflate':
+        try:
+            body = zlib.decompress(body)
+        except zlib.error, err:
+            raise ValueError(str(err))
+    return simplejson.loads(body)
+
+
 class ReplConnection(BufferedHTTPConnection):
     """
     Helper to simplify REPLICATEing to a remote server.
@@ -76,19 +214,45 @@ class ReplConnection(BufferedHTTPConnection):
         self.node = node
         BufferedHTTPConnection.__init__(self, '%(ip)s:%(port)s' % node)
         self.path = '/%s/%s/%s' % (node['device'], partition, hash_)
+        # Content-Encodings the remote server accepts, from its sync response
+        self.encodings = ()
 
-    def replicate(self, *args):
+    def send_replicate(self, *args):
         """
-        Make an HTTP REPLICATE request
+        Send an HTTP REPLICATE request without waiting for its response, so
+        the caller can get on with something else in the meantime.
 
         :param args: list of json-encodable objects
 
-        :returns: httplib response object
+        :returns: True if the request was sent
         """
         try:
+            if 'rows' in self.encodings and \
+                    [arg for arg in args if _is_rows(arg)]:
+                self.request('REPLICATE', self.path,
+                             encode_replicate_rows(args),
+                             {'Content-Type': ROWS_CONTENT_TYPE})
+                return True
             body = simplejson.dumps(args)
-            self.request('REPLICATE', self.path, body,
-                    {'Content-Type': 'application/json'})
+            headers = {'Content-Type': 'application/json'}
+            if 'deflate' in self.encodings and \
+                    len(body) >= COMPRESS_MIN_SIZE:
+                body = zlib.compress(body, 1)
+                headers['Content-Encoding'] = 'deflate'
+            self.request('REPLICATE', self.path, body, headers)
+            return True
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR sending HTTP request to %s'), self.node)
+            return False
+
+    def get_replicate_response(self):
+        """
+        Read the response to the REPLICATE request last sent.
+
+        :returns: httplib response object
+        """
+        try:
             response = self.getresponse()
             response.data = response.read()
             return response
@@ -97,6 +261,18 @@ class ReplConnection(BufferedHTTPConnection):
                 _('ERROR reading HTTP response from %s'), self.node)
             return None
 
+    def replicate(self, *args):
+        """
+        Make an HTTP REPLICATE request
+
+        :param args: list of json-encodable objects
+
+        :returns: httplib response object
+        """
+        if not self.send_replicate(*args):
+            return None
+        return self.get_replicate_response()
+
 
 class Replicator(Daemon):
     """
@@ -112,9 +288,12 @@ class Replicator(Daemon):
         self.port = int(conf.get('bind_port', self.default_port))
         concurrency = int(conf.get('concurrency', 8))
         self.cpool = GreenPool(size=concurrency)
+        self.device_concurrency = int(conf.get('device_concurrency', 1))
         swift_dir = conf.get('swift_dir', '/etc/swift')
         self.ring = ring.Ring(swift_dir, ring_name=self.server_type)
         self.per_diff = int(conf.get('per_diff', 1000))
+        self.max_per_diff = max(int(conf.get('max_per_diff') or
+                                    self.per_diff * 10), self.per_diff)
         self.max_diffs = int(conf.get('max_diffs') or 100)
         self.interval = int(conf.get('interval') or
                             conf.get('run_pause') or 30)
@@ -122,9 +301,23 @@ class Replicator(Daemon):
             'vm_test_mode', 'no').lower() in ('yes', 'true', 'on', '1')
         self.node_timeout = int(conf.get('node_timeout', 10))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
+        self.rsync_bwlimit = int(conf.get('rsync_bwlimit', 0))
+        self.rsync_concurrency = int(conf.get('rsync_concurrency') or
+                                     concurrency)
+        self._rsync_semaphores = {}
         self.reclaim_age = float(conf.get('reclaim_age', 86400 * 7))
+        self.reclaim_batch_size = int(conf.get('reclaim_batch_size', 1000))
+        self.reclaim_time_budget = \
+            float(conf.get('reclaim_time_budget', 10))
+        self.unchanged_recheck_interval = \
+            float(conf.get('unchanged_recheck_interval', 86400))
+        self.reclaim_index_time_budget = \
+            float(conf.get('reclaim_index_time_budget', 60))
+        self._reclaim_index_time = 0
+        self._replicated = {}
         swift.common.db.DB_PREALLOCATION = \
             conf.get('db_preallocation', 'f').lower() in TRUE_VALUES
+        swift.common.db.configure_db_connections(conf)
         self._zero_stats()
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
@@ -139,7 +332,8 @@ class Replicator(Daemon):
         self.stats = {'attempted': 0, 'success': 0, 'failure': 0, 'ts_repl': 0,
                       'no_change': 0, 'hashmatch': 0, 'rsync': 0, 'diff': 0,
                       'remove': 0, 'empty': 0, 'remote_merge': 0,
-                      'start': time.time(), 'diff_capped': 0}
+                      'start': time.time(), 'diff_capped': 0,
+                      'reclaim_deferred': 0, 'unchanged': 0}
 
     def _report_stats(self):
         """Report the current stats to the logs."""
@@ -159,11 +353,13 @@ class Replicator(Daemon):
         self.logger.info(' '.join(['%s:%s' % item for item in
              self.stats.items() if item[0] in
              ('no_change', 'hashmatch', 'rsync', 'diff', 'ts_repl', 'empty',
-              'diff_capped')]))
+              'diff_capped', 'reclaim_deferred', 'unchanged')]))
 
     def _rsync_file(self, db_file, remote_file, whole_file=True):
         """
         Sync a single file using rsync. Used by _rsync_db to handle syncing.
+        Partially transferred files are kept, so a failed sync picks up from
+        where it stopped the next time around.
 
         :param db_file: file to be synced
         :param remote_file: remote location to sync the DB file to
@@ -171,9 +367,14 @@ class Replicator(Daemon):
 
         :returns: True if the sync was successful, False otherwise
         """
-        popen_args = ['rsync', '--quiet', '--no-motd',
+        popen_args = ['rsync', '--quiet', '--no-motd', '--partial',
                       '--timeout=%s' % int(math.ceil(self.node_timeout)),
                       '--contimeout=%s' % int(math.ceil(self.conn_timeout))]
+        if self.rsync_bwlimit:
+            # rsync_bwlimit is for the whole device, and up to
+            # rsync_concurrency dbs from it are rsynced at a time
+            popen_args.append('--bwlimit=%d' % max(
+                1, self.rsync_bwlimit // self.rsync_concurrency))
         if whole_file:
             popen_args.append('--whole-file')
         popen_args.extend([db_file, remote_file])
@@ -204,24 +405,69 @@ class Replicator(Daemon):
         else:
             remote_file = '%s::%s/%s/tmp/%s' % (device_ip,
                     self.server_type, device['device'], local_id)
-        mtime = os.path.getmtime(broker.db_file)
-        if not self._rsync_file(broker.db_file, remote_file):
-            return False
-        # perform block-level sync if the db was modified during the first sync
-        if os.path.exists(broker.db_file + '-journal') or \
-                    os.path.getmtime(broker.db_file) > mtime:
-            # grab a lock so nobody else can modify it
-            with broker.lock():
-                if not self._rsync_file(broker.db_file, remote_file, False):
-                    return False
+        with self._rsync_semaphore(broker.db_file):
+            # only the DB file is copied, so a DB in WAL mode has its log
+            # copied into it first
+            broker.checkpoint()
+            mtime = os.path.getmtime(broker.db_file)
+            # the remote file is named after the db's id, so a copy left by
+            # an earlier sync that failed part way through is brought up to
+            # date rather than sent again
+            if not self._rsync_file(broker.db_file, remote_file, False):
+                return False
+            # perform block-level sync if the db was modified during the
+            # first sync
+            if os.path.exists(broker.db_file + '-journal') or \
+                        broker.has_pending_wal() or \
+                        os.path.getmtime(broker.db_file) > mtime:
+                # grab a lock so nobody else can modify it
+                with broker.lock():
+                    broker.checkpoint(truncate=False)
+                    if not self._rsync_file(broker.db_file, remote_file,
+                                            False):
+                        return False
         with Timeout(replicate_timeout or self.node_timeout):
             response = http.replicate(replicate_method, local_id)
         return response and response.status >= 200 and response.status < 300
 
+    def _rsync_semaphore(self, db_file):
+        """
+        Returns the semaphore that limits the dbs rsynced at a time from the
+        device db_file is on to rsync_concurrency.
+
+        :param db_file: path to the db about to be rsynced
+        """
+        device = self.extract_device(db_file)
+        if device not in self._rsync_semaphores:
+            self._rsync_semaphores[device] = \
+                Semaphore(self.rsync_concurrency)
+        return self._rsync_semaphores[device]
+
+    def _next_per_diff(self, per_diff, elapsed):
+        """
+        Adapts the number of rows sent per merge_items call to how long the
+        last call took: it doubles, up to max_per_diff, while calls finish
+        within an eighth of node_timeout, and halves, down to per_diff, once
+        they take more than a quarter of it.
+
+        :param per_diff: number of rows sent in the last call
+        :param elapsed: seconds the last call took
+        :returns: number of rows to send in the next call
+        """
+        if elapsed < self.node_timeout / 8.0:
+            return min(per_diff * 2, self.max_per_diff)
+        if elapsed > self.node_timeout / 4.0:
+            return max(per_diff // 2, self.per_diff)
+        return per_diff
+
     def _usync_db(self, point, broker, http, remote_id, local_id):
         """
         Sync a db by sending all records since the last sync.
 
+        Each batch of records is read from the DB while the remote server
+        merges the one before it, and the batches grow or shrink with how
+        quickly it does so (see :func:`_next_per_diff`).
+
         :param point: synchronization high water mark between the replicas
         :param broker: database broker object
         :param http: ReplConnection object for the remote server
@@ -234,24 +480,35 @@ class Replicator(Daemon):
         self.logger.increment('diffs')
         self.logger.debug(_('Syncing chunks with %s'), http.host)
         sync_table = broker.get_syncs()
-        objects = broker.get_items_since(point, self.per_diff)
+        per_diff = self.per_diff
+        objects = broker.get_items_since(point, per_diff)
         diffs = 0
+        rows = 0
         while len(objects) and diffs < self.max_diffs:
             diffs += 1
+            start = time.time()
+            response = None
             with Timeout(self.node_timeout):
-                response = http.replicate('merge_items', objects, local_id)
+                sent = http.send_replicate('merge_items', objects, local_id)
+            if sent:
+                next_objects = broker.get_items_since(objects[-1]['ROWID'],
+                                                      per_diff)
+                with Timeout(self.node_timeout):
+                    response = http.get_replicate_response()
             if not response or response.status >= 300 or response.status < 200:
                 if response:
                     self.logger.error(_('ERROR Bad response %(status)s from '
                         '%(host)s'),
                         {'status': response.status, 'host': http.host})
                 return False
+            per_diff = self._next_per_diff(per_diff, time.time() - start)
+            rows += len(objects)
             point = objects[-1]['ROWID']
-            objects = broker.get_items_since(point, self.per_diff)
+            objects = next_objects
         if objects:
             self.logger.debug(_('Synchronization for %s has fallen more than '
                 '%s rows behind; moving on and will try again next pass.') %
-                (broker.db_file, self.max_diffs * self.per_diff))
+                (broker.db_file, rows))
             self.stats['diff_capped'] += 1
             self.logger.increment('diff_caps')
         else:
@@ -332,6 +589,7 @@ class Replicator(Daemon):
             raise DriveNotMounted()
         elif response.status >= 200 and response.status < 300:
             rinfo = simplejson.loads(response.data)
+            http.encodings = rinfo.get('encodings', ())
             local_sync = broker.get_sync(rinfo['id'], incoming=False)
             if self._in_sync(rinfo, info, broker, local_sync):
                 return True
@@ -360,12 +618,37 @@ class Replicator(Daemon):
         self.logger.debug(_('Replicating db %s'), object_file)
         self.stats['attempted'] += 1
         self.logger.increment('attempts')
+        nodes = self.ring.get_part_nodes(int(partition))
+        shouldbehere = bool([n for n in nodes if n['id'] == node_id])
+        # See Footnote [1] for an explanation of the repl_nodes assignment.
+        i = 0
+        while i < len(nodes) and nodes[i]['id'] != node_id:
+            i += 1
+        repl_nodes = nodes[i + 1:] + nodes[:i]
+        if self.unchanged_recheck_interval and shouldbehere and \
+                self._unchanged(partition, object_file, repl_nodes):
+            self.stats['unchanged'] += 1
+            self.logger.increment('unchanged')
+            self.stats['success'] += len(repl_nodes)
+            self.logger.update_stats('successes', len(repl_nodes))
+            self.logger.timing_since('timing', start_time)
+            return
         try:
             broker = self.brokerclass(object_file, pending_timeout=30)
-            broker.reclaim(time.time() - self.reclaim_age,
-                           time.time() - (self.reclaim_age * 2))
+            self._maintain_db(broker)
+            # deleted rows are reclaimed a batch at a time; whatever is left
+            # when the time budget runs out waits for the next pass
+            if not broker.reclaim(time.time() - self.reclaim_age,
+                                  time.time() - (self.reclaim_age * 2),
+                                  self.reclaim_batch_size or None,
+                                  self.reclaim_time_budget or None):
+                self.stats['reclaim_deferred'] += 1
+                self.logger.increment('reclaim_deferred')
             info = broker.get_replication_info()
             full_info = broker.get_info()
+            # taken once the db is up to date locally, so any write from
+            # here on makes the next pass replicate it again
+            db_stat = self._db_stat(object_file)
         except (Exception, Timeout), e:
             if 'no such table' in str(e):
                 self.logger.error(_('Quarantining DB %s'), object_file)
@@ -395,13 +678,6 @@ class Replicator(Daemon):
             self.logger.timing_since('timing', start_time)
             return
         responses = []
-        nodes = self.ring.get_part_nodes(int(partition))
-        shouldbehere = bool([n for n in nodes if n['id'] == node_id])
-        # See Footnote [1] for an explanation of the repl_nodes assignment.
-        i = 0
-        while i < len(nodes) and nodes[i]['id'] != node_id:
-            i += 1
-        repl_nodes = nodes[i + 1:] + nodes[:i]
         more_nodes = self.ring.get_more_nodes(int(partition))
         for node in repl_nodes:
             success = False
@@ -420,11 +696,207 @@ class Replicator(Daemon):
             # If the db shouldn't be on this node and has been successfully
             # synced to all of its peers, it can be removed.
             self.delete_db(object_file)
+        elif self.unchanged_recheck_interval and shouldbehere and \
+                all(responses) and delete_timestamp <= put_timestamp:
+            self._set_replicated(object_file, {
+                'stat': db_stat, 'time': time.time(),
+                'nodes': sorted(node['id'] for node in repl_nodes),
+                'info': dict((key, info[key])
+                             for key in REPLICATED_INFO_KEYS)})
         self.logger.timing_since('timing', start_time)
 
+    def _maintain_db(self, broker):
+        """
+        Hook for the upkeep a server type's DBs need before they are
+        replicated, such as building tables that would otherwise have to be
+        built on behalf of a request. Implementations log their own errors
+        rather than failing the replication of the DB.
+
+        This builds the index reclaims find deleted rows along on older DBs
+        that lack it. Each build holds the DB's write lock until it is done,
+        so once reclaim_index_time_budget seconds have gone on builds in a
+        pass, the rest wait for the next one.
+
+        :param broker: the DB's broker
+        """
+        if self._reclaim_index_time >= self.reclaim_index_time_budget:
+            return
+        start = time.time()
+        try:
+            if broker.build_reclaim_index():
+                self.logger.increment('reclaim_index_built')
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR building reclaim index for %s'),
+                                  broker.db_file)
+        self._reclaim_index_time += time.time() - start
+
+    def _db_stat(self, object_file):
+        """
+        Stat a db along with its .pending and -wal files; any write to the db
+        changes the result.
+
+        :param object_file: DB file name
+        :returns: tuple of (inode, size, mtime) per file, or None for files
+                  that do not exist
+        """
+        stat = []
+        for path in (object_file, object_file + '.pending',
+                     object_file + '-wal'):
+            try:
+                st = os.stat(path)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                stat.append(None)
+            else:
+                stat.append((st.st_ino, st.st_size, st.st_mtime))
+        return tuple(stat)
+
+    def _load_replicated(self, part_dir):
+        """
+        Load the REPLICATED_FILE index of a partition.
+
+        :param part_dir: the partition's directory
+        :returns: dictionary of db hash to what was recorded for it by
+                  :func:`_set_replicated`
+        """
+        try:
+            with open(os.path.join(part_dir, REPLICATED_FILE), 'rb') as fp:
+                return pickle.load(fp)
+        except Exception:
+            return {}
+
+    def _write_replicated(self, part_dir, replicated):
+        """
+        Write out the REPLICATED_FILE index of a partition.
+
+        :param part_dir: the partition's directory
+        :param replicated: dictionary of db hash to entry
+        """
+        try:
+            write_pickle(replicated, os.path.join(part_dir, REPLICATED_FILE),
+                         part_dir, pickle.HIGHEST_PROTOCOL)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR updating %s'),
+                                  os.path.join(part_dir, REPLICATED_FILE))
+
+    def _hold_replicated(self, part_dir):
+        """
+        Keep the REPLICATED_FILE index of a partition in memory until each
+        hold on it is released, so that it is loaded once and written once
+        however many of the partition's dbs are replicated in between.
+
+        :param part_dir: the partition's directory
+        """
+        held = self._replicated.setdefault(
+            part_dir, {'holds': 0, 'replicated': None, 'dirty': False})
+        held['holds'] += 1
+
+    def _release_replicated(self, part_dir):
+        """
+        Release a hold taken by :func:`_hold_replicated`, writing the index
+        out if it changed once the last hold is gone.
+
+        :param part_dir: the partition's directory
+        """
+        held = self._replicated[part_dir]
+        held['holds'] -= 1
+        if held['holds'] > 0:
+            return
+        del self._replicated[part_dir]
+        if held['dirty']:
+            self._write_replicated(part_dir, held['replicated'])
+
+    def _get_replicated(self, object_file):
+        """
+        Get the REPLICATED_FILE index of the partition a db is in; while the
+        partition is held it is only loaded once.
+
+        :param object_file: DB file name
+        :returns: dictionary of db hash to what was recorded for it by
+                  :func:`_set_replicated`
+        """
+        part_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+            object_file)))
+        held = self._replicated.get(part_dir)
+        if not held:
+            return self._load_replicated(part_dir)
+        if held['replicated'] is None:
+            held['replicated'] = self._load_replicated(part_dir)
+        return held['replicated']
+
+    def _set_replicated(self, object_file, entry):
+        """
+        Record a db as in sync with its peers in the REPLICATED_FILE index of
+        its partition, or drop it from the index. While the partition is held
+        this only changes the index in memory.
+
+        :param object_file: DB file name
+        :param entry: dictionary of {'stat', 'time', 'nodes', 'info'}, or None
+                      to drop the db
+        """
+        part_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+            object_file)))
+        hash_ = os.path.basename(os.path.dirname(object_file))
+        replicated = self._get_replicated(object_file)
+        if entry is not None:
+            replicated[hash_] = entry
+        elif replicated.pop(hash_, None) is None:
+            return
+        if part_dir in self._replicated:
+            self._replicated[part_dir]['dirty'] = True
+        else:
+            self._write_replicated(part_dir, replicated)
+
+    def _unchanged(self, partition, object_file, repl_nodes):
+        """
+        Check whether a db is still in sync with its peers without opening
+        it: it has to be unchanged since it was last recorded as replicated
+        to the same nodes, and each of them has to agree with a sync RPC.
+        Dbs are replicated in full at least every unchanged_recheck_interval
+        seconds regardless, so that their deleted rows are reclaimed.
+
+        :param partition: partition the db is in
+        :param object_file: DB file name
+        :param repl_nodes: the nodes the db is replicated to
+
+        :returns: True if there is nothing to replicate, False otherwise
+        """
+        entry = self._get_replicated(object_file).get(
+            os.path.basename(os.path.dirname(object_file)))
+        try:
+            if not entry or \
+                    entry['time'] < time.time() - \
+                    self.unchanged_recheck_interval or \
+                    entry['nodes'] != sorted(n['id'] for n in repl_nodes) or \
+                    entry['stat'] != self._db_stat(object_file):
+                return False
+        except OSError:
+            return False
+        info = entry['info']
+        for node in repl_nodes:
+            try:
+                with ConnectionTimeout(self.conn_timeout):
+                    http = self._http_connect(node, partition, object_file)
+                if not http:
+                    return False
+                with Timeout(self.node_timeout):
+                    response = http.replicate('sync', info['max_row'],
+                        info['hash'], info['id'], info['created_at'],
+                        info['put_timestamp'], info['delete_timestamp'], '')
+                if not response or \
+                        not 200 <= response.status < 300 or \
+                        simplejson.loads(response.data)['point'] < \
+                        info['max_row']:
+                    return False
+            except (Exception, Timeout):
+                return False
+        return True
+
     def delete_db(self, object_file):
         with lock_parent_directory(object_file):
             shutil.rmtree(os.path.dirname(object_file), True)
+        self._set_replicated(object_file, None)
         self.stats['remove'] += 1
         device_name = self.extract_device(object_file)
         self.logger.increment('removes.' + device_name)
@@ -472,6 +944,7 @@ class Replicator(Daemon):
     def run_once(self, *args, **kwargs):
         """Run a replication pass once."""
         self._zero_stats()
+        self._reclaim_index_time = 0
         dirs = []
         ips = whataremyips()
         if not ips:
@@ -491,13 +964,104 @@ class Replicator(Daemon):
                 if os.path.isdir(datadir):
                     dirs.append((datadir, node['id']))
         self.logger.info(_('Beginning replication run'))
-        for part, object_file, node_id in self.roundrobin_datadirs(dirs):
-            self.cpool.spawn_n(
-                self._replicate_object, part, object_file, node_id)
-        self.cpool.waitall()
+        if self.device_concurrency > 1 and len(dirs) > 1:
+            self._replicate_devices(dirs)
+        else:
+            self._replicate_dirs(dirs)
         self.logger.info(_('Replication run OVER'))
         self._report_stats()
 
+    def _replicate_dirs(self, dirs):
+        """
+        Replicate the dbs in the given data dirs, concurrency at a time.
+
+        :param dirs: list of (datadir, node_id) tuples
+        """
+        # each datadir's partitions are walked one after the other; the walk
+        # holds the replicated index of the partition it is in, and each db
+        # holds it while it is being replicated
+        walking = {}
+        for part, object_file, node_id in self.roundrobin_datadirs(dirs):
+            part_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+                object_file)))
+            if walking.get(node_id) != part_dir:
+                self._hold_replicated(part_dir)
+                if node_id in walking:
+                    self._release_replicated(walking[node_id])
+                walking[node_id] = part_dir
+            self._hold_replicated(part_dir)
+            self.cpool.spawn_n(self._replicate_object_held, part_dir, part,
+                               object_file, node_id)
+        for part_dir in walking.values():
+            self._release_replicated(part_dir)
+        self.cpool.waitall()
+
+    def _replicate_object_held(self, part_dir, *args):
+        """
+        Replicate a db as :func:`_replicate_object` does, then release its
+        hold on its partition's replicated index.
+
+        :param part_dir: the partition's directory
+        """
+        try:
+            self._replicate_object(*args)
+        finally:
+            self._release_replicated(part_dir)
+
+    def _replicate_devices(self, dirs):
+        """
+        Replicate each device's dbs in a child process of its own, so that
+        devices do not wait on each other's disk and SQLite work, with up to
+        device_concurrency children at a time. The children's stats are added
+        to this process's.
+
+        :param dirs: list of (datadir, node_id) tuples
+        """
+        pid2filename = {}
+        for datadir in dirs:
+            while len(pid2filename) >= self.device_concurrency:
+                self._load_device_stats(pid2filename.pop(os.wait()[0], None))
+            fd, tmpfilename = mkstemp()
+            os.close(fd)
+            pid = os.fork()
+            if pid:
+                pid2filename[pid] = tmpfilename
+                continue
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self._zero_stats()
+                self._replicate_dirs([datadir])
+                with open(tmpfilename, 'w') as fp:
+                    simplejson.dump(self.stats, fp)
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR replicating %s'), datadir[0])
+            finally:
+                os._exit(0)
+        while pid2filename:
+            self._load_device_stats(pid2filename.pop(os.wait()[0], None))
+
+    def _load_device_stats(self, filename):
+        """
+        Add the stats a device's child process left in a file to this
+        process's, and remove the file.
+
+        :param filename: the file, or None for nothing to load
+        """
+        if not filename:
+            return
+        try:
+            with open(filename, 'r') as fp:
+                stats = fp.read()
+            if stats:
+                for key, value in simplejson.loads(stats).iteritems():
+                    if key != 'start':
+                        self.stats[key] = self.stats.get(key, 0) + value
+        except Exception:
+            self.logger.exception(
+                _('ERROR loading replication stats from %s'), filename)
+        finally:
+            os.unlink(filename)
+
     def run_forever(self, *args, **kwargs):
         """
         Replicate dbs under the given root in an infinite loop.
@@ -595,6 +1159,7 @@ class ReplicatorRpc(object):
             if timespan > DEBUG_TIMINGS_THRESHOLD:
                 self.logger.debug(_('replicator-rpc-sync time for '
                     'merge_syncs: %.02fs') % timespan)
+        info['encodings'] = ['deflate', 'rows']
         return Response(simplejson.dumps(info))
 
     def merge_syncs(self, broker, args):
@@ -25,9 +25,9 @@ from urllib import quote as _quote
 
 from eventlet import sleep, Timeout
 
-from swift.common.bufferedhttp import http_connect
+from swift.common.bufferedhttp import http_connect, http_connect_raw
 from swiftclient import ClientException, json_loads
-from swift.common.utils import normalize_timestamp
+from swift.common.utils import json, normalize_timestamp
 from swift.common.http import HTTP_NO_CONTENT, HTTP_INSUFFICIENT_STORAGE, \
     is_success, is_server_error
 
@@ -407,6 +407,42 @@ def direct_delete_object(node, part, account, container, obj,
                 http_reason=resp.reason)
 
 
+def direct_bulk_delete_objects(node, objects, conn_timeout=5,
+                               response_timeout=15, headers={}):
+    """
+    Delete several objects on a device directly from the object server.
+
+    :param node: node dictionary from the ring
+    :param objects: list of dictionaries of {'partition', 'account',
+                    'container', 'obj', 'container_host',
+                    'container_partition', 'container_device'}
+    :param conn_timeout: timeout in seconds for establishing the connection
+    :param response_timeout: timeout in seconds for getting the response
+    :returns: list of the DELETE status of each of the objects
+    """
+    body = json.dumps(objects)
+    headers = dict(headers)
+    headers['X-Timestamp'] = normalize_timestamp(time())
+    headers['Content-Length'] = str(len(body))
+    headers['Content-Type'] = 'application/json'
+    path = '/' + node['device']
+    with Timeout(conn_timeout):
+        conn = http_connect_raw(node['ip'], node['port'], 'BULK_DELETE',
+                                quote(path), headers)
+    with Timeout(response_timeout):
+        conn.send(body)
+        resp = conn.getresponse()
+        resp_body = resp.read()
+    if not is_success(resp.status):
+        raise ClientException(
+                'Object server %s:%s direct BULK_DELETE %s gave status %s' %
+                (node['ip'], node['port'], repr(path), resp.status),
+                http_host=node['ip'], http_port=node['port'],
+                http_device=node['device'], http_status=resp.status,
+                http_reason=resp.reason)
+    return json_loads(resp_body)
+
+
 def retry(func, *args, **kwargs):
     """
     Helper function to retry a given function a number of times.
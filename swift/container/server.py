@@ -15,33 +15,82 @@
 
 from __future__ import with_statement
 
+import errno
 import os
 import time
 import traceback
 from urllib import unquote
 from xml.sax import saxutils
 from datetime import datetime
+from itertools import chain, islice
 
-from eventlet import Timeout
+from eventlet import sleep, Timeout
+from eventlet.event import Event
 from webob import Request, Response
 from webob.exc import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
     HTTPCreated, HTTPInternalServerError, HTTPNoContent, \
-    HTTPNotFound, HTTPPreconditionFailed, HTTPMethodNotAllowed
+    HTTPNotFound, HTTPPreconditionFailed, HTTPMethodNotAllowed, \
+    HTTPServiceUnavailable
 
 import swift.common.db
 from swift.common.db import ContainerBroker
 from swift.common.utils import get_logger, get_param, hash_path, public, \
     normalize_timestamp, storage_directory, split_path, validate_sync_to, \
-    TRUE_VALUES, validate_device_partition, json
+    TRUE_VALUES, validate_device_partition, json, mkdirs
 from swift.common.constraints import CONTAINER_LISTING_LIMIT, \
     check_mount, check_float, check_utf8, FORMAT2CONTENT_TYPE
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
-from swift.common.db_replicator import ReplicatorRpc
+from swift.common.db_replicator import ReplicatorRpc, \
+    load_replicate_args
 from swift.common.http import HTTP_NOT_FOUND, is_success, \
     HTTPInsufficientStorage
 
 DATADIR = 'containers'
+# Directory on each device of the containers whose stats may have changed
+# since they were last reported to their account; see mark_dirty
+DIRTYDIR = 'containers_dirty'
+
+
+def mark_dirty(db_file):
+    """
+    Records that a container DB's stats may have changed since they were last
+    reported to its account, so the container updater gets to it without
+    waiting for a full sweep. The record is an empty file named after the
+    DB's hash, in a directory named after its partition under DIRTYDIR on the
+    DB's device.
+
+    :param db_file: path to the container DB
+    """
+    hash_dir = os.path.dirname(db_file)
+    part_dir = os.path.dirname(os.path.dirname(hash_dir))
+    dirty_dir = os.path.join(os.path.dirname(os.path.dirname(part_dir)),
+                             DIRTYDIR, os.path.basename(part_dir))
+    dirty_file = os.path.join(dirty_dir, os.path.basename(hash_dir))
+    for attempt in xrange(3):
+        try:
+            fd = os.open(dirty_file, os.O_WRONLY | os.O_CREAT, 0644)
+            break
+        except OSError, err:
+            if err.errno != errno.ENOENT or attempt == 2:
+                raise
+            # the updater removes the directory once it has emptied it
+            mkdirs(dirty_dir)
+    os.close(fd)
+
+
+def format_last_modified(created_at):
+    """
+    Formats an object row's created_at timestamp for listings.
+
+    :param created_at: created_at timestamp of the row
+    :returns: ISO 8601 string, always with microseconds
+    """
+    created_at = datetime.utcfromtimestamp(float(created_at)).isoformat()
+    # python isoformat() doesn't include msecs when zero
+    if len(created_at) < len("1970-01-01T00:00:00.000000"):
+        created_at += ".000000"
+    return created_at
 
 
 class ContainerController(object):
@@ -69,6 +118,145 @@ class ContainerController(object):
             self.save_headers.append('x-versions-location')
         swift.common.db.DB_PREALLOCATION = \
             conf.get('db_preallocation', 'f').lower() in TRUE_VALUES
+        swift.common.db.configure_db_connections(conf)
+        self.group_commit_window = float(conf.get('group_commit_window', 0))
+        self.group_commit_timeout = \
+            float(conf.get('group_commit_timeout', 15))
+        self.commit_groups = {}
+        self.pending_read_flush_size = \
+            int(conf.get('pending_read_flush_size', 4096))
+        self.listing_page_size = int(conf.get('listing_page_size', 1000))
+
+    def _put_object(self, broker, name, timestamp, size, content_type, etag,
+                    deleted=0):
+        """
+        Creates an object row in the container's DB, grouping it with the
+        rows of any concurrent requests for the same DB so they are written
+        with a single broker.put_objects call. The first request to arrive
+        writes the group, after waiting group_commit_window seconds (or just
+        yielding, when that is 0) to let the others join it; they wait up to
+        group_commit_timeout seconds for its outcome and raise its error, if
+        any.
+
+        :param broker: ContainerBroker of the container
+        :param name: object name
+        :param timestamp: timestamp of the object row
+        :param size: object size
+        :param content_type: object content-type
+        :param etag: object etag
+        :param deleted: 1 if the row marks the object deleted
+        :returns: False if the request gave up waiting on its group's write,
+                  True otherwise
+        """
+        record = {'name': name, 'created_at': timestamp, 'size': size,
+                  'content_type': content_type, 'etag': etag,
+                  'deleted': deleted}
+        group = self.commit_groups.get(broker.db_file)
+        if group is not None:
+            group[0].append(record)
+            self.logger.increment('group_commit.joined')
+            outcome = []
+            with Timeout(self.group_commit_timeout, False):
+                outcome.append(group[1].wait())
+            if not outcome:
+                self.logger.increment('group_commit.timeouts')
+                return False
+            if outcome[0]:
+                raise outcome[0]
+            return True
+        group = self.commit_groups[broker.db_file] = ([record], Event())
+        try:
+            sleep(self.group_commit_window)
+        finally:
+            del self.commit_groups[broker.db_file]
+        err = None
+        try:
+            try:
+                broker.put_objects(group[0])
+            except (Exception, Timeout), err:
+                raise
+        finally:
+            group[1].send(err)
+        self._mark_dirty(broker.db_file)
+        return True
+
+    def _mark_dirty(self, db_file):
+        """
+        Marks a container DB for the container updater with
+        :func:`mark_dirty`. Failing to is logged rather than failing the
+        request; the updater's full sweeps get to the DB regardless.
+
+        :param db_file: path to the container DB
+        """
+        try:
+            mark_dirty(db_file)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR marking %s dirty'), db_file)
+
+    def _listing_pages(self, broker, limit, marker, end_marker, prefix,
+                       delimiter, path):
+        """
+        Yields the rows of a container listing a page of up to
+        listing_page_size rows at a time. Each page is read with its own
+        query, starting after the last row of the page before as a client
+        paging through the listing with marker would, so no query is left
+        open on the DB while the response is being sent.
+
+        :returns: generator of lists of rows from list_objects_iter
+        """
+        while limit > 0:
+            page_size = min(limit, self.listing_page_size)
+            rows = broker.list_objects_iter(page_size, marker, end_marker,
+                                            prefix, delimiter, path)
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                break
+            limit -= len(rows)
+            marker = rows[-1][0]
+
+    def _json_listing(self, pages):
+        """Yields a JSON container listing a page at a time."""
+        separator = '['
+        for rows in pages:
+            data = []
+            for (name, created_at, size, content_type, etag) in rows:
+                if content_type is None:
+                    data.append({"subdir": name})
+                else:
+                    data.append({
+                        'last_modified': format_last_modified(created_at),
+                        'bytes': size, 'content_type': content_type,
+                        'hash': etag, 'name': name})
+            yield separator + json.dumps(data)[1:-1]
+            separator = ', '
+        yield separator == '[' and '[]' or ']'
+
+    def _xml_listing(self, pages, container):
+        """Yields an XML container listing a page at a time."""
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<container name=%s>' % saxutils.quoteattr(container)
+        for rows in pages:
+            xml_output = []
+            for (name, created_at, size, content_type, etag) in rows:
+                name = saxutils.escape(name)
+                if content_type is None:
+                    xml_output.append('<subdir name="%s"><name>%s</name>'
+                                      '</subdir>' % (name, name))
+                else:
+                    content_type = saxutils.escape(content_type)
+                    xml_output.append('<object><name>%s</name><hash>%s</hash>'\
+                           '<bytes>%d</bytes><content_type>%s</content_type>'\
+                           '<last_modified>%s</last_modified></object>' % \
+                           (name, etag, size, content_type,
+                            format_last_modified(created_at)))
+            yield ''.join(xml_output)
+        yield '</container>'
+
+    def _plain_listing(self, pages):
+        """Yields a plain text container listing a page at a time."""
+        for rows in pages:
+            yield ''.join(r[0] + '\n' for r in rows)
 
     def _get_container_broker(self, drive, part, account, container):
         """
@@ -166,7 +354,11 @@ class ContainerController(object):
             self.logger.timing_since('DELETE.timing', start_time)
             return HTTPNotFound()
         if obj:     # delete object
-            broker.delete_object(obj, req.headers.get('x-timestamp'))
+            if not self._put_object(broker, obj,
+                    req.headers.get('x-timestamp'), 0, 'application/deleted',
+                    'noetag', 1):
+                self.logger.increment('DELETE.errors')
+                return HTTPServiceUnavailable(request=req)
             self.logger.timing_since('DELETE.timing', start_time)
             return HTTPNoContent(request=req)
         else:
@@ -180,6 +372,7 @@ class ContainerController(object):
             if not broker.is_deleted():
                 self.logger.increment('DELETE.errors')
                 return HTTPConflict(request=req)
+            self._mark_dirty(broker.db_file)
             resp = self.account_update(req, account, container, broker)
             self.logger.timing_since('DELETE.timing', start_time)
             if resp:
@@ -223,8 +416,11 @@ class ContainerController(object):
             if not os.path.exists(broker.db_file):
                 self.logger.timing_since('PUT.timing', start_time)
                 return HTTPNotFound()
-            broker.put_object(obj, timestamp, int(req.headers['x-size']),
-                req.headers['x-content-type'], req.headers['x-etag'])
+            if not self._put_object(broker, obj, timestamp,
+                    int(req.headers['x-size']), req.headers['x-content-type'],
+                    req.headers['x-etag']):
+                self.logger.increment('PUT.errors')
+                return HTTPServiceUnavailable(request=req)
             self.logger.timing_since('PUT.timing', start_time)
             return HTTPCreated(request=req)
         else:   # put container
@@ -249,6 +445,7 @@ class ContainerController(object):
                             broker.metadata['X-Container-Sync-To'][0]:
                         broker.set_x_container_sync_points(-1, -1)
                 broker.update_metadata(metadata)
+            self._mark_dirty(broker.db_file)
             resp = self.account_update(req, account, container, broker)
             self.logger.timing_since('PUT.timing', start_time)
             if resp:
@@ -276,6 +473,7 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container)
         broker.pending_timeout = 0.1
         broker.stale_reads_ok = True
+        broker.pending_read_flush_size = self.pending_read_flush_size
         if broker.is_deleted():
             self.logger.timing_since('HEAD.timing', start_time)
             return HTTPNotFound(request=req)
@@ -311,6 +509,7 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container)
         broker.pending_timeout = 0.1
         broker.stale_reads_ok = True
+        broker.pending_read_flush_size = self.pending_read_flush_size
         if broker.is_deleted():
             self.logger.timing_since('GET.timing', start_time)
             return HTTPNotFound(request=req)
@@ -358,52 +557,30 @@ class ContainerController(object):
             self.logger.increment('GET.errors')
             return HTTPBadRequest(body='bad accept header: %s' % req.accept,
                                   content_type='text/plain', request=req)
-        container_list = broker.list_objects_iter(limit, marker, end_marker,
-                                                  prefix, delimiter, path)
+        pages = self._listing_pages(broker, limit, marker, end_marker,
+                                    prefix, delimiter, path)
+        # a listing of one page is sent whole, with a Content-Length, and a
+        # longer one is streamed as its pages are read
+        first_pages = list(islice(pages, 2))
+        if len(first_pages) > 1:
+            pages = chain(first_pages, pages)
+        else:
+            pages = first_pages
         if out_content_type == 'application/json':
-            data = []
-            for (name, created_at, size, content_type, etag) in container_list:
-                if content_type is None:
-                    data.append({"subdir": name})
-                else:
-                    created_at = datetime.utcfromtimestamp(
-                        float(created_at)).isoformat()
-                    # python isoformat() doesn't include msecs when zero
-                    if len(created_at) < len("1970-01-01T00:00:00.000000"):
-                        created_at += ".000000"
-                    data.append({'last_modified': created_at, 'bytes': size,
-                                'content_type': content_type, 'hash': etag,
-                                'name': name})
-            container_list = json.dumps(data)
+            container_list = self._json_listing(pages)
         elif out_content_type.endswith('/xml'):
-            xml_output = []
-            for (name, created_at, size, content_type, etag) in container_list:
-                # escape name and format date here
-                name = saxutils.escape(name)
-                created_at = datetime.utcfromtimestamp(
-                    float(created_at)).isoformat()
-                # python isoformat() doesn't include msecs when zero
-                if len(created_at) < len("1970-01-01T00:00:00.000000"):
-                    created_at += ".000000"
-                if content_type is None:
-                    xml_output.append('<subdir name="%s"><name>%s</name>'
-                                      '</subdir>' % (name, name))
-                else:
-                    content_type = saxutils.escape(content_type)
-                    xml_output.append('<object><name>%s</name><hash>%s</hash>'\
-                           '<bytes>%d</bytes><content_type>%s</content_type>'\
-                           '<last_modified>%s</last_modified></object>' % \
-                           (name, etag, size, content_type, created_at))
-            container_list = ''.join([
-                '<?xml version="1.0" encoding="UTF-8"?>\n',
-                '<container name=%s>' % saxutils.quoteattr(container),
-                ''.join(xml_output), '</container>'])
+            container_list = self._xml_listing(pages, container)
         else:
-            if not container_list:
+            if not first_pages:
                 self.logger.timing_since('GET.timing', start_time)
                 return HTTPNoContent(request=req, headers=resp_headers)
-            container_list = '\n'.join(r[0] for r in container_list) + '\n'
-        ret = Response(body=container_list, request=req, headers=resp_headers)
+            container_list = self._plain_listing(pages)
+        if len(first_pages) > 1:
+            ret = Response(app_iter=container_list, request=req,
+                           headers=resp_headers)
+        else:
+            ret = Response(body=''.join(container_list), request=req,
+                           headers=resp_headers)
         ret.content_type = out_content_type
         ret.charset = 'utf-8'
         self.logger.timing_since('GET.timing', start_time)
@@ -427,12 +604,18 @@ class ContainerController(object):
             self.logger.increment('REPLICATE.errors')
             return HTTPInsufficientStorage(drive=drive, request=req)
         try:
-            args = json.load(req.environ['wsgi.input'])
+            args = load_replicate_args(req)
         except ValueError, err:
             self.logger.increment('REPLICATE.errors')
             return HTTPBadRequest(body=str(err), content_type='text/plain')
+        op = isinstance(args, list) and args and args[0]
         ret = self.replicator_rpc.dispatch(post_args, args)
         ret.request = req
+        if op in ('merge_items', 'complete_rsync', 'rsync_then_merge') and \
+                is_success(ret.status_int):
+            # rows from other replicas can change the container's stats
+            self._mark_dirty(os.path.join(self.root, drive, storage_directory(
+                DATADIR, partition, hash), hash + '.db'))
         self.logger.timing_since('REPLICATE.timing', start_time)
         return ret
 
@@ -13,17 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
 from time import ctime, time
 from random import random, shuffle
 from struct import unpack_from
 
-from eventlet import sleep, Timeout
+from eventlet import GreenPool, patcher, sleep, Timeout
 
 import swift.common.db
 from swift.container import server as container_server
-from swiftclient import ClientException, delete_object, put_object, \
-    quote
-from swift.common.direct_client import direct_get_object
+from swiftclient import ClientException, delete_object, \
+    http_connection, put_object, quote
+from swift.common.direct_client import direct_get_object, \
+    direct_head_object
 from swift.common.ring import Ring
 from swift.common.db import ContainerBroker
 from swift.common.utils import audit_location_generator, get_logger, \
@@ -35,7 +37,8 @@ from swift.common.http import HTTP_UNAUTHORIZED, HTTP_NOT_FOUND
 class _Iter2FileLikeObject(object):
     """
     Returns an iterator's contents via :func:`read`, making it look like a file
-    object.
+    object. The iterator's chunks are handed on as they are, without being
+    joined or copied, unless a read asks for less than a whole chunk.
     """
 
     def __init__(self, iterator):
@@ -56,12 +59,11 @@ class _Iter2FileLikeObject(object):
             return chunk + ''.join(self.iterator)
         chunk = self._chunk
         self._chunk = ''
-        if chunk and len(chunk) <= size:
-            return chunk
-        try:
-            chunk += self.iterator.next()
-        except StopIteration:
-            pass
+        if not chunk:
+            try:
+                chunk = self.iterator.next()
+            except StopIteration:
+                return ''
         if len(chunk) <= size:
             return chunk
         self._chunk = chunk[size:]
@@ -158,6 +160,20 @@ class ContainerSync(Daemon):
             for h in conf.get('allowed_sync_hosts', '127.0.0.1').split(',')
             if h.strip()]
         self.proxy = conf.get('sync_proxy')
+        #: Number of rows read from a container database at a time.
+        self.sync_batch_size = int(conf.get('sync_batch_size', 100))
+        #: Number of updates sent to the other container at a time.
+        self.concurrency = int(conf.get('concurrency', 10))
+        #: Size of the chunks objects are relayed to the other container in.
+        self.chunk_size = int(conf.get('chunk_size', 65536))
+        #: Number of large objects whose ETag in the other container is
+        #: remembered, so that a later update of one with the same contents
+        #: can be a server side copy; 0 always sends objects in full.
+        self.remote_etag_cache_size = \
+            int(conf.get('remote_etag_cache_size', 10000))
+        #: (sync_to, object name) -> ETag the other container was last sent,
+        #: least recently used first.
+        self.remote_etags = OrderedDict()
         #: Number of containers with sync turned on that were successfully
         #: synced.
         self.container_syncs = 0
@@ -186,6 +202,7 @@ class ContainerSync(Daemon):
         """
         Runs container sync scans until stopped.
         """
+        patcher.monkey_patch(all=False, socket=True)
         sleep(random() * self.interval)
         while True:
             begin = time()
@@ -205,6 +222,7 @@ class ContainerSync(Daemon):
         """
         Runs a single container sync scan.
         """
+        patcher.monkey_patch(all=False, socket=True)
         self.logger.info(_('Begin container sync "once" mode'))
         begin = time()
         all_locs = audit_location_generator(self.devices,
@@ -286,45 +304,46 @@ class ContainerSync(Daemon):
                     self.logger.increment('failures')
                     return
                 stop_at = time() + self.container_time
+                pool = GreenPool(self.concurrency)
+                conns = []
                 while time() < stop_at and sync_point2 < sync_point1:
-                    rows = broker.get_items_since(sync_point2, 1)
+                    rows = [row for row in broker.get_items_since(
+                                sync_point2, self.sync_batch_size)
+                            if row['ROWID'] < sync_point1]
                     if not rows:
                         break
-                    row = rows[0]
-                    if row['ROWID'] >= sync_point1:
-                        break
-                    key = hash_path(info['account'], info['container'],
-                                    row['name'], raw_digest=True)
                     # This node will only intially sync out one third of the
                     # objects (if 3 replicas, 1/4 if 4, etc.). This section
                     # will attempt to sync previously skipped rows in case the
                     # other nodes didn't succeed.
-                    if unpack_from('>I', key)[0] % \
-                            len(nodes) != ordinal:
-                        if not self.container_sync_row(row, sync_to, sync_key,
-                                                       broker, info):
-                            return
-                    sync_point2 = row['ROWID']
-                    broker.set_x_container_sync_points(None, sync_point2)
+                    synced_to = self.container_sync_rows(
+                        pool, [(row, self._row_ordinal(row, info, nodes) !=
+                                ordinal) for row in rows],
+                        sync_to, sync_key, broker, info, conns)
+                    if synced_to is not None:
+                        sync_point2 = synced_to
+                        broker.set_x_container_sync_points(None, sync_point2)
+                    if synced_to != rows[-1]['ROWID']:
+                        return
                 while time() < stop_at:
-                    rows = broker.get_items_since(sync_point1, 1)
+                    rows = broker.get_items_since(sync_point1,
+                                                  self.sync_batch_size)
                     if not rows:
                         break
-                    row = rows[0]
-                    key = hash_path(info['account'], info['container'],
-                                    row['name'], raw_digest=True)
                     # This node will only intially sync out one third of the
                     # objects (if 3 replicas, 1/4 if 4, etc.). It'll come back
                     # around to the section above and attempt to sync
                     # previously skipped rows in case the other nodes didn't
                     # succeed.
-                    if unpack_from('>I', key)[0] % \
-                            len(nodes) == ordinal:
-                        if not self.container_sync_row(row, sync_to, sync_key,
-                                                       broker, info):
-                            return
-                    sync_point1 = row['ROWID']
-                    broker.set_x_container_sync_points(sync_point1, None)
+                    synced_to = self.container_sync_rows(
+                        pool, [(row, self._row_ordinal(row, info, nodes) ==
+                                ordinal) for row in rows],
+                        sync_to, sync_key, broker, info, conns)
+                    if synced_to is not None:
+                        sync_point1 = synced_to
+                        broker.set_x_container_sync_points(sync_point1, None)
+                    if synced_to != rows[-1]['ROWID']:
+                        return
                 self.container_syncs += 1
                 self.logger.increment('syncs')
         except (Exception, Timeout), err:
@@ -332,7 +351,171 @@ class ContainerSync(Daemon):
             self.logger.increment('failures')
             self.logger.exception(_('ERROR Syncing %s'), (broker.db_file))
 
-    def container_sync_row(self, row, sync_to, sync_key, broker, info):
+    def _row_ordinal(self, row, info, nodes):
+        key = hash_path(info['account'], info['container'], row['name'],
+                        raw_digest=True)
+        return unpack_from('>I', key)[0] % len(nodes)
+
+    def _copyable(self, row, sync_to):
+        """
+        Returns True if the row's object is big enough to be worth a server
+        side copy and this daemon last sent the other container the same
+        contents for it.
+        """
+        return bool(row.get('etag')) and \
+            row.get('size', 0) >= self.chunk_size and \
+            self.remote_etags.get((sync_to, row['name'])) == row['etag']
+
+    def _remember_remote_etag(self, row, sync_to, headers):
+        """
+        Records the ETag of a large object just sent to the other container
+        (see :func:`_copyable`), or forgets the object's if it cannot be
+        copied there.
+        """
+        key = (sync_to, row['name'])
+        self.remote_etags.pop(key, None)
+        if self.remote_etag_cache_size <= 0 or \
+                'etag' not in headers or \
+                'x-static-large-object' in headers or \
+                int(headers.get('content-length', 0)) < self.chunk_size:
+            return
+        self.remote_etags[key] = headers['etag']
+        while len(self.remote_etags) > self.remote_etag_cache_size:
+            self.remote_etags.popitem(last=False)
+
+    def container_sync_copy(self, row, sync_to, headers, http_conn):
+        """
+        Tries to update an object whose contents the other container already
+        has, as after a change of only its metadata, with a server side copy
+        of the object onto itself instead of sending the contents again. The
+        copy is conditional on the other container's object having the same
+        ETag. Static large object manifests are never copied, since the
+        copy would replace the other container's manifest with its
+        segments' contents.
+
+        :param row: The updated row in the local database triggering the sync
+                    update.
+        :param sync_to: The URL to the remote container.
+        :param headers: The headers of the local object, as they are to be
+                        sent.
+        :param http_conn: The connection to send the request on, or None.
+        :returns: True if the other container's object was updated, False if
+                  it must be sent in full.
+        """
+        if 'etag' not in headers or 'x-static-large-object' in headers:
+            return False
+        copy_headers = dict(headers)
+        copy_headers.pop('content-length', None)
+        del copy_headers['etag']
+        copy_headers['if-match'] = headers['etag']
+        copy_headers['x-copy-from'] = '%s/%s' % (
+            sync_to.rsplit('/', 1)[1], quote(row['name']))
+        copy_headers['x-fresh-metadata'] = 'true'
+        try:
+            put_object(sync_to, name=row['name'], headers=copy_headers,
+                       http_conn=http_conn, proxy=self.proxy)
+        except ClientException, err:
+            # Usually 404 or 412 as the other container's object is missing
+            # or has other contents; the response was read in full, so the
+            # connection can still be used to send the object.
+            if not err.http_status:
+                raise
+            return False
+        self.logger.increment('copies')
+        return True
+
+    def _get_local_object(self, row, info, head=False):
+        """
+        GETs (or HEADs) the row's object from the first local replica that
+        has it at least as new as the row; a replica that errors or is out
+        of date is passed over for the next one.
+
+        :param row: The updated row in the local database.
+        :param info: The get_info result from the local container database
+                     broker.
+        :param head: If True, only the object's headers are fetched.
+        :returns: tuple of (headers to send on, body iterator or None)
+        """
+        part, nodes = self.object_ring.get_nodes(
+            info['account'], info['container'], row['name'])
+        shuffle(nodes)
+        exc = None
+        looking_for_timestamp = float(row['created_at'])
+        for node in nodes:
+            try:
+                if head:
+                    headers = direct_head_object(node, part,
+                        info['account'], info['container'], row['name'])
+                    body = None
+                else:
+                    headers, body = direct_get_object(node, part,
+                        info['account'], info['container'], row['name'],
+                        resp_chunk_size=self.chunk_size)
+                if float(headers['x-timestamp']) >= looking_for_timestamp:
+                    break
+                if body is not None and hasattr(body, 'close'):
+                    body.close()
+            except ClientException, err:
+                # If any errors are not 404, make sure we report the
+                # non-404 one. We don't want to mistakenly assume the
+                # object no longer exists just because one says so and
+                # the others errored for some other reason.
+                if not exc or exc.http_status == HTTP_NOT_FOUND:
+                    exc = err
+        else:
+            if exc:
+                raise exc
+            raise Exception(_('Unknown exception trying to GET: '
+                '%(node)r %(account)r %(container)r %(object)r'),
+                {'node': node, 'part': part,
+                 'account': info['account'],
+                 'container': info['container'],
+                 'object': row['name']})
+        for key in ('date', 'last-modified'):
+            if key in headers:
+                del headers[key]
+        if 'etag' in headers:
+            headers['etag'] = headers['etag'].strip('"')
+        return headers, body
+
+    def container_sync_rows(self, pool, rows, sync_to, sync_key, broker,
+                            info, conns):
+        """
+        Sends the updates for a page of rows concurrently, with at most
+        :attr:`concurrency` requests in flight.
+
+        :param pool: The GreenPool to send the updates with.
+        :param rows: A list of (row, send) pairs in ROWID order; the update
+                     for a row is only sent if send is true.
+        :param sync_to: The URL to the remote container.
+        :param sync_key: The X-Container-Sync-Key to use when sending requests
+                         to the other container.
+        :param broker: The local container database broker.
+        :param info: The get_info result from the local container database
+                     broker.
+        :param conns: A list of idle connections to sync_to shared by the
+                      updates; see :func:`container_sync_row`.
+        :returns: The ROWID up to which every row's update was sent, or None
+                  if the first row's update failed.
+        """
+        events = []
+        for row, send in rows:
+            if send:
+                events.append(pool.spawn(self.container_sync_row, row,
+                                         sync_to, sync_key, broker, info,
+                                         conns))
+            else:
+                events.append(None)
+        synced_to = None
+        for (row, send), event in zip(rows, events):
+            if event is not None and not event.wait():
+                break
+            synced_to = row['ROWID']
+        pool.waitall()
+        return synced_to
+
+    def container_sync_row(self, row, sync_to, sync_key, broker, info,
+                           conns=None):
         """
         Sends the update the row indicates to the sync_to container.
 
@@ -344,8 +527,19 @@ class ContainerSync(Daemon):
         :param broker: The local container database broker.
         :param info: The get_info result from the local container database
                      broker.
+        :param conns: A list of idle connections to sync_to; one is taken
+                      (or made) for the update and put back once it is done
+                      with, so the connections are kept alive between
+                      updates. If None, a connection is made just for this
+                      update.
         :returns: True on success
         """
+        http_conn = None
+        if conns is not None:
+            if conns:
+                http_conn = conns.pop()
+            else:
+                http_conn = http_connection(sync_to, proxy=self.proxy)
         try:
             start_time = time()
             if row['deleted']:
@@ -353,7 +547,7 @@ class ContainerSync(Daemon):
                     delete_object(sync_to, name=row['name'],
                         headers={'x-timestamp': row['created_at'],
                                  'x-container-sync-key': sync_key},
-                        proxy=self.proxy)
+                        http_conn=http_conn, proxy=self.proxy)
                 except ClientException, err:
                     if err.http_status != HTTP_NOT_FOUND:
                         raise
@@ -361,53 +555,31 @@ class ContainerSync(Daemon):
                 self.logger.increment('deletes')
                 self.logger.timing_since('deletes.timing', start_time)
             else:
-                part, nodes = self.object_ring.get_nodes(
-                    info['account'], info['container'],
-                    row['name'])
-                shuffle(nodes)
-                exc = None
-                looking_for_timestamp = float(row['created_at'])
-                timestamp = -1
-                headers = body = None
-                for node in nodes:
-                    try:
-                        these_headers, this_body = direct_get_object(node,
-                            part, info['account'], info['container'],
-                            row['name'], resp_chunk_size=65536)
-                        this_timestamp = float(these_headers['x-timestamp'])
-                        if this_timestamp > timestamp:
-                            timestamp = this_timestamp
-                            headers = these_headers
-                            body = this_body
-                    except ClientException, err:
-                        # If any errors are not 404, make sure we report the
-                        # non-404 one. We don't want to mistakenly assume the
-                        # object no longer exists just because one says so and
-                        # the others errored for some other reason.
-                        if not exc or exc.http_status == HTTP_NOT_FOUND:
-                            exc = err
-                if timestamp < looking_for_timestamp:
-                    if exc:
-                        raise exc
-                    raise Exception(_('Unknown exception trying to GET: '
-                        '%(node)r %(account)r %(container)r %(object)r'),
-                        {'node': node, 'part': part,
-                         'account': info['account'],
-                         'container': info['container'],
-                         'object': row['name']})
-                for key in ('date', 'last-modified'):
-                    if key in headers:
-                        del headers[key]
-                if 'etag' in headers:
-                    headers['etag'] = headers['etag'].strip('"')
-                headers['x-timestamp'] = row['created_at']
-                headers['x-container-sync-key'] = sync_key
-                put_object(sync_to, name=row['name'], headers=headers,
-                    contents=_Iter2FileLikeObject(body), proxy=self.proxy)
+                copied = False
+                if self._copyable(row, sync_to):
+                    # only the headers are needed to try a copy, and the
+                    # contents only if it fails
+                    headers = self._get_local_object(row, info, head=True)[0]
+                    headers['x-timestamp'] = row['created_at']
+                    headers['x-container-sync-key'] = sync_key
+                    copied = self.container_sync_copy(row, sync_to, headers,
+                                                      http_conn)
+                if not copied:
+                    headers, body = self._get_local_object(row, info)
+                    headers['x-timestamp'] = row['created_at']
+                    headers['x-container-sync-key'] = sync_key
+                    put_object(sync_to, name=row['name'], headers=headers,
+                        contents=_Iter2FileLikeObject(body),
+                        chunk_size=self.chunk_size, http_conn=http_conn,
+                        proxy=self.proxy)
+                self._remember_remote_etag(row, sync_to, headers)
                 self.container_puts += 1
                 self.logger.increment('puts')
                 self.logger.timing_since('puts.timing', start_time)
         except ClientException, err:
+            # The response was read in full, so the connection can be reused.
+            if http_conn and err.http_status:
+                conns.append(http_conn)
             if err.http_status == HTTP_UNAUTHORIZED:
                 self.logger.info(_('Unauth %(sync_from)r '
                     '=> %(sync_to)r'),
@@ -434,4 +606,6 @@ class ContainerSync(Daemon):
             self.container_failures += 1
             self.logger.increment('failures')
             return False
+        if http_conn:
+            conns.append(http_conn)
         return True
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
 import logging
 import os
 import signal
@@ -24,14 +25,16 @@ from tempfile import mkstemp
 from eventlet import spawn, patcher, Timeout
 
 import swift.common.db
-from swift.container.server import DATADIR
+from swift.container.server import DATADIR, DIRTYDIR, mark_dirty
 from swift.common.bufferedhttp import http_connect
 from swift.common.db import ContainerBroker
 from swift.common.exceptions import ConnectionTimeout
 from swift.common.ring import Ring
-from swift.common.utils import get_logger, TRUE_VALUES, dump_recon_cache
+from swift.common.utils import get_logger, TRUE_VALUES, dump_recon_cache, \
+    json, storage_directory
 from swift.common.daemon import Daemon
-from swift.common.http import is_success, HTTP_INTERNAL_SERVER_ERROR
+from swift.common.http import is_success, HTTP_INTERNAL_SERVER_ERROR, \
+    HTTP_METHOD_NOT_ALLOWED
 
 
 class ContainerUpdater(Daemon):
@@ -50,6 +53,15 @@ class ContainerUpdater(Daemon):
         self.slowdown = float(conf.get('slowdown', 0.01))
         self.node_timeout = int(conf.get('node_timeout', 3))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
+        self.full_sweep_interval = \
+            float(conf.get('full_sweep_interval', 86400))
+        self.account_update_batch_size = \
+            int(conf.get('account_update_batch_size', 100))
+        self.max_pending_reports = \
+            int(conf.get('max_pending_reports', 1000))
+        self.pending_reports = {}
+        self.pending_report_count = 0
+        self.last_full_sweep = 0
         self.no_changes = 0
         self.successes = 0
         self.failures = 0
@@ -69,18 +81,30 @@ class ContainerUpdater(Daemon):
             self.account_ring = Ring(self.swift_dir, ring_name='account')
         return self.account_ring
 
-    def get_paths(self):
+    def get_devices(self):
         """
-        Get paths to all of the partitions on each drive to be processed.
+        Get paths to each of the drives to be processed.
 
         :returns: a list of paths
         """
-        paths = []
+        devices = []
         for device in os.listdir(self.devices):
             dev_path = os.path.join(self.devices, device)
             if self.mount_check and not os.path.ismount(dev_path):
                 self.logger.warn(_('%s is not mounted'), device)
                 continue
+            devices.append(dev_path)
+        shuffle(devices)
+        return devices
+
+    def get_paths(self):
+        """
+        Get paths to all of the partitions on each drive to be processed.
+
+        :returns: a list of paths
+        """
+        paths = []
+        for dev_path in self.get_devices():
             con_path = os.path.join(dev_path, DATADIR)
             if not os.path.exists(con_path):
                 continue
@@ -115,10 +139,14 @@ class ContainerUpdater(Daemon):
                [a for a, u in self.account_suppressions.iteritems() if u < now]
             for account in expired_suppressions:
                 del self.account_suppressions[account]
+            # the containers marked dirty are updated on every sweep; all of
+            # them only every full_sweep_interval seconds
+            full_sweep = begin - self.last_full_sweep >= \
+                self.full_sweep_interval
             pid2filename = {}
             # read from account ring to ensure it's fresh
             self.get_account_ring().get_nodes('')
-            for path in self.get_paths():
+            for path in self.get_devices():
                 while len(pid2filename) >= self.concurrency:
                     pid = os.wait()[0]
                     try:
@@ -138,7 +166,7 @@ class ContainerUpdater(Daemon):
                     self.failures = 0
                     self.new_account_suppressions = open(tmpfilename, 'w')
                     forkbegin = time.time()
-                    self.container_sweep(path)
+                    self.device_sweep(path, full_sweep)
                     elapsed = time.time() - forkbegin
                     self.logger.debug(
                         _('Container update sweep of %(path)s completed: '
@@ -154,6 +182,8 @@ class ContainerUpdater(Daemon):
                     self._load_suppressions(pid2filename[pid])
                 finally:
                     del pid2filename[pid]
+            if full_sweep:
+                self.last_full_sweep = begin
             elapsed = time.time() - begin
             self.logger.info(_('Container update sweep completed: %.02fs'),
                              elapsed)
@@ -172,8 +202,8 @@ class ContainerUpdater(Daemon):
         self.no_changes = 0
         self.successes = 0
         self.failures = 0
-        for path in self.get_paths():
-            self.container_sweep(path)
+        for path in self.get_devices():
+            self.device_sweep(path)
         elapsed = time.time() - begin
         self.logger.info(_('Container update single threaded sweep completed: '
             '%(elapsed).02fs, %(success)s successes, %(fail)s failures, '
@@ -183,6 +213,63 @@ class ContainerUpdater(Daemon):
         dump_recon_cache({'container_updater_sweep': elapsed},
                          self.rcache, self.logger)
 
+    def device_sweep(self, path, full_sweep=True):
+        """
+        Process the containers on a drive marked dirty by the container
+        server, then, for a full sweep, all of them. The queued reports are
+        sent once the dirty containers are done and after each partition of
+        the full sweep, so they don't wait for the rest of the drive.
+
+        :param path: path to the drive
+        :param full_sweep: if False, only the dirty containers are processed
+        """
+        self.dirty_sweep(path)
+        self.flush_reports()
+        con_path = os.path.join(path, DATADIR)
+        if full_sweep and os.path.exists(con_path):
+            partitions = os.listdir(con_path)
+            shuffle(partitions)
+            for partition in partitions:
+                self.container_sweep(os.path.join(con_path, partition))
+                self.flush_reports()
+
+    def dirty_sweep(self, path):
+        """
+        Process the containers on a drive marked dirty by the container
+        server; see :func:`swift.container.server.mark_dirty`. Each mark is
+        removed before its container is processed, so a change made while
+        it is being processed marks it again, and a partition's directory is
+        removed once it is empty.
+
+        :param path: path to the drive
+        """
+        dirty_path = os.path.join(path, DIRTYDIR)
+        if not os.path.isdir(dirty_path):
+            return
+        for partition in os.listdir(dirty_path):
+            try:
+                hashes = os.listdir(os.path.join(dirty_path, partition))
+            except OSError:
+                continue
+            for hsh in hashes:
+                try:
+                    os.unlink(os.path.join(dirty_path, partition, hsh))
+                except OSError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    continue
+                dbfile = os.path.join(path, storage_directory(
+                    DATADIR, partition, hsh), hsh + '.db')
+                if os.path.exists(dbfile):
+                    self.process_container(dbfile)
+                    time.sleep(self.slowdown)
+            try:
+                os.rmdir(os.path.join(dirty_path, partition))
+            except OSError, err:
+                if err.errno not in (errno.ENOENT, errno.ENOTEMPTY,
+                                     errno.EEXIST):
+                    raise
+
     def container_sweep(self, path):
         """
         Walk the path looking for container DBs and process them.
@@ -197,7 +284,10 @@ class ContainerUpdater(Daemon):
 
     def process_container(self, dbfile):
         """
-        Process a container, and update the information in the account.
+        Process a container, and queue an update of the information in the
+        account; see :func:`flush_reports`. The account's reports are sent
+        once account_update_batch_size of them are queued, and all of them
+        once max_pending_reports are.
 
         :param dbfile: container DB to process
         """
@@ -209,50 +299,134 @@ class ContainerUpdater(Daemon):
         if float(info['put_timestamp']) <= 0:
             return
         if self.account_suppressions.get(info['account'], 0) > time.time():
+            # leave it for when the account is no longer suppressed
+            mark_dirty(dbfile)
             return
         if info['put_timestamp'] > info['reported_put_timestamp'] or \
                 info['delete_timestamp'] > info['reported_delete_timestamp'] \
                 or info['object_count'] != info['reported_object_count'] or \
                 info['bytes_used'] != info['reported_bytes_used']:
-            container = '/%s/%s' % (info['account'], info['container'])
-            part, nodes = self.get_account_ring().get_nodes(info['account'])
-            events = [spawn(self.container_report, node, part, container,
-                            info['put_timestamp'], info['delete_timestamp'],
-                            info['object_count'], info['bytes_used'])
-                      for node in nodes]
-            successes = 0
-            failures = 0
-            for event in events:
-                if is_success(event.wait()):
-                    successes += 1
-                else:
-                    failures += 1
-            if successes > failures:
-                self.logger.increment('successes')
-                self.successes += 1
-                self.logger.debug(
-                    _('Update report sent for %(container)s %(dbfile)s'),
-                    {'container': container, 'dbfile': dbfile})
-                broker.reported(info['put_timestamp'],
-                                info['delete_timestamp'], info['object_count'],
-                                info['bytes_used'])
-            else:
-                self.logger.increment('failures')
-                self.failures += 1
-                self.logger.debug(
-                    _('Update report failed for %(container)s %(dbfile)s'),
-                    {'container': container, 'dbfile': dbfile})
-                self.account_suppressions[info['account']] = until = \
-                    time.time() + self.account_suppression_time
-                if self.new_account_suppressions:
-                    print >>self.new_account_suppressions, \
-                        info['account'], until
-            # Only track timing data for attempted updates:
-            self.logger.timing_since('timing', start_time)
+            reports = self.pending_reports.setdefault(info['account'], [])
+            reports.append((dbfile, info, start_time))
+            self.pending_report_count += 1
+            if len(reports) >= self.account_update_batch_size:
+                self.flush_reports(info['account'])
+            elif self.pending_report_count >= self.max_pending_reports:
+                self.flush_reports()
         else:
             self.logger.increment('no_changes')
             self.no_changes += 1
 
+    def flush_reports(self, account=None):
+        """
+        Send the container reports queued by :func:`process_container` to
+        the account servers, one request per account server for each
+        account.
+
+        :param account: account whose reports to send; if None, the reports
+                        for every account are sent
+        """
+        if account is None:
+            accounts = self.pending_reports.keys()
+        else:
+            accounts = [account]
+        for account in accounts:
+            reports = self.pending_reports.pop(account, None)
+            if not reports:
+                continue
+            self.pending_report_count -= len(reports)
+            part, nodes = self.get_account_ring().get_nodes(account)
+            events = [spawn(self.account_report, node, part, account,
+                            [info for dbfile, info, start_time in reports])
+                      for node in nodes]
+            statuses = [event.wait() for event in events]
+            for i, (dbfile, info, start_time) in enumerate(reports):
+                container = '/%s/%s' % (info['account'], info['container'])
+                successes = 0
+                failures = 0
+                for node_statuses in statuses:
+                    if is_success(node_statuses[i]):
+                        successes += 1
+                    else:
+                        failures += 1
+                if successes > failures:
+                    self.logger.increment('successes')
+                    self.successes += 1
+                    self.logger.debug(
+                        _('Update report sent for %(container)s %(dbfile)s'),
+                        {'container': container, 'dbfile': dbfile})
+                    ContainerBroker(dbfile, logger=self.logger).reported(
+                        info['put_timestamp'], info['delete_timestamp'],
+                        info['object_count'], info['bytes_used'])
+                else:
+                    self.logger.increment('failures')
+                    self.failures += 1
+                    self.logger.debug(
+                        _('Update report failed for %(container)s %(dbfile)s'),
+                        {'container': container, 'dbfile': dbfile})
+                    mark_dirty(dbfile)
+                    self.account_suppressions[info['account']] = until = \
+                        time.time() + self.account_suppression_time
+                    if self.new_account_suppressions:
+                        print >>self.new_account_suppressions, \
+                            info['account'], until
+                # Only track timing data for attempted updates:
+                self.logger.timing_since('timing', start_time)
+
+    def account_report(self, node, part, account, infos):
+        """
+        Report the info of several containers in an account to an account
+        server with a single UPDATE request. A lone container, or an account
+        server that does not support UPDATE, is reported with
+        :func:`container_report` instead.
+
+        :param node: node dictionary from the account ring
+        :param part: partition the account is on
+        :param account: account name
+        :param infos: list of container info dicts to report
+        :returns: list of HTTP statuses, one for each of infos
+        """
+        if len(infos) > 1:
+            body = json.dumps([
+                {'name': info['container'],
+                 'put_timestamp': info['put_timestamp'],
+                 'delete_timestamp': info['delete_timestamp'],
+                 'object_count': info['object_count'],
+                 'bytes_used': info['bytes_used']} for info in infos])
+            status = self._account_update(node, part, account, body)
+            if status != HTTP_METHOD_NOT_ALLOWED:
+                return [status] * len(infos)
+        return [self.container_report(
+                    node, part, '/%s/%s' % (account, info['container']),
+                    info['put_timestamp'], info['delete_timestamp'],
+                    info['object_count'], info['bytes_used'])
+                for info in infos]
+
+    def _account_update(self, node, part, account, body):
+        with ConnectionTimeout(self.conn_timeout):
+            try:
+                conn = http_connect(
+                    node['ip'], node['port'], node['device'], part,
+                    'UPDATE', '/' + account,
+                    headers={'Content-Type': 'application/json',
+                             'Content-Length': str(len(body)),
+                             'X-Account-Override-Deleted': 'yes'})
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR account update failed with '
+                    '%(ip)s:%(port)s/%(device)s (will retry later): '), node)
+                return HTTP_INTERNAL_SERVER_ERROR
+        with Timeout(self.node_timeout):
+            try:
+                conn.send(body)
+                resp = conn.getresponse()
+                resp.read()
+                return resp.status
+            except (Exception, Timeout):
+                if self.logger.getEffectiveLevel() <= logging.DEBUG:
+                    self.logger.exception(
+                        _('Exception with %(ip)s:%(port)s/%(device)s'), node)
+                return HTTP_INTERNAL_SERVER_ERROR
+
     def container_report(self, node, part, container, put_timestamp,
                          delete_timestamp, count, bytes):
         """
@@ -24,7 +24,7 @@ import traceback
 from datetime import datetime
 from hashlib import md5
 from tempfile import mkstemp
-from urllib import unquote
+from urllib import quote, unquote
 from contextlib import contextmanager
 
 from webob import Request, Response, UTC
@@ -38,7 +38,7 @@ from eventlet import sleep, Timeout, tpool
 from swift.common.utils import mkdirs, normalize_timestamp, public, \
     storage_directory, hash_path, renamer, fallocate, \
     split_path, drop_buffer_cache, get_logger, write_pickle, \
-    TRUE_VALUES, validate_device_partition
+    TRUE_VALUES, validate_device_partition, json
 from swift.common.bufferedhttp import http_connect
 from swift.common.constraints import check_object_creation, check_mount, \
     check_float, check_utf8
@@ -383,6 +383,8 @@ class ObjectController(object):
                 conf.get('allowed_headers',
                 default_allowed_headers).split(',') if i.strip() and
                 i.strip().lower() not in DISALLOWED_HEADERS)
+        # Marks static large object manifests; the proxy relies on it.
+        self.allowed_headers.add('x-static-large-object')
         self.expiring_objects_account = \
             (conf.get('auto_create_account_prefix') or '.') + \
             'expiring_objects'
@@ -539,6 +541,11 @@ class ObjectController(object):
             if header_key in request.headers:
                 header_caps = header_key.title()
                 metadata[header_caps] = request.headers[header_key]
+        # A fast POST must not turn a static large object manifest back into
+        # a plain object.
+        if 'X-Static-Large-Object' in file.metadata:
+            metadata['X-Static-Large-Object'] = \
+                file.metadata['X-Static-Large-Object']
         old_delete_at = int(file.metadata.get('X-Delete-At') or 0)
         if old_delete_at != new_delete_at:
             if new_delete_at:
@@ -846,6 +853,59 @@ class ObjectController(object):
         self.logger.timing_since('DELETE.timing', start_time)
         return resp
 
+    @public
+    def BULK_DELETE(self, request):
+        """
+        Handle BULK_DELETE requests for the Swift Object Server. This is used
+        by the account reaper to delete many objects on a device with a
+        single request; each object is deleted just as by :func:`DELETE`.
+
+        The body is a JSON list of {'partition', 'account', 'container',
+        'obj', 'container_host', 'container_partition', 'container_device'}
+        and the response body a JSON list of the DELETE status of each.
+        """
+        start_time = time.time()
+        try:
+            device = split_path(unquote(request.path), 1, 1)[0]
+        except ValueError, e:
+            self.logger.increment('BULK_DELETE.errors')
+            return HTTPBadRequest(body=str(e), request=request,
+                                  content_type='text/plain')
+        if 'x-timestamp' not in request.headers or \
+                not check_float(request.headers['x-timestamp']):
+            self.logger.increment('BULK_DELETE.errors')
+            return HTTPBadRequest(body='Missing timestamp', request=request,
+                                  content_type='text/plain')
+        if self.mount_check and not check_mount(self.devices, device):
+            self.logger.increment('BULK_DELETE.errors')
+            return HTTPInsufficientStorage(drive=device, request=request)
+        try:
+            entries = [(str(entry['partition']),
+                        entry['account'].encode('utf-8'),
+                        entry['container'].encode('utf-8'),
+                        entry['obj'].encode('utf-8'),
+                        {'X-Container-Host': entry['container_host'],
+                         'X-Container-Partition':
+                            str(entry['container_partition']),
+                         'X-Container-Device': entry['container_device']})
+                       for entry in json.loads(request.body)]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.logger.increment('BULK_DELETE.errors')
+            return HTTPBadRequest(body='Invalid BULK_DELETE body',
+                                  request=request, content_type='text/plain')
+        statuses = []
+        for partition, account, container, obj, headers in entries:
+            headers['X-Timestamp'] = request.headers['x-timestamp']
+            headers['X-Trans-Id'] = request.headers.get('x-trans-id', '-')
+            subreq = Request.blank(
+                quote('/%s/%s/%s/%s/%s' % (device, partition, account,
+                                           container, obj)),
+                environ={'REQUEST_METHOD': 'DELETE'}, headers=headers)
+            statuses.append(self.DELETE(subreq).status_int)
+        self.logger.timing_since('BULK_DELETE.timing', start_time)
+        return Response(body=json.dumps(statuses),
+                        content_type='application/json', request=request)
+
     @public
     def REPLICATE(self, request):
         """
@@ -91,9 +91,7 @@ class AccountController(Controller):
                    'x-trans-id': self.trans_id,
                    'Connection': 'close'}
         self.transfer_headers(req.headers, headers)
-        if self.app.memcache:
-            self.app.memcache.delete(
-                get_account_memcache_key(self.account_name))
+        self._delete_cached_info(get_account_memcache_key(self.account_name))
         resp = self.make_requests(req, self.app.account_ring,
             account_partition, 'PUT', req.path_info, [headers] * len(accounts))
         return resp
@@ -110,9 +108,7 @@ class AccountController(Controller):
                    'X-Trans-Id': self.trans_id,
                    'Connection': 'close'}
         self.transfer_headers(req.headers, headers)
-        if self.app.memcache:
-            self.app.memcache.delete(
-                get_account_memcache_key(self.account_name))
+        self._delete_cached_info(get_account_memcache_key(self.account_name))
         resp = self.make_requests(req, self.app.account_ring,
             account_partition, 'POST', req.path_info,
             [headers] * len(accounts))
@@ -142,9 +138,7 @@ class AccountController(Controller):
         headers = {'X-Timestamp': normalize_timestamp(time.time()),
                    'X-Trans-Id': self.trans_id,
                    'Connection': 'close'}
-        if self.app.memcache:
-            self.app.memcache.delete(
-                get_account_memcache_key(self.account_name))
+        self._delete_cached_info(get_account_memcache_key(self.account_name))
         resp = self.make_requests(req, self.app.account_ring,
             account_partition, 'DELETE', req.path_info,
             [headers] * len(accounts))
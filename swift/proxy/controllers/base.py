@@ -26,8 +26,11 @@
 
 import time
 import functools
+from itertools import islice
+from hashlib import md5
 
 from eventlet import spawn_n, GreenPile, Timeout
+from eventlet.event import Event
 from eventlet.queue import Queue, Empty, Full
 from eventlet.timeout import Timeout
 from webob.exc import status_map
@@ -84,6 +87,115 @@ def get_container_memcache_key(account, container):
     return 'container/%s/%s' % (account, container)
 
 
+def get_manifest_listing_memcache_key(account, container, put_timestamp,
+                                      prefix):
+    return 'manifest_listing/%s/%s/%s/%s' % (
+        account, container, put_timestamp, md5(prefix).hexdigest())
+
+
+class InfoCache(object):
+    """
+    Per-worker cache of account and container info kept in front of
+    memcache. It also lets concurrent lookups of the same key share a single
+    backend request, so a hot container that drops out of memcache is looked
+    up once per worker rather than once per request.
+
+    :param cache_time: the longest time in seconds an entry is kept; 0
+                       disables the local cache but not the coalescing of
+                       lookups
+    :param max_entries: the number of entries kept before expired ones are
+                        pruned
+    """
+
+    def __init__(self, cache_time=0, max_entries=10000):
+        self.cache_time = cache_time
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lookups = {}
+        self._refreshes = set()
+
+    def get(self, key):
+        """
+        Returns the value cached for key, or None if there isn't one or it
+        has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self._entries.pop(key, None)
+            return None
+        return entry[1]
+
+    def set(self, key, value, timeout=0):
+        """
+        Caches value for key for timeout seconds, but never for longer than
+        the configured cache_time.
+        """
+        if self.cache_time <= 0:
+            return
+        if timeout <= 0 or timeout > self.cache_time:
+            timeout = self.cache_time
+        if len(self._entries) >= self.max_entries:
+            self.prune()
+        self._entries[key] = (time.time() + timeout, value)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def prune(self):
+        """Drops expired entries, or everything if the cache is still full."""
+        now = time.time()
+        for key, (expires, _junk) in self._entries.items():
+            if expires <= now:
+                del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def start_refresh(self, key):
+        """
+        Registers a background refresh of key, before it is spawned, so that
+        requests arriving in the meantime do not spawn one of their own.
+
+        :returns: False if a refresh or a coalesced lookup of key is already
+                  running, True otherwise
+        """
+        if key in self._refreshes or key in self._lookups:
+            return False
+        self._refreshes.add(key)
+        return True
+
+    def end_refresh(self, key):
+        """Unregisters a refresh registered by :func:`start_refresh`."""
+        self._refreshes.discard(key)
+
+    def coalesce(self, key, func):
+        """
+        Calls func() on behalf of every greenthread asking for key at the
+        same time; the first caller makes the call and the rest wait for its
+        result. If the first caller fails, the waiters call func() themselves.
+
+        :param key: the key identifying the lookup
+        :param func: callable doing the lookup, must not return None
+        :returns: tuple of (result of func(), True if the result was shared
+                  from another greenthread's call)
+        """
+        event = self._lookups.get(key)
+        if event is not None:
+            result = event.wait()
+            if result is not None:
+                return result, True
+            return func(), False
+        event = self._lookups[key] = Event()
+        result = None
+        try:
+            result = func()
+        finally:
+            del self._lookups[key]
+            event.send(result)
+        return result, False
+
+
 class Controller(object):
     """Base WSGI controller class for the proxy"""
     server_type = 'Base'
@@ -182,9 +294,9 @@ class Controller(object):
         """
         partition, nodes = self.app.account_ring.get_nodes(account)
         # 0 = no responses, 200 = found, 404 = not found, -1 = mixed responses
-        if self.app.memcache:
-            cache_key = get_account_memcache_key(account)
-            cache_value = self.app.memcache.get(cache_key)
+        cache_key = get_account_memcache_key(account)
+        cache_value = self._get_cached_info(cache_key)
+        if cache_value is not None:
             if not isinstance(cache_value, dict):
                 result_code = cache_value
                 container_count = 0
@@ -195,69 +307,61 @@ class Controller(object):
                 return partition, nodes, container_count
             elif result_code == HTTP_NOT_FOUND and not autocreate:
                 return None, None, None
-        result_code = 0
-        container_count = 0
-        attempts_left = len(nodes)
         path = '/%s' % account
-        headers = {'x-trans-id': self.trans_id, 'Connection': 'close'}
-        iternodes = self.iter_nodes(partition, nodes, self.app.account_ring)
-        while attempts_left > 0:
-            try:
-                node = iternodes.next()
-            except StopIteration:
-                break
-            attempts_left -= 1
-            try:
-                with ConnectionTimeout(self.app.conn_timeout):
-                    conn = http_connect(node['ip'], node['port'],
-                            node['device'], partition, 'HEAD', path, headers)
-                with Timeout(self.app.node_timeout):
-                    resp = conn.getresponse()
-                    body = resp.read()
-                    if is_success(resp.status):
-                        result_code = HTTP_OK
-                        container_count = int(
-                            resp.getheader('x-account-container-count') or 0)
-                        break
-                    elif resp.status == HTTP_NOT_FOUND:
-                        if result_code == 0:
-                            result_code = HTTP_NOT_FOUND
-                        elif result_code != HTTP_NOT_FOUND:
-                            result_code = -1
-                    elif resp.status == HTTP_INSUFFICIENT_STORAGE:
-                        self.error_limit(node)
-                        continue
-                    else:
-                        result_code = -1
-            except (Exception, Timeout):
-                self.exception_occurred(node, _('Account'),
-                    _('Trying to get account info for %s') % path)
-        if result_code == HTTP_NOT_FOUND and autocreate:
-            if len(account) > MAX_ACCOUNT_NAME_LENGTH:
-                return None, None, None
-            headers = {'X-Timestamp': normalize_timestamp(time.time()),
-                       'X-Trans-Id': self.trans_id,
-                       'Connection': 'close'}
-            resp = self.make_requests(Request.blank('/v1' + path),
-                self.app.account_ring, partition, 'PUT',
-                path, [headers] * len(nodes))
-            if not is_success(resp.status_int):
-                self.app.logger.warning('Could not autocreate account %r' % \
-                                        path)
-                return None, None, None
-            result_code = HTTP_OK
-        if self.app.memcache and result_code in (HTTP_OK, HTTP_NOT_FOUND):
-            if result_code == HTTP_OK:
-                cache_timeout = self.app.recheck_account_existence
-            else:
-                cache_timeout = self.app.recheck_account_existence * 0.1
-            self.app.memcache.set(cache_key,
-                {'status': result_code, 'container_count': container_count},
-                timeout=cache_timeout)
+
+        def autocreate_and_cache(result_code, container_count):
+            if result_code == HTTP_NOT_FOUND and autocreate:
+                if len(account) > MAX_ACCOUNT_NAME_LENGTH:
+                    return None, 0
+                headers = {'X-Timestamp': normalize_timestamp(time.time()),
+                           'X-Trans-Id': self.trans_id,
+                           'Connection': 'close'}
+                resp = self.make_requests(Request.blank('/v1' + path),
+                    self.app.account_ring, partition, 'PUT',
+                    path, [headers] * len(nodes))
+                if not is_success(resp.status_int):
+                    self.app.logger.warning(
+                        'Could not autocreate account %r' % path)
+                    return None, 0
+                result_code = HTTP_OK
+            if result_code in (HTTP_OK, HTTP_NOT_FOUND):
+                if result_code == HTTP_OK:
+                    cache_timeout = self.app.recheck_account_existence
+                else:
+                    cache_timeout = self.app.recheck_account_existence * 0.1
+                self._set_cached_info(cache_key, {'status': result_code,
+                    'container_count': container_count}, cache_timeout)
+            return result_code, container_count
+
+        # only the greenthread doing the lookup autocreates and caches
+        (result_code, container_count), coalesced = self._coalesced_info(
+            'account', cache_key, lambda: autocreate_and_cache(
+                *self._account_info_from_backend(partition, nodes, path)))
+        if coalesced and result_code == HTTP_NOT_FOUND and autocreate:
+            # shared from a lookup that did not autocreate
+            result_code, container_count = autocreate_and_cache(
+                result_code, container_count)
         if result_code == HTTP_OK:
             return partition, nodes, container_count
         return None, None, None
 
+    def _account_info_from_backend(self, partition, nodes, path):
+        """
+        HEADs the account on its nodes.
+
+        :returns: tuple of (result code, container count), where the result
+                  code is 0 for no responses, 200 for found, 404 for not
+                  found and -1 for mixed responses
+        """
+        result_code, headers = self._info_heads(partition, nodes,
+            self.app.account_ring, path, _('Account'),
+            _('Trying to get account info for %s') % path)
+        container_count = 0
+        if result_code == HTTP_OK:
+            container_count = int(
+                headers.get('x-account-container-count') or 0)
+        return result_code, container_count
+
     def container_info(self, account, container, account_autocreate=False):
         """
         Get container information and thusly verify container existance.
@@ -270,85 +374,267 @@ class Controller(object):
                   read acl, container write acl, container sync key) or (None,
                   None, None, None, None) if the container does not exist
         """
+        partition, nodes, info = self._container_info(account, container,
+                                                      account_autocreate)
+        if info is None:
+            return None, None, None, None, None, None
+        return partition, nodes, info['read_acl'], info['write_acl'], \
+            info.get('sync_key'), info.get('versions')
+
+    def _container_info(self, account, container, account_autocreate=False):
+        """
+        Does the work of :func:`container_info`, returning the container's
+        info as it is cached.
+
+        :param account: account name for the container
+        :param container: container name to look up
+        :returns: tuple of (container partition, container nodes, dict of
+                  container info or None if the container does not exist)
+        """
         partition, nodes = self.app.container_ring.get_nodes(
                 account, container)
         path = '/%s/%s' % (account, container)
-        if self.app.memcache:
-            cache_key = get_container_memcache_key(account, container)
-            cache_value = self.app.memcache.get(cache_key)
-            if isinstance(cache_value, dict):
-                status = cache_value['status']
-                read_acl = cache_value['read_acl']
-                write_acl = cache_value['write_acl']
-                sync_key = cache_value.get('sync_key')
-                versions = cache_value.get('versions')
-                if status == HTTP_OK:
-                    return partition, nodes, read_acl, write_acl, sync_key, \
-                            versions
-                elif status == HTTP_NOT_FOUND:
-                    return None, None, None, None, None, None
+        cache_key = get_container_memcache_key(account, container)
+        cache_value = self._get_cached_info(cache_key)
+        if isinstance(cache_value, dict):
+            status = cache_value['status']
+            if cache_value.get('expires') and \
+                    cache_value['expires'] < time.time():
+                self._revalidate_container_info(partition, nodes, path,
+                                                cache_key, cache_value)
+            if status == HTTP_OK:
+                return partition, nodes, cache_value
+            elif status in (HTTP_NOT_FOUND, 0, -1):
+                # 0 and -1 are only cached to back off from troubled
+                # container servers
+                return partition, nodes, None
         if not self.account_info(account, autocreate=account_autocreate)[1]:
-            return None, None, None, None, None, None
+            return partition, nodes, None
+        info = self._coalesced_info('container', cache_key,
+            lambda: self._cache_container_info(cache_key,
+                self._container_info_from_backend(partition, nodes, path)))[0]
+        if info['status'] == HTTP_OK:
+            return partition, nodes, info
+        return partition, nodes, None
+
+    def _container_info_from_backend(self, partition, nodes, path):
+        """
+        HEADs the container on its nodes.
+
+        :returns: dict of container info in the form cached in memcache; its
+                  status is 0 for no responses, 200 for found, 404 for not
+                  found and -1 for mixed responses
+        """
+        result_code, headers = self._info_heads(partition, nodes,
+            self.app.container_ring, path, _('Container'),
+            _('Trying to get container info for %s') % path)
+        return self._container_info_from_headers(result_code, headers or {})
+
+    def _container_info_from_headers(self, status, headers):
+        """
+        Builds the container info that is cached in memcache from the headers
+        of a container server's response.
+
+        :param status: the status to record for the container
+        :param headers: the response headers, looked up in lower case
+        :returns: dict of container info
+        """
+        return {'status': status,
+                'read_acl': headers.get('x-container-read'),
+                'write_acl': headers.get('x-container-write'),
+                'sync_key': headers.get('x-container-sync-key'),
+                'container_size': headers.get('x-container-object-count'),
+                'versions': headers.get('x-versions-location'),
+                'put_timestamp': headers.get('x-put-timestamp')}
+
+    def _info_head(self, node, partition, path, server_type, error_msg):
+        """
+        Sends one HEAD for account or container info.
+
+        :returns: tuple of (status, dict of lowercased response headers), or
+                  (None, None) if the request failed
+        """
+        result = None, None
+        try:
+            with ConnectionTimeout(self.app.conn_timeout):
+                conn = http_connect(node['ip'], node['port'], node['device'],
+                    partition, 'HEAD', path,
+                    {'x-trans-id': self.trans_id, 'Connection': 'close'})
+            with Timeout(self.app.node_timeout):
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status == HTTP_INSUFFICIENT_STORAGE:
+                    self.error_limit(node)
+                result = resp.status, dict(
+                    (k.lower(), v) for k, v in resp.getheaders())
+        except (Exception, Timeout):
+            self.exception_occurred(node, server_type, error_msg)
+        return result
+
+    def _info_heads(self, partition, nodes, ring, path, server_type,
+                    error_msg):
+        """
+        HEADs an account or container on as many nodes as it has replicas,
+        stopping at the first success. The nodes are tried one after another
+        unless concurrent_info_lookups is set; then they are all asked at
+        once, or info_lookup_stagger seconds apart.
+
+        :returns: tuple of (result code, headers of the successful response
+                  or None); the result code is 0 for no responses, 200 for
+                  found, 404 for not found and -1 for mixed responses
+        """
+        node_iter = islice(self.iter_nodes(partition, nodes, ring),
+                           len(nodes))
+        args = (partition, path, server_type, error_msg)
         result_code = 0
-        read_acl = None
-        write_acl = None
-        sync_key = None
-        container_size = None
-        versions = None
-        attempts_left = len(nodes)
-        headers = {'x-trans-id': self.trans_id, 'Connection': 'close'}
-        iternodes = self.iter_nodes(partition, nodes, self.app.container_ring)
-        while attempts_left > 0:
+        if not self.app.concurrent_info_lookups:
+            for node in node_iter:
+                status, headers = self._info_head(node, *args)
+                if is_success(status):
+                    return HTTP_OK, headers
+                result_code = self._merge_info_status(result_code, status)
+            return result_code, None
+        responses = Queue()
+
+        def head(node, logger_thread_locals):
+            self.app.logger.thread_locals = logger_thread_locals
+            responses.put(self._info_head(node, *args))
+
+        pending = 0
+        for node in node_iter:
+            spawn_n(head, node, self.app.logger.thread_locals)
+            pending += 1
+            if self.app.info_lookup_stagger <= 0:
+                continue
             try:
-                node = iternodes.next()
-            except StopIteration:
-                break
-            attempts_left -= 1
+                status, headers = responses.get(
+                    timeout=self.app.info_lookup_stagger)
+            except Empty:
+                continue
+            pending -= 1
+            if is_success(status):
+                return HTTP_OK, headers
+            result_code = self._merge_info_status(result_code, status)
+        while pending:
+            status, headers = responses.get()
+            pending -= 1
+            if is_success(status):
+                return HTTP_OK, headers
+            result_code = self._merge_info_status(result_code, status)
+        return result_code, None
+
+    def _merge_info_status(self, result_code, status):
+        """
+        Folds the status of a failed info HEAD into the result code so far.
+        """
+        if status is None or status == HTTP_INSUFFICIENT_STORAGE:
+            return result_code
+        if status == HTTP_NOT_FOUND:
+            if result_code in (0, HTTP_NOT_FOUND):
+                return HTTP_NOT_FOUND
+            return -1
+        return -1
+
+    def _cache_container_info(self, cache_key, info, stale_info=None):
+        """
+        Caches the result of a container lookup. Lookups that got no answer
+        or mixed answers are only cached if container_error_backoff is set;
+        if stale_info is given, it is kept for that long instead.
+
+        With container_stale_time set, the entry records when it expires
+        but stays in memcache that much longer, so that it can be served
+        while it is revalidated.
+
+        :param cache_key: the memcache key of the container
+        :param info: dict of container info from _container_info_from_backend
+        :param stale_info: the expired info being revalidated, if any
+        :returns: info
+        """
+        result = info
+        if info['status'] == HTTP_OK:
+            cache_timeout = self.app.recheck_container_existence
+        elif info['status'] == HTTP_NOT_FOUND:
+            cache_timeout = self.app.recheck_container_existence * 0.1
+        elif self.app.container_error_backoff > 0:
+            cache_timeout = self.app.container_error_backoff
+            if stale_info is not None:
+                info = stale_info
+        else:
+            return result
+        if self.app.container_stale_time > 0:
+            info = dict(info, expires=time.time() + cache_timeout)
+            cache_timeout += self.app.container_stale_time
+        self._set_cached_info(cache_key, info, cache_timeout)
+        return result
+
+    def _revalidate_container_info(self, partition, nodes, path, cache_key,
+                                   stale_info):
+        """
+        Refreshes expired container info in a background greenthread unless
+        this worker is already looking the container up.
+        """
+        self.app.logger.increment('container_info.stale')
+        if not self.app.info_cache.start_refresh(cache_key):
+            return
+
+        def refresh(logger_thread_locals):
+            self.app.logger.thread_locals = logger_thread_locals
             try:
-                with ConnectionTimeout(self.app.conn_timeout):
-                    conn = http_connect(node['ip'], node['port'],
-                            node['device'], partition, 'HEAD', path, headers)
-                with Timeout(self.app.node_timeout):
-                    resp = conn.getresponse()
-                    body = resp.read()
-                    if is_success(resp.status):
-                        result_code = HTTP_OK
-                        read_acl = resp.getheader('x-container-read')
-                        write_acl = resp.getheader('x-container-write')
-                        sync_key = resp.getheader('x-container-sync-key')
-                        container_size = \
-                            resp.getheader('X-Container-Object-Count')
-                        versions = resp.getheader('x-versions-location')
-                        break
-                    elif resp.status == HTTP_NOT_FOUND:
-                        if result_code == 0:
-                            result_code = HTTP_NOT_FOUND
-                        elif result_code != HTTP_NOT_FOUND:
-                            result_code = -1
-                    elif resp.status == HTTP_INSUFFICIENT_STORAGE:
-                        self.error_limit(node)
-                        continue
-                    else:
-                        result_code = -1
-            except (Exception, Timeout):
-                self.exception_occurred(node, _('Container'),
-                    _('Trying to get container info for %s') % path)
-        if self.app.memcache and result_code in (HTTP_OK, HTTP_NOT_FOUND):
-            if result_code == HTTP_OK:
-                cache_timeout = self.app.recheck_container_existence
-            else:
-                cache_timeout = self.app.recheck_container_existence * 0.1
-            self.app.memcache.set(cache_key,
-                                  {'status': result_code,
-                                   'read_acl': read_acl,
-                                   'write_acl': write_acl,
-                                   'sync_key': sync_key,
-                                   'container_size': container_size,
-                                   'versions': versions},
-                                  timeout=cache_timeout)
-        if result_code == HTTP_OK:
-            return partition, nodes, read_acl, write_acl, sync_key, versions
-        return None, None, None, None, None, None
+                self._coalesced_info('container', cache_key,
+                    lambda: self._cache_container_info(cache_key,
+                        self._container_info_from_backend(partition, nodes,
+                                                          path),
+                        stale_info))
+            finally:
+                self.app.info_cache.end_refresh(cache_key)
+
+        spawn_n(refresh, self.app.logger.thread_locals)
+
+    def _get_cached_info(self, cache_key):
+        """
+        Looks up account or container info in the worker's local cache and
+        then in memcache.
+
+        :returns: the cached value or None
+        """
+        cache_value = self.app.info_cache.get(cache_key)
+        if cache_value is None and self.app.memcache:
+            cache_value = self.app.memcache.get(cache_key)
+            if isinstance(cache_value, dict):
+                self.app.info_cache.set(cache_key, cache_value)
+        return cache_value
+
+    def _set_cached_info(self, cache_key, value, timeout):
+        """Caches account or container info locally and in memcache."""
+        self.app.info_cache.set(cache_key, value, timeout)
+        if self.app.memcache:
+            self.app.memcache.set(cache_key, value, timeout=timeout)
+
+    def _delete_cached_info(self, cache_key):
+        """Drops account or container info from both caches."""
+        self.app.info_cache.delete(cache_key)
+        if self.app.memcache:
+            self.app.memcache.delete(cache_key)
+
+    def _coalesced_info(self, server_type, cache_key, lookup):
+        """
+        Runs lookup() once for all of this worker's concurrent requests for
+        the same account or container info.
+
+        :param server_type: 'account' or 'container', used for metrics
+        :param cache_key: the memcache key of the info
+        :param lookup: callable doing the backend requests and caching their
+                       result, so that only one greenthread writes it
+        :returns: tuple of (the result of lookup(), True if it was shared
+                  from another greenthread's call)
+        """
+        start = time.time()
+        result, coalesced = self.app.info_cache.coalesce(cache_key, lookup)
+        if coalesced:
+            self.app.logger.increment('%s_info.coalesced' % server_type)
+            self.app.logger.timing_since(
+                '%s_info.coalesced.timing' % server_type, start)
+        return result, coalesced
 
     def iter_nodes(self, partition, nodes, ring):
         """
@@ -660,6 +946,9 @@ class Controller(object):
                     res.environ = dict()
                 res.environ['swift_x_timestamp'] = \
                     source.getheader('x-timestamp')
+                # Used by the container info cache
+                res.environ['swift_x_put_timestamp'] = \
+                    source.getheader('x-put-timestamp')
                 update_headers(res, {'accept-ranges': 'bytes'})
                 res.status = source.status
                 res.content_length = source.getheader('Content-Length')
@@ -675,6 +964,9 @@ class Controller(object):
                     res.environ = dict()
                 res.environ['swift_x_timestamp'] = \
                     source.getheader('x-timestamp')
+                # Used by the container info cache
+                res.environ['swift_x_put_timestamp'] = \
+                    source.getheader('x-put-timestamp')
                 update_headers(res, {'accept-ranges': 'bytes'})
                 res.content_length = source.getheader('Content-Length')
                 if source.getheader('Content-Type'):
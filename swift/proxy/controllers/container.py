@@ -32,7 +32,8 @@ from webob.exc import HTTPBadRequest, HTTPForbidden, HTTPNotFound
 
 from swift.common.utils import normalize_timestamp, public
 from swift.common.constraints import check_metadata, MAX_CONTAINER_NAME_LENGTH
-from swift.common.http import HTTP_ACCEPTED
+from swift.common.http import HTTP_ACCEPTED, HTTP_NOT_FOUND, HTTP_OK, \
+    is_success, is_server_error
 from swift.proxy.controllers.base import Controller, delay_denial, \
     get_container_memcache_key, get_account_memcache_key
 
@@ -73,18 +74,34 @@ class ContainerController(Controller):
         resp = self.GETorHEAD_base(req, _('Container'), part, nodes,
                 req.path_info, len(nodes))
 
-        if self.app.memcache:
-            # set the memcache container size for ratelimiting
+        if is_success(resp.status_int) or \
+                resp.status_int == HTTP_NOT_FOUND or \
+                is_server_error(resp.status_int):
+            # cache the container info as container_info does, so that
+            # container_stale_time and container_error_backoff apply to it
+            # too; the container size is used for ratelimiting, its
+            # put_timestamp for the manifest listing cache
             cache_key = get_container_memcache_key(self.account_name,
                                                    self.container_name)
-            self.app.memcache.set(cache_key,
-              {'status': resp.status_int,
-               'read_acl': resp.headers.get('x-container-read'),
-               'write_acl': resp.headers.get('x-container-write'),
-               'sync_key': resp.headers.get('x-container-sync-key'),
-               'container_size': resp.headers.get('x-container-object-count'),
-               'versions': resp.headers.get('x-versions-location')},
-                                  timeout=self.app.recheck_container_existence)
+            stale_info = None
+            if is_success(resp.status_int):
+                status = HTTP_OK
+            elif resp.status_int == HTTP_NOT_FOUND:
+                status = HTTP_NOT_FOUND
+            else:
+                status = -1
+                # info that is still cached is kept through the backoff
+                cache_value = self._get_cached_info(cache_key)
+                if isinstance(cache_value, dict) and \
+                        cache_value['status'] == HTTP_OK:
+                    stale_info = cache_value
+            headers = dict((k.lower(), v) for k, v in resp.headers.items())
+            # X-Put-Timestamp isn't passed on to the client
+            headers['x-put-timestamp'] = \
+                (resp.environ or {}).get('swift_x_put_timestamp')
+            self._cache_container_info(cache_key,
+                self._container_info_from_headers(status, headers),
+                stale_info)
 
         if 'swift.authorize' in req.environ:
             req.acl = resp.headers.get('x-container-read')
@@ -146,10 +163,8 @@ class ContainerController(Controller):
                         'Connection': 'close'}
             self.transfer_headers(req.headers, nheaders)
             headers.append(nheaders)
-        if self.app.memcache:
-            cache_key = get_container_memcache_key(self.account_name,
-                                                   self.container_name)
-            self.app.memcache.delete(cache_key)
+        self._delete_cached_info(get_container_memcache_key(
+            self.account_name, self.container_name))
         resp = self.make_requests(req, self.app.container_ring,
                 container_partition, 'PUT', req.path_info, headers)
         return resp
@@ -172,10 +187,8 @@ class ContainerController(Controller):
                    'x-trans-id': self.trans_id,
                    'Connection': 'close'}
         self.transfer_headers(req.headers, headers)
-        if self.app.memcache:
-            cache_key = get_container_memcache_key(self.account_name,
-                                                   self.container_name)
-            self.app.memcache.delete(cache_key)
+        self._delete_cached_info(get_container_memcache_key(
+            self.account_name, self.container_name))
         resp = self.make_requests(req, self.app.container_ring,
                 container_partition, 'POST', req.path_info,
                 [headers] * len(containers))
@@ -198,10 +211,8 @@ class ContainerController(Controller):
                            'X-Account-Partition': account_partition,
                            'X-Account-Device': account['device'],
                            'Connection': 'close'})
-        if self.app.memcache:
-            cache_key = get_container_memcache_key(self.account_name,
-                                                   self.container_name)
-            self.app.memcache.delete(cache_key)
+        self._delete_cached_info(get_container_memcache_key(
+            self.account_name, self.container_name))
         resp = self.make_requests(req, self.app.container_ring,
                     container_partition, 'DELETE', req.path_info, headers)
         # Indicates no server had the container
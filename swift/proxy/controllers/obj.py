@@ -31,24 +31,28 @@ except ImportError:
 import mimetypes
 import re
 import time
+from bisect import bisect_right
+from collections import deque
+from cStringIO import StringIO
 from datetime import datetime
 from urllib import unquote, quote
 from hashlib import md5
 from random import shuffle
 
-from eventlet import sleep, GreenPile, Timeout
+from eventlet import sleep, spawn, GreenPile, Timeout
 from eventlet.queue import Queue
 from eventlet.timeout import Timeout
 from webob.exc import HTTPAccepted, HTTPBadRequest, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPRequestEntityTooLarge, HTTPRequestTimeout, \
-    HTTPServerError, HTTPServiceUnavailable
+    HTTPServerError, HTTPServiceUnavailable, HTTPUnprocessableEntity
 from webob import Request, Response
 
 from swift.common.utils import ContextPool, normalize_timestamp, TRUE_VALUES, \
     public
 from swift.common.bufferedhttp import http_connect
 from swift.common.constraints import check_metadata, check_object_creation, \
-    CONTAINER_LISTING_LIMIT, MAX_FILE_SIZE
+    CONTAINER_LISTING_LIMIT, MAX_FILE_SIZE, MAX_MANIFEST_SEGMENTS, \
+    MAX_MANIFEST_SIZE
 from swift.common.exceptions import ChunkReadTimeout, \
     ChunkWriteTimeout, ConnectionTimeout, ListingIterNotFound, \
     ListingIterNotAuthorized, ListingIterError
@@ -56,7 +60,8 @@ from swift.common.http import is_success, is_client_error, HTTP_CONTINUE, \
     HTTP_CREATED, HTTP_MULTIPLE_CHOICES, HTTP_NOT_FOUND, \
     HTTP_INTERNAL_SERVER_ERROR, HTTP_SERVICE_UNAVAILABLE, \
     HTTP_INSUFFICIENT_STORAGE, HTTPClientDisconnect
-from swift.proxy.controllers.base import Controller, delay_denial
+from swift.proxy.controllers.base import Controller, delay_denial, \
+    get_manifest_listing_memcache_key
 
 
 class SegmentedIterable(object):
@@ -171,6 +176,21 @@ class SegmentedIterable(object):
                 self.response.status_int = HTTP_SERVICE_UNAVAILABLE
             raise
 
+    def _seek_to(self, start):
+        """
+        Skips over the segments that end before the byte offset start and
+        sets self.seek to the offset within the first segment to return.
+
+        :param start: The first byte (zero-based) to return.
+        :raises: StopIteration when start is beyond the last segment.
+        """
+        self.segment_peek = self.listing.next()
+        while start >= self.position + self.segment_peek['bytes']:
+            self.segment += 1
+            self.position += self.segment_peek['bytes']
+            self.segment_peek = self.listing.next()
+        self.seek = start - self.position
+
     def app_iter_range(self, start, stop):
         """
         Non-standard iterator function for use with Webob in serving Range
@@ -182,12 +202,7 @@ class SegmentedIterable(object):
         """
         try:
             if start:
-                self.segment_peek = self.listing.next()
-                while start >= self.position + self.segment_peek['bytes']:
-                    self.segment += 1
-                    self.position += self.segment_peek['bytes']
-                    self.segment_peek = self.listing.next()
-                self.seek = start - self.position
+                self._seek_to(start)
             else:
                 start = 0
             if stop is not None:
@@ -230,6 +245,160 @@ class SegmentedIterable(object):
             raise
 
 
+class StaticSegmentedIterable(SegmentedIterable):
+    """
+    Iterable that returns the object contents for a static large object, whose
+    manifest holds the full ordered list of its segments. Range requests find
+    the first segment to return with a binary search over the segment
+    offsets, and the next segments are requested while the current one is
+    being sent. Each segment's etag and size are checked against the
+    manifest, and a segment that no longer matches ends the response short
+    rather than being sent.
+
+    :param controller: The ObjectController instance to work with.
+    :param listing: The list of object segments to iterate over; dicts with
+                    'name' ('/container/object'), 'bytes' and 'hash' keys.
+    :param response: The webob.Response this iterable is associated with, if
+                     any (default: None)
+    """
+
+    def __init__(self, controller, listing, response=None):
+        SegmentedIterable.__init__(self, controller, None, [], response)
+        self.segments = list(listing)
+        self.offsets = []
+        self.length = 0
+        for segment_dict in self.segments:
+            self.offsets.append(self.length)
+            self.length += int(segment_dict['bytes'])
+        self.next_index = 0
+        self.prefetched = deque()
+
+    def _fetch_segment(self, segment_dict, seek, logger_thread_locals):
+        """
+        Starts the GET of one segment.
+
+        :returns: the webob.Response for the segment
+        """
+        self.controller.app.logger.thread_locals = logger_thread_locals
+        name = segment_dict['name']
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        container, obj = name.lstrip('/').split('/', 1)
+        ring = self.controller.app.object_ring
+        partition, nodes = ring.get_nodes(self.controller.account_name,
+                                          container, obj)
+        path = '/%s/%s/%s' % (self.controller.account_name, container, obj)
+        req = Request.blank(path)
+        if seek:
+            req.range = 'bytes=%s-' % seek
+        shuffle(nodes)
+        resp = self.controller.GETorHEAD_base(req, _('Object'), partition,
+            self.controller.iter_nodes(partition, nodes, ring), path,
+            len(nodes))
+        resp.segment_path = path
+        return resp
+
+    def _load_next_segment(self):
+        """
+        Loads the self.segment_iter with the next object segment's contents,
+        keeping up to slo_segment_concurrency segment requests in flight.
+
+        :raises: StopIteration when there are no more object segments.
+        """
+        try:
+            while self.next_index < len(self.segments) and \
+                    len(self.prefetched) < \
+                    max(self.controller.app.slo_segment_concurrency, 1):
+                self.segment += 1
+                if self.segment > \
+                        self.controller.app.rate_limit_after_segment:
+                    sleep(max(self.next_get_time - time.time(), 0))
+                self.next_get_time = time.time() + \
+                    1.0 / self.controller.app.rate_limit_segments_per_sec
+                segment_dict = self.segments[self.next_index]
+                self.prefetched.append((segment_dict, self.seek,
+                    spawn(self._fetch_segment, segment_dict, self.seek,
+                          self.controller.app.logger.thread_locals)))
+                self.seek = 0
+                self.next_index += 1
+            if not self.prefetched:
+                raise StopIteration()
+            self.segment_dict, seek, fetcher = self.prefetched.popleft()
+            resp = fetcher.wait()
+            if not is_success(resp.status_int):
+                raise Exception(_('Could not load object segment %(path)s:' \
+                    ' %(status)s') % {'path': resp.segment_path,
+                                      'status': resp.status_int})
+            if resp.content_length != \
+                    int(self.segment_dict['bytes']) - seek or \
+                    resp.etag != self.segment_dict['hash']:
+                # See NOTE: swift_conn at top of file about this.
+                if getattr(resp, 'swift_conn', None):
+                    resp.swift_conn.close()
+                    resp.swift_conn = None
+                raise Exception(_('Object segment %(path)s no longer '
+                    'matches the manifest: size %(size)s, etag %(etag)s') %
+                    {'path': resp.segment_path,
+                     'size': resp.content_length, 'etag': resp.etag})
+            self.segment_iter = resp.app_iter
+            # See NOTE: swift_conn at top of file about this.
+            self.segment_iter_swift_conn = getattr(resp, 'swift_conn', None)
+        except StopIteration:
+            raise
+        except (Exception, Timeout), err:
+            if not getattr(err, 'swift_logged', False):
+                self.controller.app.logger.exception(_('ERROR: While '
+                    'processing manifest /%(acc)s/%(cont)s/%(obj)s'),
+                    {'acc': self.controller.account_name,
+                     'cont': self.controller.container_name,
+                     'obj': self.controller.object_name})
+                err.swift_logged = True
+                self.response.status_int = HTTP_SERVICE_UNAVAILABLE
+            raise
+
+    def _close_prefetched(self):
+        """Closes out any segment requests that will not be read."""
+        while self.prefetched:
+            _junk, _junk, fetcher = self.prefetched.popleft()
+            try:
+                resp = fetcher.wait()
+                # See NOTE: swift_conn at top of file about this.
+                if getattr(resp, 'swift_conn', None):
+                    resp.swift_conn.close()
+                    resp.swift_conn = None
+            except (Exception, Timeout):
+                pass
+
+    def _seek_to(self, start):
+        """
+        Finds the segment holding the byte offset start with a binary search
+        and sets self.seek to the offset within that segment.
+
+        :param start: The first byte (zero-based) to return.
+        :raises: StopIteration when start is beyond the last segment.
+        """
+        if start >= self.length:
+            raise StopIteration()
+        self.next_index = bisect_right(self.offsets, start) - 1
+        self.segment = self.next_index
+        self.position = self.offsets[self.next_index]
+        self.seek = start - self.position
+
+    def __iter__(self):
+        try:
+            for chunk in SegmentedIterable.__iter__(self):
+                yield chunk
+        finally:
+            self._close_prefetched()
+
+    def app_iter_range(self, start, stop):
+        try:
+            for chunk in SegmentedIterable.app_iter_range(self, start, stop):
+                yield chunk
+        finally:
+            self._close_prefetched()
+
+
 class ObjectController(Controller):
     """WSGI controller for object requests."""
     server_type = 'Object'
@@ -276,6 +445,216 @@ class ObjectController(Controller):
             for obj in sublisting:
                 yield obj
 
+    def _manifest_listing(self, lcontainer, lprefix, env):
+        """
+        Returns the full listing of the segments for an object manifest. When
+        manifest_listing_cache_time is set, the listing is cached in memcache
+        keyed by the segment container's put timestamp and the prefix, so
+        repeated reads of a popular manifest don't hit the container servers.
+
+        :param lcontainer: the container holding the segments
+        :param lprefix: the prefix of the segment names
+        :param env: the WSGI environment of the manifest request
+        :returns: list of segment dicts as returned by a JSON listing
+        :raises: ListingIterNotFound, ListingIterNotAuthorized,
+                 ListingIterError
+        """
+        cache_key = None
+        if self.app.memcache and self.app.manifest_listing_cache_time > 0:
+            _junk, _junk, info = self._container_info(self.account_name,
+                                                      lcontainer)
+            if info is None:
+                raise ListingIterNotFound()
+            if info.get('put_timestamp'):
+                cache_key = get_manifest_listing_memcache_key(
+                    self.account_name, lcontainer, info['put_timestamp'],
+                    lprefix)
+                listing = self.app.memcache.get(cache_key)
+                if isinstance(listing, list):
+                    if 'swift.authorize' in env:
+                        lreq = Request.blank('i will be overridden by env',
+                                             environ=env)
+                        # Don't quote PATH_INFO, by WSGI spec
+                        lreq.environ['PATH_INFO'] = \
+                            '/%s/%s' % (self.account_name, lcontainer)
+                        lreq.environ['REQUEST_METHOD'] = 'GET'
+                        lreq.acl = info['read_acl']
+                        aresp = env['swift.authorize'](lreq)
+                        if aresp:
+                            raise ListingIterNotAuthorized(aresp)
+                    self.app.logger.increment('manifest_listing.cache_hit')
+                    return listing
+                self.app.logger.increment('manifest_listing.cache_miss')
+        listing = list(self._listing_iter(lcontainer, lprefix, env))
+        if cache_key and len(listing) <= CONTAINER_LISTING_LIMIT:
+            self.app.memcache.set(cache_key, listing,
+                                  timeout=self.app.manifest_listing_cache_time)
+        return listing
+
+    def _authorize_segment_containers(self, containers, env):
+        """
+        Checks that the requester may read each of the given segment
+        containers, the same way a manifest's listing is authorized.
+
+        :param containers: iterable of container names
+        :param env: the WSGI environment of the request
+        :returns: an error response or None if all are readable
+        """
+        if 'swift.authorize' not in env:
+            return None
+        for container in containers:
+            _junk, nodes, read_acl, _junk, _junk, _junk = \
+                self.container_info(self.account_name, container)
+            if not nodes:
+                return HTTPNotFound(request=Request.blank('/', environ=env))
+            creq = Request.blank('i will be overridden by env', environ=env)
+            # Don't quote PATH_INFO, by WSGI spec
+            creq.environ['PATH_INFO'] = '/%s/%s' % (self.account_name,
+                                                    container)
+            creq.environ['REQUEST_METHOD'] = 'GET'
+            creq.acl = read_acl
+            aresp = env['swift.authorize'](creq)
+            if aresp:
+                return aresp
+        return None
+
+    def _head_segment(self, path, logger_thread_locals):
+        self.app.logger.thread_locals = logger_thread_locals
+        container, obj = path.lstrip('/').split('/', 1)
+        partition, nodes = self.app.object_ring.get_nodes(
+            self.account_name, container, obj)
+        shuffle(nodes)
+        path = '/%s/%s/%s' % (self.account_name, container, obj)
+        hreq = Request.blank(path, environ={'REQUEST_METHOD': 'HEAD'})
+        return self.GETorHEAD_base(hreq, _('Object'), partition,
+            self.iter_nodes(partition, nodes, self.app.object_ring), path,
+            len(nodes))
+
+    def _static_manifest_put(self, req):
+        """
+        Turns a ?multipart-manifest=put request into the PUT of a static large
+        object manifest. The body is a JSON list of {'path', 'etag',
+        'size_bytes'} dicts naming the segments in order; each segment is
+        checked with a HEAD and the request is rewritten in place to store
+        the resulting segment index.
+
+        :param req: webob.Request object
+        :returns: an error response or None if req may now be PUT
+        """
+        if 'x-copy-from' in req.headers:
+            return HTTPBadRequest(request=req, content_type='text/plain',
+                body='Static large object manifests cannot be copied into')
+        body = req.environ['wsgi.input'].read(MAX_MANIFEST_SIZE + 1)
+        if len(body) > MAX_MANIFEST_SIZE:
+            return HTTPRequestEntityTooLarge(request=req,
+                content_type='text/plain',
+                body='Manifest must be at most %d bytes' % MAX_MANIFEST_SIZE)
+        try:
+            parsed = json.loads(body)
+        except ValueError:
+            parsed = None
+        if not isinstance(parsed, list) or not parsed:
+            return HTTPBadRequest(request=req, content_type='text/plain',
+                body='Manifest must be a non-empty JSON list')
+        if len(parsed) > MAX_MANIFEST_SEGMENTS:
+            return HTTPRequestEntityTooLarge(request=req,
+                content_type='text/plain', body='Manifest must have at most '
+                '%d segments' % MAX_MANIFEST_SEGMENTS)
+        paths = []
+        for seg in parsed:
+            if not isinstance(seg, dict) or \
+                    set(seg) != set(('path', 'etag', 'size_bytes')) or \
+                    not isinstance(seg['path'], basestring) or \
+                    len(seg['path'].lstrip('/').split('/', 1)) != 2:
+                return HTTPBadRequest(request=req, content_type='text/plain',
+                    body='Each segment must be a dict with path, etag and '
+                         'size_bytes keys; path is /container/object')
+            path = seg['path']
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            paths.append('/' + path.lstrip('/'))
+        aresp = self._authorize_segment_containers(
+            set(path.split('/')[1] for path in paths), req.environ)
+        if aresp:
+            return aresp
+        pile = GreenPile(max(self.app.slo_segment_concurrency, 1))
+        for path in paths:
+            pile.spawn(self._head_segment, path,
+                       self.app.logger.thread_locals)
+        problems = []
+        manifest = []
+        for seg, path, hresp in zip(parsed, paths, pile):
+            if not is_success(hresp.status_int):
+                problems.append('%s: %s' % (path, hresp.status_int))
+            elif 'x-object-manifest' in hresp.headers or \
+                    'x-static-large-object' in hresp.headers:
+                problems.append('%s: segments cannot be manifests' % path)
+            elif str(hresp.content_length) != str(seg['size_bytes']):
+                problems.append('%s: size %s != %s' % (
+                    path, hresp.content_length, seg['size_bytes']))
+            elif hresp.etag != seg['etag']:
+                problems.append('%s: etag %s != %s' %
+                                (path, hresp.etag, seg['etag']))
+            else:
+                manifest.append({'name': path, 'bytes': hresp.content_length,
+                    'hash': hresp.etag,
+                    'content_type': hresp.headers.get('content-type'),
+                    'last_modified': hresp.headers.get('last-modified')})
+        if problems:
+            return HTTPBadRequest(request=req, content_type='text/plain',
+                                  body='Errors:\n' + '\n'.join(problems))
+        slo_etag = md5(''.join(seg['hash'] for seg in manifest)).hexdigest()
+        if req.headers.get('etag', slo_etag).strip('"') != slo_etag:
+            return HTTPUnprocessableEntity(request=req)
+        body = json.dumps(manifest)
+        req.environ['wsgi.input'] = StringIO(body)
+        req.content_length = len(body)
+        if 'transfer-encoding' in req.headers:
+            del req.headers['transfer-encoding']
+        req.headers['Etag'] = md5(body).hexdigest()
+        req.headers['X-Static-Large-Object'] = 'True'
+        return None
+
+    def _static_manifest_response(self, req, resp, partition, nodes):
+        """
+        Builds the response for a GET or HEAD of a static large object from
+        the response for its manifest.
+
+        :param req: webob.Request object
+        :param resp: the webob.Response for the manifest object
+        :param partition: the manifest's partition
+        :param nodes: the manifest's nodes
+        :returns: webob.Response object
+        """
+        if req.method == 'HEAD':
+            mreq = Request.blank(req.path_info,
+                                 environ={'REQUEST_METHOD': 'GET'})
+            mresp = self.GETorHEAD_base(mreq, _('Object'), partition,
+                self.iter_nodes(partition, nodes, self.app.object_ring),
+                req.path_info, len(nodes))
+            if not is_success(mresp.status_int):
+                return mresp
+        else:
+            mresp = resp
+        try:
+            listing = json.loads(''.join(mresp.app_iter))
+        except ValueError:
+            self.app.logger.error(_('Invalid static large object manifest '
+                '%s'), req.path)
+            return HTTPServerError(request=req)
+        aresp = self._authorize_segment_containers(
+            set(seg['name'].lstrip('/').split('/', 1)[0] for seg in listing),
+            req.environ)
+        if aresp:
+            return aresp
+        resp = Response(headers=resp.headers, request=req,
+                        conditional_response=True)
+        resp.app_iter = StaticSegmentedIterable(self, listing, resp)
+        resp.content_length = resp.app_iter.length
+        resp.etag = md5(''.join(seg['hash'] for seg in listing)).hexdigest()
+        resp.headers['accept-ranges'] = 'bytes'
+        return resp
+
     def GETorHEAD(self, req):
         """Handle HTTP GET or HEAD requests."""
         _junk, _junk, req.acl, _junk, _junk, object_versions = \
@@ -294,6 +673,7 @@ class ObjectController(Controller):
         # we should request a manifest because size of manifest file
         # can be not 0. After checking a manifest, redo the range request
         # on the whole object.
+        static_manifest = req.GET.get('multipart-manifest') != 'get'
         if req.range:
             req_range = req.range
             req.range = None
@@ -302,19 +682,26 @@ class ObjectController(Controller):
                                                         nodes,
                                                         self.app.object_ring),
                                         req.path_info, len(nodes))
-            if 'x-object-manifest' not in resp2.headers:
+            if 'x-object-manifest' not in resp2.headers and not (
+                    static_manifest and
+                    'x-static-large-object' in resp2.headers):
                 return resp
             resp = resp2
             req.range = str(req_range)
 
+        if static_manifest and 'x-static-large-object' in resp.headers and \
+                is_success(resp.status_int):
+            return self._static_manifest_response(req, resp, partition,
+                                                  nodes)
+
         if 'x-object-manifest' in resp.headers:
             lcontainer, lprefix = \
                 resp.headers['x-object-manifest'].split('/', 1)
             lcontainer = unquote(lcontainer)
             lprefix = unquote(lprefix)
             try:
-                listing = list(self._listing_iter(lcontainer, lprefix,
-                                req.environ))
+                listing = self._manifest_listing(lcontainer, lprefix,
+                                                 req.environ)
             except ListingIterNotFound:
                 return HTTPNotFound(request=req)
             except ListingIterNotAuthorized, err:
@@ -402,6 +789,7 @@ class ObjectController(Controller):
                 self.object_name))
             req.headers['X-Fresh-Metadata'] = 'true'
             req.environ['swift_versioned_copy'] = True
+            req.environ['swift_post_as_copy'] = True
             resp = self.PUT(req)
             # Older editions returned 202 Accepted on object POSTs, so we'll
             # convert any 201 Created responses to that for compatibility with
@@ -413,6 +801,8 @@ class ObjectController(Controller):
             error_response = check_metadata(req, 'object')
             if error_response:
                 return error_response
+            if 'x-static-large-object' in req.headers:
+                del req.headers['x-static-large-object']
             container_partition, containers, _junk, req.acl, _junk, _junk = \
                 self.container_info(self.account_name, self.container_name,
                     account_autocreate=self.app.account_autocreate)
@@ -508,6 +898,12 @@ class ObjectController(Controller):
                 return aresp
         if not containers:
             return HTTPNotFound(request=req)
+        if 'x-static-large-object' in req.headers:
+            del req.headers['x-static-large-object']
+        if req.GET.get('multipart-manifest') == 'put':
+            error_response = self._static_manifest_put(req)
+            if error_response:
+                return error_response
         if 'x-delete-after' in req.headers:
             try:
                 x_delete_after = int(req.headers['x-delete-after'])
@@ -622,6 +1018,10 @@ class ObjectController(Controller):
             source_req = req.copy_get()
             source_req.path_info = source_header
             source_req.headers['X-Newest'] = 'true'
+            if req.environ.get('swift_post_as_copy'):
+                # keep a static large object's manifest rather than copying
+                # its segments' data
+                source_req.query_string = 'multipart-manifest=get'
             orig_obj_name = self.object_name
             orig_container_name = self.container_name
             self.object_name = src_obj_name
@@ -644,6 +1044,10 @@ class ObjectController(Controller):
             new_req.etag = source_resp.etag
             # we no longer need the X-Copy-From header
             del new_req.headers['X-Copy-From']
+            if req.environ.get('swift_post_as_copy') and \
+                    'x-static-large-object' in source_resp.headers:
+                new_req.headers['X-Static-Large-Object'] = \
+                    source_resp.headers['x-static-large-object']
             if not content_type_manually_set:
                 new_req.headers['Content-Type'] = \
                     source_resp.headers['Content-Type']
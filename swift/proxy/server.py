@@ -41,6 +41,7 @@ from swift.common.utils import cache_from_env, get_logger, \
 from swift.common.constraints import check_utf8
 from swift.proxy.controllers import AccountController, ObjectController, \
     ContainerController, Controller
+from swift.proxy.controllers.base import InfoCache
 
 
 class Application(object):
@@ -70,6 +71,15 @@ class Application(object):
             int(conf.get('recheck_container_existence', 60))
         self.recheck_account_existence = \
             int(conf.get('recheck_account_existence', 60))
+        self.container_stale_time = \
+            float(conf.get('container_stale_time', 0))
+        self.container_error_backoff = \
+            float(conf.get('container_error_backoff', 0))
+        self.info_cache = InfoCache(float(conf.get('info_cache_time', 0)))
+        self.concurrent_info_lookups = conf.get('concurrent_info_lookups',
+            'false').lower() in TRUE_VALUES
+        self.info_lookup_stagger = \
+            float(conf.get('info_lookup_stagger', 0))
         self.allow_account_management = \
             conf.get('allow_account_management', 'no').lower() in TRUE_VALUES
         self.object_post_as_copy = \
@@ -102,6 +112,10 @@ class Application(object):
             int(conf.get('rate_limit_after_segment', 10))
         self.rate_limit_segments_per_sec = \
             int(conf.get('rate_limit_segments_per_sec', 1))
+        self.manifest_listing_cache_time = \
+            int(conf.get('manifest_listing_cache_time', 0))
+        self.slo_segment_concurrency = \
+            int(conf.get('slo_segment_concurrency', 2))
         self.log_handoffs = \
             conf.get('log_handoffs', 'true').lower() in TRUE_VALUES
 
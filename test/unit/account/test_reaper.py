@@ -15,9 +15,15 @@
 
 # TODO: Tests
 
+import os
 import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from eventlet import GreenPool
 
 from swift.account import reaper
+from swift.common.direct_client import ClientException
 from swift.common.utils import normalize_timestamp
 
 
@@ -30,8 +36,30 @@ class FakeBroker(object):
         return self.info
 
 
+class FakeRing(object):
+
+    def get_nodes(self, account, container, obj=None):
+        return 1, [{'ip': '10.0.0.%d' % i, 'port': 6000, 'device': 'sda'}
+                   for i in xrange(3)]
+
+
 class TestReaper(unittest.TestCase):
 
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def _reaper(self, conf=None):
+        r = reaper.AccountReaper(conf or {})
+        r.object_ring = FakeRing()
+        r.stats_return_codes = {}
+        r.stats_objects_deleted = 0
+        r.stats_objects_remaining = 0
+        r.stats_objects_possibly_remaining = 0
+        return r
+
     def test_delay_reaping_conf_default(self):
         r = reaper.AccountReaper({})
         self.assertEquals(r.delay_reaping, 0)
@@ -72,6 +100,92 @@ class TestReaper(unittest.TestCase):
         finally:
             reaper.time = time_orig
 
+    def test_bulk_delete_conf(self):
+        r = reaper.AccountReaper({})
+        self.assertEquals(r.bulk_delete_size, 100)
+        self.assertEquals(r.objects_per_second, 0)
+        r = reaper.AccountReaper({'bulk_delete_size': '7',
+                                  'objects_per_second': '2.5'})
+        self.assertEquals(r.bulk_delete_size, 7)
+        self.assertEquals(r.objects_per_second, 2.5)
+
+    def test_reap_objects_bulk(self):
+        calls = []
+
+        def fake_bulk_delete(node, objects, conn_timeout=5,
+                             response_timeout=15, headers={}):
+            calls.append((node['ip'], [o['obj'] for o in objects],
+                          response_timeout))
+            if node['ip'] == '10.0.0.2':
+                raise ClientException('', http_status=500)
+            return [204] * len(objects)
+
+        orig = reaper.direct_bulk_delete_objects
+        try:
+            reaper.direct_bulk_delete_objects = fake_bulk_delete
+            r = self._reaper({'bulk_delete_size': '2'})
+            cnodes = [{'ip': '10.0.1.%d' % i, 'port': 6001, 'device': 'sdb'}
+                      for i in xrange(3)]
+            r.reap_objects('a', 'c', 5, cnodes, ['o1', 'o2', 'o3'],
+                           GreenPool())
+        finally:
+            reaper.direct_bulk_delete_objects = orig
+        self.assertEquals(sorted(calls),
+            [('10.0.0.%d' % i, objs, r.node_timeout * len(objs))
+             for i in xrange(3) for objs in (['o1', 'o2'], ['o3'])])
+        self.assertEquals(r.stats_objects_deleted, 3)
+        self.assertEquals(r.stats_return_codes, {2: 6, 5: 2})
+
+    def test_reap_objects_bulk_unsupported(self):
+        bulk_calls = []
+        calls = []
+
+        def fake_bulk_delete(node, objects, **kwargs):
+            bulk_calls.append(node['ip'])
+            raise ClientException('', http_status=405)
+
+        def fake_delete(node, part, account, container, obj, **kwargs):
+            calls.append((node['ip'], obj,
+                          kwargs['headers']['X-Container-Host']))
+            if obj == 'o2':
+                raise ClientException('', http_status=404)
+
+        orig = reaper.direct_bulk_delete_objects, reaper.direct_delete_object
+        try:
+            reaper.direct_bulk_delete_objects = fake_bulk_delete
+            reaper.direct_delete_object = fake_delete
+            r = self._reaper({'bulk_delete_size': '1'})
+            cnodes = [{'ip': '10.0.1.%d' % i, 'port': 6001, 'device': 'sdb'}
+                      for i in xrange(3)]
+            r.reap_objects('a', 'c', 5, cnodes, ['o1', 'o2'], GreenPool(1))
+        finally:
+            reaper.direct_bulk_delete_objects, reaper.direct_delete_object = \
+                orig
+        # Each object server is only asked for a bulk delete once.
+        self.assertEquals(sorted(bulk_calls),
+                          ['10.0.0.0', '10.0.0.1', '10.0.0.2'])
+        self.assertEquals(len(calls), 6)
+        self.assertEquals(
+            sorted((ip, host) for ip, obj, host in calls if obj == 'o1'),
+            [('10.0.0.0', '10.0.1.2:6001'), ('10.0.0.1', '10.0.1.1:6001'),
+             ('10.0.0.2', '10.0.1.0:6001')])
+        self.assertEquals(r.stats_objects_deleted, 1)
+        self.assertEquals(r.stats_objects_remaining, 1)
+        self.assertEquals(r.bulk_delete_unsupported,
+                          set([('10.0.0.%d' % i, 6000) for i in xrange(3)]))
+
+    def test_progress(self):
+        r = self._reaper()
+        r.progress_file = os.path.join(self.testdir, 'a.db.reaper')
+        self.assertEquals(r.load_progress(), {'marker': '', 'containers': {}})
+        r.progress = {'marker': 'c1', 'containers': {'c2': 'o'}}
+        r.save_progress()
+        self.assertEquals(r.load_progress(),
+                          {'marker': 'c1', 'containers': {'c2': 'o'}})
+        r.progress = {'marker': '', 'containers': {}}
+        r.save_progress()
+        self.assertFalse(os.path.exists(r.progress_file))
+
 
 if __name__ == '__main__':
     unittest.main()
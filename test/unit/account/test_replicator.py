@@ -15,6 +15,7 @@
 
 import unittest
 from swift.account import replicator
+from swift.common import db, db_replicator
 
 
 class TestReplicator(unittest.TestCase):
@@ -27,6 +28,25 @@ class TestReplicator(unittest.TestCase):
     def test_placeholder(self):
         pass
 
+    def test_usage_prefix_delimiter_old_sqlite(self):
+
+        class FakeRing:
+            class Ring:
+                def __init__(self, *args, **kwargs):
+                    pass
+        orig_ring = db_replicator.ring
+        orig_version = db.PREFIX_STAT_SQLITE_VERSION
+        try:
+            db_replicator.ring = FakeRing()
+            self.assertEquals(replicator.AccountReplicator(
+                {'usage_prefix_delimiter': '_'}).usage_prefix_delimiter, '_')
+            db.PREFIX_STAT_SQLITE_VERSION = (99, 0, 0)
+            self.assertEquals(replicator.AccountReplicator(
+                {'usage_prefix_delimiter': '_'}).usage_prefix_delimiter, None)
+        finally:
+            db_replicator.ring = orig_ring
+            db.PREFIX_STAT_SQLITE_VERSION = orig_version
+
 
 if __name__ == '__main__':
     unittest.main()
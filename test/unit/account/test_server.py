@@ -161,6 +161,74 @@ class TestAccountController(unittest.TestCase):
         self.assertEquals(resp.headers['x-account-object-count'], 4)
         self.assertEquals(resp.headers['x-account-bytes-used'], 6)
 
+    def test_HEAD_GET_usage_prefix(self):
+        controller = AccountController({'devices': self.testdir,
+            'mount_check': 'false', 'usage_prefix_delimiter': '_'})
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
+            'HTTP_X_TIMESTAMP': '0'})
+        controller.PUT(req)
+        for name, count in (('logs_1', 2), ('logs_2', 3), ('logs', 4),
+                            ('web_1', 5)):
+            req = Request.blank('/sda1/p/a/%s' % name,
+                                environ={'REQUEST_METHOD': 'PUT'},
+                                headers={'X-Put-Timestamp': '1',
+                                         'X-Delete-Timestamp': '0',
+                                         'X-Object-Count': str(count),
+                                         'X-Bytes-Used': str(count * 10)})
+            controller.PUT(req)
+        # nothing is reported until the replicator builds the totals
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'HEAD',
+            'QUERY_STRING': 'usage_prefix=logs_'})
+        resp = controller.HEAD(req)
+        self.assertEquals(resp.status_int, 204)
+        self.assert_('x-account-prefix-container-count' not in resp.headers)
+        controller._get_account_broker('sda1', 'p', 'a').build_prefix_stat(
+            '_')
+        for method in ('HEAD', 'GET'):
+            req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': method,
+                'QUERY_STRING': 'usage_prefix=logs_'})
+            resp = getattr(controller, method)(req)
+            self.assertEquals(resp.status_int // 100, 2)
+            self.assertEquals(
+                int(resp.headers['x-account-prefix-container-count']), 2)
+            self.assertEquals(
+                int(resp.headers['x-account-prefix-object-count']), 5)
+            self.assertEquals(
+                int(resp.headers['x-account-prefix-bytes-used']), 50)
+            self.assertEquals(
+                int(resp.headers['x-account-object-count']), 14)
+        # updates to the containers are reflected
+        req = Request.blank('/sda1/p/a/logs_2',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Put-Timestamp': '1',
+                                     'X-Delete-Timestamp': '2',
+                                     'X-Object-Count': '0',
+                                     'X-Bytes-Used': '0'})
+        controller.PUT(req)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'HEAD',
+            'QUERY_STRING': 'usage_prefix=logs_'})
+        resp = controller.HEAD(req)
+        self.assertEquals(
+            int(resp.headers['x-account-prefix-container-count']), 1)
+        self.assertEquals(
+            int(resp.headers['x-account-prefix-bytes-used']), 20)
+        # prefixes not ending with the delimiter, or without it configured,
+        # are ignored
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'HEAD',
+            'QUERY_STRING': 'usage_prefix=logs'})
+        resp = controller.HEAD(req)
+        self.assert_('x-account-prefix-container-count' not in resp.headers)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'HEAD',
+            'QUERY_STRING': 'usage_prefix=logs_'})
+        resp = self.controller.HEAD(req)
+        self.assert_('x-account-prefix-container-count' not in resp.headers)
+        # nested prefixes are not totaled, so they are refused
+        for method in ('HEAD', 'GET'):
+            req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': method,
+                'QUERY_STRING': 'usage_prefix=logs_1_'})
+            resp = getattr(controller, method)(req)
+            self.assertEquals(resp.status_int, 400)
+
     def test_PUT_not_found(self):
         req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
             headers={'X-PUT-Timestamp': normalize_timestamp(1),
@@ -196,6 +264,44 @@ class TestAccountController(unittest.TestCase):
         self.assertEquals(resp.status_int, 403)
         self.assertEquals(resp.body, 'Recently deleted')
 
+    def test_UPDATE(self):
+        body = simplejson.dumps([
+            {'name': 'c1', 'put_timestamp': normalize_timestamp(1),
+             'delete_timestamp': normalize_timestamp(0),
+             'object_count': 1, 'bytes_used': 2},
+            {'name': u'c\u2603', 'put_timestamp': normalize_timestamp(1),
+             'delete_timestamp': normalize_timestamp(0),
+             'object_count': 3, 'bytes_used': 4}])
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=body)
+        resp = self.controller.UPDATE(req)
+        self.assertEquals(resp.status_int, 404)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
+            'HTTP_X_TIMESTAMP': '0'})
+        self.controller.PUT(req)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'UPDATE'},
+                            body='[{"name": "c1"}]')
+        resp = self.controller.UPDATE(req)
+        self.assertEquals(resp.status_int, 400)
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=body)
+        resp = self.controller.UPDATE(req)
+        self.assertEquals(resp.status_int, 400)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=body)
+        resp = self.controller.UPDATE(req)
+        self.assertEquals(resp.status_int, 202)
+        req = Request.blank('/sda1/p/a?format=json',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = self.controller.GET(req)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(
+            [(c['name'], c['count'], c['bytes'])
+             for c in simplejson.loads(resp.body)],
+            [('c1', 1, 2), (u'c\u2603', 3, 4)])
+        self.assertEquals(resp.headers['x-account-container-count'], 2)
+        self.assertEquals(resp.headers['x-account-object-count'], 4)
+
     def test_PUT_GET_metadata(self):
         # Set metadata header
         req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT'},
@@ -16,11 +16,13 @@
 """ Tests for swift.common.db """
 
 from __future__ import with_statement
+import cPickle as pickle
 import hashlib
 import os
 import unittest
 from shutil import rmtree, copy
 from StringIO import StringIO
+from tempfile import mkdtemp
 from time import sleep, time
 from uuid import uuid4
 
@@ -28,10 +30,13 @@ import simplejson
 import sqlite3
 
 import swift.common.db
-from swift.common.db import AccountBroker, chexor, ContainerBroker, \
-    DatabaseBroker, DatabaseConnectionError, dict_factory, get_db_connection
-from swift.common.utils import normalize_timestamp
+from swift.common.db import AccountBroker, chexor, ConnectionPool, \
+    ContainerBroker, DatabaseBroker, DatabaseConnectionError, dict_factory, \
+    encode_pending_entry, get_db_connection, PENDING_ENTRY_MARKER, \
+    PENDING_HEADER
+from swift.common.utils import normalize_timestamp, lock_parent_directory
 from swift.common.exceptions import LockTimeout
+from test.unit import FakeLogger
 
 
 class TestDatabaseConnectionError(unittest.TestCase):
@@ -79,6 +84,115 @@ class TestChexor(unittest.TestCase):
             'd41d8cd98f00b204e9800998ecf8427e', None, normalize_timestamp(1))
 
 
+class TestPendingFile(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.logger = FakeLogger()
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def old_entry(self, entry):
+        return ':' + pickle.dumps(entry, protocol=2).encode('base64')
+
+    def iter_pending(self, data, chunk_size=65536):
+        broker = DatabaseBroker(os.path.join(self.testdir, '1.db'),
+                                logger=self.logger)
+        return list(broker._iter_pending(StringIO(data), chunk_size))
+
+    def test_binary_entries(self):
+        entries = [('o%d' % i, normalize_timestamp(i), i, 'text/plain',
+                    'etag:\xff', 0) for i in xrange(50)]
+        data = ''.join(encode_pending_entry(e) for e in entries)
+        self.assertEquals(self.iter_pending(data), entries)
+        # decoding doesn't depend on where the chunks split the entries
+        self.assertEquals(self.iter_pending(data, 7), entries)
+        self.assertEquals(self.logger.log_dict, {})
+
+    def test_old_and_mixed_entries(self):
+        entries = [('o%d' % i, normalize_timestamp(i), i, 'text/plain',
+                    'etag', 0) for i in xrange(6)]
+        data = ''.join(self.old_entry(e) for e in entries[:2]) + \
+            encode_pending_entry(entries[2]) + \
+            self.old_entry(entries[3]) + \
+            encode_pending_entry(entries[4]) + self.old_entry(entries[5])
+        self.assertEquals(self.iter_pending(data), entries)
+        self.assertEquals(self.iter_pending(data, 5), entries)
+        self.assertEquals(self.logger.log_dict, {})
+
+    def test_invalid_entries(self):
+        good = encode_pending_entry(('o', '1', 0, 'text/plain', 'etag', 0))
+        bad_checksum = good[:-1] + chr(ord(good[-1]) ^ 1)
+        self.assertEquals(self.iter_pending(
+            bad_checksum + ':garbage' + good + good[:-3]),
+            [('o', '1', 0, 'text/plain', 'etag', 0)])
+        self.assertEquals(len(self.logger.log_dict['error']), 2)
+        self.assertEquals(self.logger.log_dict['exception'], [])
+        self.assertEquals(self.iter_pending(':garbage' + good),
+            [('o', '1', 0, 'text/plain', 'etag', 0)])
+        self.assertEquals(len(self.logger.log_dict['exception']), 1)
+
+    def test_torn_entries(self):
+        entries = [('o%d' % i, normalize_timestamp(i), i, 'text/plain',
+                    'etag', 0) for i in xrange(4)]
+        encoded = [encode_pending_entry(e) for e in entries]
+        huge = PENDING_ENTRY_MARKER + PENDING_HEADER.pack(1 << 30, 0)
+        for torn in (encoded[1][:10], encoded[1][:3], encoded[1][:-1],
+                     huge):
+            data = encoded[0] + torn + ''.join(encoded[2:])
+            # the entries after the torn one are still read
+            self.assertEquals(self.iter_pending(data),
+                              [entries[0]] + entries[2:])
+            self.assertEquals(self.iter_pending(data, 5),
+                              [entries[0]] + entries[2:])
+
+        broker = ContainerBroker(os.path.join(self.testdir, 'c.db'),
+                                 account='a', container='c')
+        broker.initialize(normalize_timestamp(1))
+        with open(broker.pending_file, 'a+b') as fp:
+            fp.write(encoded[0] + encoded[1][:10] + ''.join(encoded[2:]))
+        self.assertEquals(
+            [o[0] for o in broker.list_objects_iter(10, '', None, None, '')],
+            ['o0', 'o2', 'o3'])
+        broker._commit_puts()
+        self.assertEquals(os.path.getsize(broker.pending_file), 0)
+        self.assertEquals(
+            [o[0] for o in broker.list_objects_iter(10, '', None, None, '')],
+            ['o0', 'o2', 'o3'])
+
+    def test_commit_puts(self):
+        broker = ContainerBroker(os.path.join(self.testdir, 'c.db'),
+                                 account='a', container='c')
+        broker.initialize(normalize_timestamp(1))
+        with open(broker.pending_file, 'a+b') as fp:
+            fp.write(self.old_entry(('old', normalize_timestamp(2), 1,
+                                     'text/plain', 'etag', 0)))
+        broker.put_object('new', normalize_timestamp(3), 2, 'text/plain',
+                          'etag')
+        with open(broker.pending_file, 'rb') as fp:
+            self.assertEquals(list(broker._iter_pending(fp)),
+                [('old', normalize_timestamp(2), 1, 'text/plain', 'etag', 0),
+                 ('new', normalize_timestamp(3), 2, 'text/plain', 'etag', 0)])
+        self.assertEquals(
+            [o[0] for o in broker.list_objects_iter(10, '', None, None, '')],
+            ['new', 'old'])
+        self.assertEquals(os.path.getsize(broker.pending_file), 0)
+
+        broker = AccountBroker(os.path.join(self.testdir, 'a.db'),
+                               account='a')
+        broker.initialize(normalize_timestamp(1))
+        with open(broker.pending_file, 'a+b') as fp:
+            fp.write(self.old_entry(('old', normalize_timestamp(2), '0', 1,
+                                     1, 0)))
+        broker.put_container('new', normalize_timestamp(3), '0', 2, 2)
+        self.assertEquals(
+            [c[0] for c in broker.list_containers_iter(10, '', None, None,
+                                                       '')],
+            ['new', 'old'])
+        self.assertEquals(broker.get_info()['object_count'], 3)
+
+
 class TestGetDBConnection(unittest.TestCase):
 
     def test_normal_case(self):
@@ -89,6 +203,172 @@ class TestGetDBConnection(unittest.TestCase):
         self.assertRaises(DatabaseConnectionError, get_db_connection,
                           'invalid database path / name')
 
+    def test_pragmas(self):
+        tmpdir = mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.db')
+            get_db_connection(path, okay_to_create=True).close()
+            swift.common.db.configure_db_connections({
+                'db_journal_mode': 'wal', 'db_synchronous': 'off',
+                'db_cache_size': '-4096', 'db_mmap_size': '1048576'})
+            conn = get_db_connection(path)
+            self.assertEquals(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEquals(
+                conn.execute('PRAGMA synchronous').fetchone()[0], 0)
+            self.assertEquals(
+                conn.execute('PRAGMA cache_size').fetchone()[0], -4096)
+            # by default, a DB in WAL mode is left in it, even when it is
+            # open elsewhere
+            swift.common.db.configure_db_connections({})
+            conn2 = get_db_connection(path)
+            self.assertEquals(
+                conn2.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEquals(
+                conn2.execute('PRAGMA synchronous').fetchone()[0], 1)
+            # one that can't be switched while it is open is used as it is
+            swift.common.db.configure_db_connections(
+                {'db_journal_mode': 'delete'})
+            conn3 = get_db_connection(path)
+            self.assertEquals(
+                conn3.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            conn.close()
+            conn2.close()
+            conn3.close()
+            conn = get_db_connection(path)
+            self.assertEquals(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            conn.close()
+        finally:
+            swift.common.db.configure_db_connections({})
+            rmtree(tmpdir, ignore_errors=True)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        swift.common.db.configure_db_connections({})
+        rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_get_put(self):
+        path1 = os.path.join(self.tmpdir, '1.db')
+        path2 = os.path.join(self.tmpdir, '2.db')
+        for path in (path1, path2):
+            get_db_connection(path, okay_to_create=True).close()
+        pool = ConnectionPool(2)
+        conn1 = pool.get(path1)
+        conn2 = pool.get(path1)
+        self.assert_(conn1 is not conn2)
+        pool.put(path1, conn1)
+        pool.put(path1, conn2)
+        # most recently used first
+        self.assert_(pool.get(path1) is conn2)
+        self.assert_(pool.get(path1) is conn1)
+        self.assert_(pool.get(path1) not in (conn1, conn2))
+        conn3 = pool.get(path2, timeout=7)
+        self.assertEquals(conn3.timeout, 7)
+        pool.put(path1, conn1)
+        pool.put(path1, conn2)
+        pool.put(path2, conn3)
+        # conn1 was least recently used
+        self.assertRaises(sqlite3.ProgrammingError, conn1.execute,
+                          'SELECT 1')
+        self.assert_(pool.get(path2, timeout=3) is conn3)
+        self.assertEquals(conn3.timeout, 3)
+        pool.clear()
+        self.assertRaises(sqlite3.ProgrammingError, conn2.execute,
+                          'SELECT 1')
+        # a pool of size 0 doesn't keep connections
+        pool = ConnectionPool(0)
+        conn = pool.get(path1)
+        pool.put(path1, conn)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                          'SELECT 1')
+
+    def test_replaced_db(self):
+        path = os.path.join(self.tmpdir, 'test.db')
+        conn = get_db_connection(path, okay_to_create=True)
+        conn.execute('CREATE TABLE t (x)')
+        conn.commit()
+        conn.close()
+        pool = ConnectionPool(2)
+        conn = pool.get(path)
+        pool.put(path, conn)
+        copy(path, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        conn2 = pool.get(path)
+        self.assert_(conn2 is not conn)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                          'SELECT 1')
+        pool.put(path, conn2)
+        os.unlink(path)
+        get_db_connection(path, okay_to_create=True).close()
+        self.assert_(pool.get(path) is not conn2)
+        self.assertRaises(sqlite3.ProgrammingError, conn2.execute,
+                          'SELECT 1')
+
+    def test_brokers_share_connections(self):
+        swift.common.db.configure_db_connections({'db_pool_size': '4'})
+        broker = ContainerBroker(os.path.join(self.tmpdir, 'test.db'),
+                                 account='a', container='c')
+        broker.initialize(normalize_timestamp(1))
+        broker.put_object('o', normalize_timestamp(2), 0, 'text/plain', 'e')
+        self.assertEquals(broker.get_info()['object_count'], 1)
+        self.assert_(broker.conn is None)
+        conns = []
+        for _junk in xrange(3):
+            broker = ContainerBroker(os.path.join(self.tmpdir, 'test.db'),
+                                     account='a', container='c')
+            with broker.get() as conn:
+                conns.append(conn)
+            self.assertEquals(broker.get_info()['object_count'], 1)
+        self.assertEquals(len(set(conns)), 1)
+        # a connection that errored isn't reused
+        try:
+            with broker.get() as conn:
+                raise ValueError()
+        except ValueError:
+            pass
+        with broker.get() as conn2:
+            self.assert_(conn2 is not conn)
+
+    def test_close_idle(self):
+        path1 = os.path.join(self.tmpdir, '1.db')
+        path2 = os.path.join(self.tmpdir, '2.db')
+        for path in (path1, path2):
+            get_db_connection(path, okay_to_create=True).close()
+        pool = ConnectionPool(4)
+        conn1, conn2, conn3 = pool.get(path1), pool.get(path1), \
+            pool.get(path2)
+        pool.put(path1, conn1)
+        pool.put(path2, conn3)
+        pool.put(path1, conn2)
+        pool.close_idle(path1)
+        for conn in (conn1, conn2):
+            self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                              'SELECT 1')
+        self.assert_(pool.get(path2) is conn3)
+        self.assertEquals(pool._idle, {})
+        self.assertEquals(len(pool._order), 0)
+
+    def test_checkpoint_closes_pooled_connections(self):
+        swift.common.db.configure_db_connections({'db_pool_size': '4',
+                                                  'db_journal_mode': 'wal'})
+        broker = ContainerBroker(os.path.join(self.tmpdir, 'test.db'),
+                                 account='a', container='c')
+        broker.initialize(normalize_timestamp(1))
+        broker.put_object('o', normalize_timestamp(2), 0, 'text/plain', 'e')
+        self.assertEquals(broker.get_info()['object_count'], 1)
+        self.assert_(broker.has_pending_wal())
+        broker.checkpoint()
+        self.assertFalse(broker.has_pending_wal())
+        self.assertEquals(swift.common.db.DB_CONNECTION_POOL._idle, {})
+        self.assertEquals(broker.get_info()['object_count'], 1)
+
+
 
 class TestDatabaseBroker(unittest.TestCase):
 
@@ -698,6 +978,47 @@ class TestContainerBroker(unittest.TestCase):
         res = broker.reclaim(normalize_timestamp(time()), time())
         broker.delete_db(normalize_timestamp(time()))
 
+    def test_reclaim_batches(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        for i in xrange(10):
+            broker.put_object('o%d' % i, normalize_timestamp(2), 0,
+                              'text/plain', 'd41d8cd98f00b204e9800998ecf8427e')
+            broker.delete_object('o%d' % i, normalize_timestamp(3 + i))
+        broker.put_object('live', normalize_timestamp(2), 0, 'text/plain',
+                          'd41d8cd98f00b204e9800998ecf8427e')
+        with broker.get() as conn:
+            # DBs made before the index reclaim without it
+            conn.execute('DROP INDEX ix_object_deleted_created_at')
+
+        def names():
+            with broker.get() as conn:
+                return [r[0] for r in conn.execute(
+                    'SELECT name FROM object ORDER BY name')]
+
+        def has_index():
+            with broker.get() as conn:
+                return bool(conn.execute('''
+                    SELECT 1 FROM sqlite_master
+                    WHERE name = 'ix_object_deleted_created_at'
+                ''').fetchone())
+
+        # a tiny time budget stops after the first batch
+        self.assertFalse(broker.reclaim(normalize_timestamp(9), 0, 2,
+                                        0.000001))
+        self.assertEquals(len(names()), 9)
+        self.assertFalse(has_index())
+        # until the index is built separately
+        self.assertTrue(broker.build_reclaim_index())
+        self.assertTrue(has_index())
+        self.assertFalse(broker.build_reclaim_index())
+        # the next call carries on from there
+        self.assertTrue(broker.reclaim(normalize_timestamp(9), 0, 2))
+        self.assertEquals(names(), ['live', 'o6', 'o7', 'o8', 'o9'])
+        self.assertTrue(broker.reclaim(normalize_timestamp(20), 0, 3, 10))
+        self.assertEquals(names(), ['live'])
+        self.assertEquals(broker.get_info()['object_count'], 1)
+
     def test_delete_object(self):
         """ Test swift.common.db.ContainerBroker.delete_object """
         broker = ContainerBroker(':memory:', account='a', container='c')
@@ -920,6 +1241,116 @@ class TestContainerBroker(unittest.TestCase):
             self.assertEquals(conn.execute(
                 "SELECT deleted FROM object").fetchone()[0], 0)
 
+    def test_put_objects(self):
+        """ Test swift.common.db.ContainerBroker.put_objects """
+        tmpdir = mkdtemp()
+        try:
+            broker = ContainerBroker(os.path.join(tmpdir, 'test.db'),
+                                     account='a', container='c')
+            broker.initialize(normalize_timestamp('1'))
+            broker.put_objects([
+                {'name': 'o%d' % i, 'created_at': normalize_timestamp(2),
+                 'size': i, 'content_type': 'text/plain', 'etag': 'e',
+                 'deleted': 0} for i in xrange(3)])
+            broker.put_objects([
+                {'name': 'o1', 'created_at': normalize_timestamp(3),
+                 'size': 0, 'content_type': 'application/deleted',
+                 'etag': 'noetag', 'deleted': 1}])
+            with open(broker.pending_file, 'rb') as fp:
+                self.assertEquals(len(list(broker._iter_pending(fp))), 4)
+            self.assertEquals(
+                [r[0] for r in broker.list_objects_iter(10, '', None, None,
+                                                        '')],
+                ['o0', 'o2'])
+            self.assertEquals(broker.get_info()['bytes_used'], 2)
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def test_reads_merge_pending_entries(self):
+        tmpdir = mkdtemp()
+        try:
+            broker = ContainerBroker(os.path.join(tmpdir, 'test.db'),
+                                     account='a', container='c')
+            broker.initialize(normalize_timestamp('1'))
+            broker.put_object('a/1', normalize_timestamp(2), 1, 'text/plain',
+                              'e')
+            broker.put_object('b', normalize_timestamp(2), 2, 'text/plain',
+                              'e')
+            broker._commit_puts()
+            broker.put_object('a/2', normalize_timestamp(3), 4, 'text/plain',
+                              'e')
+            broker.put_object('b', normalize_timestamp(3), 8, 'text/plain',
+                              'e')
+            broker.delete_object('a/1', normalize_timestamp(3))
+            broker.put_object('c', normalize_timestamp(3), 16, 'text/plain',
+                              'e')
+            broker.delete_object('c', normalize_timestamp(4))
+            pending_size = os.path.getsize(broker.pending_file)
+            broker.pending_read_flush_size = pending_size
+            with lock_parent_directory(broker.pending_file):
+                info = broker.get_info()
+                self.assertEquals(info['object_count'], 2)
+                self.assertEquals(info['bytes_used'], 12)
+                self.assertEquals(
+                    [r[:3] for r in broker.list_objects_iter(
+                        10, '', None, None, '')],
+                    [('a/2', normalize_timestamp(3), 4),
+                     ('b', normalize_timestamp(3), 8)])
+                self.assertEquals(
+                    [r[0] for r in broker.list_objects_iter(
+                        10, '', None, '', '/')],
+                    ['a/', 'b'])
+                self.assertFalse(broker.empty())
+                self.assertFalse(broker.is_deleted())
+            self.assertEquals(os.path.getsize(broker.pending_file),
+                              pending_size)
+            # without the entries, the DB's own rows are read
+            broker.pending_read_flush_size = None
+            broker.stale_reads_ok = True
+            broker.pending_timeout = 0.01
+            with lock_parent_directory(broker.pending_file):
+                self.assertEquals(broker.get_info()['bytes_used'], 3)
+            # once past the threshold, reads commit the file if they can
+            broker.pending_read_flush_size = pending_size - 1
+            self.assertEquals(broker.get_info()['bytes_used'], 12)
+            self.assertEquals(os.path.getsize(broker.pending_file), 0)
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def test_pending_entries_parsed_once(self):
+        tmpdir = mkdtemp()
+        try:
+            broker = ContainerBroker(os.path.join(tmpdir, 'test.db'),
+                                     account='a', container='c')
+            broker.initialize(normalize_timestamp('1'))
+            broker.pending_read_flush_size = 4096
+            broker.put_object('a', normalize_timestamp(2), 1, 'text/plain',
+                              'e')
+            parses = []
+            orig_read_pending_newest = broker._read_pending_newest
+
+            def read_pending_newest():
+                parses.append(True)
+                return orig_read_pending_newest()
+
+            broker._read_pending_newest = read_pending_newest
+            self.assertFalse(broker.is_deleted())
+            self.assertEquals(broker.get_info()['object_count'], 1)
+            self.assertEquals(
+                [r[0] for r in broker.list_objects_iter(10, '', None, None,
+                                                        '')], ['a'])
+            self.assertEquals(len(parses), 1)
+            # the file changing is noticed
+            broker.put_object('b', normalize_timestamp(2), 2, 'text/plain',
+                              'e')
+            self.assertEquals(broker.get_info()['object_count'], 2)
+            self.assertEquals(len(parses), 2)
+            broker._commit_puts()
+            self.assertEquals(broker.get_info()['object_count'], 2)
+            self.assertEquals(broker.get_info()['bytes_used'], 3)
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
     def test_get_info(self):
         """ Test swift.common.db.ContainerBroker.get_info """
         broker = ContainerBroker(':memory:', account='test1',
@@ -1161,6 +1592,52 @@ class TestContainerBroker(unittest.TestCase):
         self.assertEquals(len(listing), 2)
         self.assertEquals([row[0] for row in listing], ['3/0000', '3/0001'])
 
+    def test_list_objects_iter_delimiter_dir_sizes(self):
+        # listings step over or query past subdirectories depending on their
+        # sizes; either way they have to match the plain listing
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        names = []
+        for i, size in enumerate((1, 3, 40, 2, 1, 25, 1, 9, 100, 1)):
+            names.append('d/%02d' % i)
+            names.extend('d/%02d/%03d' % (i, j) for j in xrange(size))
+            names.extend('d/%02d/%03d/x' % (i, j) for j in xrange(0, size, 3))
+        for name in names:
+            broker.put_object(name, normalize_timestamp(2), 0, 'text/plain',
+                              'd41d8cd98f00b204e9800998ecf8427e')
+        names.sort()
+
+        def expected(limit, marker, prefix, path=None):
+            if path is not None:
+                prefix = path and path + '/'
+            results = []
+            for name in names:
+                if name <= marker or not name.startswith(prefix):
+                    continue
+                end = name.find('/', len(prefix))
+                if path is not None:
+                    if end < 0:
+                        results.append(name)
+                elif end < 0:
+                    results.append(name)
+                elif name[:end + 1] not in results and \
+                        name[:end + 1] != marker:
+                    results.append(name[:end + 1])
+            return results[:limit]
+
+        for limit in (1, 5, 10000):
+            for marker in ('', 'd/00', 'd/02/', 'd/02/005', 'd/08'):
+                for prefix in ('d/', 'd/02/', 'd/08/'):
+                    self.assertEquals(
+                        [r[0] for r in broker.list_objects_iter(
+                            limit, marker, None, prefix, '/')],
+                        expected(limit, marker, prefix))
+                for path in ('d/02', 'd/08'):
+                    self.assertEquals(
+                        [r[0] for r in broker.list_objects_iter(
+                            limit, marker, None, None, None, path)],
+                        expected(limit, marker, None, path))
+
     def test_list_objects_iter_prefix_delim(self):
         """ Test swift.common.db.ContainerBroker.list_objects_iter """
         broker = ContainerBroker(':memory:', account='a', container='c')
@@ -1307,6 +1784,47 @@ class TestContainerBroker(unittest.TestCase):
         self.assertEquals(['a', 'b', 'c'],
                           sorted([rec['name'] for rec in items]))
 
+    def test_merge_items_batch_matches_one_at_a_time(self):
+
+        def rec(name, timestamp, size, deleted=0):
+            return {'name': name, 'created_at': normalize_timestamp(timestamp),
+                    'size': size, 'content_type': 'text/plain',
+                    'etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                    'deleted': deleted}
+
+        initial = [rec('a', 2, 1), rec('b', 2, 2), rec('c', 2, 3)]
+        batch = [rec('a', 1, 10), rec('b', 3, 20), rec('d', 1, 30),
+                 rec('d', 3, 31), rec('d', 2, 32), rec('e', 1, 40),
+                 rec('c', 2, 50), rec('e', 1, 41), rec('b', 4, 0, 1)]
+        batch_broker = ContainerBroker(':memory:', account='a', container='c')
+        batch_broker.initialize(normalize_timestamp('1'))
+        single_broker = ContainerBroker(':memory:', account='a',
+                                        container='c')
+        single_broker.initialize(normalize_timestamp('1'))
+        for broker in (batch_broker, single_broker):
+            broker.merge_items(initial)
+        batch_broker.merge_items(batch)
+        for r in batch:
+            single_broker.merge_items([r])
+
+        def rows(broker):
+            return [(r['name'], r['created_at'], r['size'], r['deleted'])
+                    for r in broker.get_items_since(-1, 1000)]
+
+        self.assertEquals(rows(batch_broker), rows(single_broker))
+        self.assertEquals(rows(batch_broker),
+            [('a', normalize_timestamp(2), 1, 0),
+             ('c', normalize_timestamp(2), 3, 0),
+             ('d', normalize_timestamp(3), 31, 0),
+             ('e', normalize_timestamp(1), 40, 0),
+             ('b', normalize_timestamp(4), 0, 1)])
+        batch_info = batch_broker.get_info()
+        single_info = single_broker.get_info()
+        for key in ('object_count', 'bytes_used', 'hash'):
+            self.assertEquals(batch_info[key], single_info[key])
+        self.assertEquals(batch_info['object_count'], 4)
+        self.assertEquals(batch_info['bytes_used'], 75)
+
     def test_merge_items_overwrite(self):
         """test DatabaseBroker.merge_items"""
         broker1 = ContainerBroker(':memory:', account='a', container='c')
@@ -1640,6 +2158,111 @@ class TestAccountBroker(unittest.TestCase):
         # self.assert_('z' in containers)
         # self.assert_('a' not in containers)
 
+    def test_reclaim_batches(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(normalize_timestamp('1'))
+        for i in xrange(5):
+            broker.put_container('c%d' % i, 0, normalize_timestamp(2 + i),
+                                 0, 0)
+        broker.put_container('live', normalize_timestamp(2), 0, 0, 0)
+        # new DBs come with the index
+        self.assertFalse(broker.build_reclaim_index())
+        self.assertFalse(broker.reclaim(normalize_timestamp(5), 0, 1,
+                                        0.000001))
+        self.assertTrue(broker.reclaim(normalize_timestamp(5), 0, 1))
+        self.assertTrue(broker.reclaim(normalize_timestamp(9), 0, 2, 10))
+        with broker.get() as conn:
+            self.assertEquals([r[0] for r in conn.execute(
+                'SELECT name FROM container')], ['live'])
+
+    def test_get_prefix_info(self):
+        tmpdir = mkdtemp()
+        try:
+            self._test_get_prefix_info(os.path.join(tmpdir, 'a.db'))
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def _test_get_prefix_info(self, db_file):
+        broker = AccountBroker(db_file, account='a')
+        broker.initialize(normalize_timestamp('1'))
+        broker.put_container('a_1', normalize_timestamp(1), 0, 1, 10)
+        broker.put_container('a_2', normalize_timestamp(1), 0, 2, 20)
+        broker.put_container('b-1', normalize_timestamp(1), 0, 4, 40)
+        broker.put_container('c', normalize_timestamp(1), 0, 8, 80)
+        # the totals are not there until built...
+        self.assertEquals(broker.get_prefix_info('a_', '_'), None)
+        self.assertTrue(broker.build_prefix_stat('_'))
+        self.assertFalse(broker.build_prefix_stat('_'))
+        self.assertEquals(broker.get_prefix_info('a_', '_'),
+            {'container_count': 2, 'object_count': 3, 'bytes_used': 30})
+        self.assertEquals(broker.get_prefix_info('b_', '_'),
+            {'container_count': 0, 'object_count': 0, 'bytes_used': 0})
+        # ...then kept up to date
+        broker.put_container('a_2', normalize_timestamp(1), 0, 5, 50)
+        broker.put_container('b_1', normalize_timestamp(1), 0, 1, 1)
+        broker.put_container('a_1', 0, normalize_timestamp(2), 0, 0)
+        self.assertEquals(broker.get_prefix_info('a_', '_'),
+            {'container_count': 1, 'object_count': 5, 'bytes_used': 50})
+        self.assertEquals(broker.get_prefix_info('b_', '_'),
+            {'container_count': 1, 'object_count': 1, 'bytes_used': 1})
+        broker.reclaim(normalize_timestamp(3), normalize_timestamp(3))
+        self.assertEquals(broker.get_prefix_info('a_', '_'),
+            {'container_count': 1, 'object_count': 5, 'bytes_used': 50})
+        # only single segment prefixes are totaled
+        broker.put_container('a_b_1', normalize_timestamp(1), 0, 1, 1)
+        self.assertRaises(ValueError, broker.get_prefix_info, 'a_b_', '_')
+        self.assertRaises(ValueError, broker.get_prefix_info, 'a', '_')
+        # another delimiter starts over
+        self.assertEquals(broker.get_prefix_info('b-', '-'), None)
+        self.assertTrue(broker.build_prefix_stat('-'))
+        self.assertEquals(broker.get_prefix_info('b-', '-'),
+            {'container_count': 1, 'object_count': 4, 'bytes_used': 40})
+        self.assertEquals(broker.get_prefix_info('a_', '_'), None)
+        broker.put_container("it's-1", normalize_timestamp(1), 0, 1, 1)
+        self.assertEquals(broker.get_prefix_info("it's-", '-'),
+            {'container_count': 1, 'object_count': 1, 'bytes_used': 1})
+        # the triggers need nothing registered on the connection beyond
+        # what account_stat's already do
+        conn = sqlite3.connect(broker.db_file)
+        conn.create_function('chexor', 3, chexor)
+        conn.execute('''
+            INSERT INTO container (name, put_timestamp, delete_timestamp,
+                object_count, bytes_used, deleted)
+            VALUES ('it''s-2', '1', '0', 2, 2, 0)''')
+        conn.commit()
+        conn.close()
+        self.assertEquals(broker.get_prefix_info("it's-", '-'),
+            {'container_count': 2, 'object_count': 3, 'bytes_used': 3})
+        # the delimiter is recorded in a table of its own
+        self.assertTrue(broker.build_prefix_stat("'"))
+        with broker.get() as conn:
+            self.assertEquals([("'",)], [tuple(r) for r in conn.execute(
+                'SELECT delimiter FROM prefix_stat_info')])
+        self.assertFalse(broker.build_prefix_stat("'"))
+        self.assertEquals(broker.get_prefix_info("it'", "'"),
+            {'container_count': 2, 'object_count': 3, 'bytes_used': 3})
+
+    def test_prefix_stat_old_sqlite(self):
+        tmpdir = mkdtemp()
+        orig_version = swift.common.db.PREFIX_STAT_SQLITE_VERSION
+        try:
+            broker = AccountBroker(os.path.join(tmpdir, 'a.db'), account='a')
+            broker.initialize(normalize_timestamp('1'))
+            self.assertTrue(swift.common.db.prefix_stat_supported())
+            self.assertTrue(broker.build_prefix_stat('_'))
+            # a DB whose triggers use instr() can still be written to where
+            # SQLite doesn't have it
+            swift.common.db.PREFIX_STAT_SQLITE_VERSION = (99, 0, 0)
+            self.assertFalse(swift.common.db.prefix_stat_supported())
+            broker = AccountBroker(os.path.join(tmpdir, 'a.db'), account='a')
+            broker.put_container('a_1', normalize_timestamp(1), 0, 1, 10)
+            broker.put_container('b', normalize_timestamp(1), 0, 2, 20)
+            self.assertEquals(broker.get_prefix_info('a_', '_'),
+                {'container_count': 1, 'object_count': 1, 'bytes_used': 10})
+        finally:
+            swift.common.db.PREFIX_STAT_SQLITE_VERSION = orig_version
+            rmtree(tmpdir, ignore_errors=True)
+
     def test_delete_container(self):
         """ Test swift.common.db.AccountBroker.delete_container """
         broker = AccountBroker(':memory:', account='a')
@@ -1990,6 +2613,80 @@ class TestAccountBroker(unittest.TestCase):
         self.assertEquals(['a', 'b', 'c'],
                           sorted([rec['name'] for rec in items]))
 
+    def test_merge_items_batch_matches_one_at_a_time(self):
+
+        def rec(name, put, delete, count, bytes_used, deleted=0):
+            return {'name': name, 'put_timestamp': put,
+                    'delete_timestamp': delete, 'object_count': count,
+                    'bytes_used': bytes_used, 'deleted': deleted}
+
+        ts = normalize_timestamp
+        initial = [rec('a', ts(2), ts(0), 1, 10),
+                   rec('b', ts(2), ts(0), 2, 20),
+                   rec('c', ts(2), ts(0), 0, 0)]
+        batch = [rec('a', ts(1), ts(0), 5, 50), rec('b', ts(3), ts(0), 3, 30),
+                 rec('d', ts(1), ts(0), 1, 1), rec('c', ts(2), ts(3), 0, 0),
+                 rec('d', None, ts(2), None, None),
+                 rec('e', ts(1), ts(0), 4, 4), rec('b', ts(4), ts(0), 6, 60),
+                 rec('e', ts(1), ts(0), 7, 7)]
+        batch_broker = AccountBroker(':memory:', account='a')
+        batch_broker.initialize(normalize_timestamp('1'))
+        single_broker = AccountBroker(':memory:', account='a')
+        single_broker.initialize(normalize_timestamp('1'))
+        for broker in (batch_broker, single_broker):
+            broker.merge_items([dict(r) for r in initial])
+        batch_broker.merge_items([dict(r) for r in batch])
+        for r in batch:
+            single_broker.merge_items([dict(r)])
+
+        def rows(broker):
+            return [(r['name'], r['put_timestamp'], r['delete_timestamp'],
+                     r['object_count'], r['bytes_used'], r['deleted'])
+                    for r in broker.get_items_since(-1, 1000)]
+
+        self.assertEquals(rows(batch_broker), rows(single_broker))
+        self.assertEquals([r[0] for r in rows(batch_broker)],
+                          ['a', 'c', 'd', 'b', 'e'])
+        batch_info = batch_broker.get_info()
+        single_info = single_broker.get_info()
+        for key in ('container_count', 'object_count', 'bytes_used', 'hash'):
+            self.assertEquals(batch_info[key], single_info[key])
+
+    def test_put_containers(self):
+        """ Test swift.common.db.AccountBroker.put_containers """
+        tmpdir = mkdtemp()
+        try:
+            broker = AccountBroker(os.path.join(tmpdir, 'test.db'),
+                                   account='a')
+            self.assertRaises(DatabaseConnectionError, broker.put_containers,
+                              [])
+            broker.initialize(normalize_timestamp('1'))
+            broker.put_container('a', normalize_timestamp(2),
+                                 normalize_timestamp(0), 1, 1)
+            broker.put_container('b', normalize_timestamp(2),
+                                 normalize_timestamp(0), 1, 1)
+            broker.put_containers([
+                {'name': 'a', 'put_timestamp': normalize_timestamp(3),
+                 'delete_timestamp': normalize_timestamp(0),
+                 'object_count': 5, 'bytes_used': 50},
+                {'name': 'b', 'put_timestamp': normalize_timestamp(2),
+                 'delete_timestamp': normalize_timestamp(3),
+                 'object_count': 0, 'bytes_used': 0},
+                {'name': 'c', 'put_timestamp': normalize_timestamp(3),
+                 'delete_timestamp': normalize_timestamp(0),
+                 'object_count': 2, 'bytes_used': 20}])
+            self.assertEquals(os.path.getsize(broker.pending_file), 0)
+            self.assertEquals(
+                [r[0] for r in broker.list_containers_iter(10, '', None, None,
+                                                           '')],
+                ['a', 'c'])
+            info = broker.get_info()
+            self.assertEquals(info['container_count'], 2)
+            self.assertEquals(info['object_count'], 7)
+            self.assertEquals(info['bytes_used'], 70)
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
 
 def premetadata_create_account_stat_table(self, conn, put_timestamp):
     """
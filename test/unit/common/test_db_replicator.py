@@ -18,8 +18,13 @@ from contextlib import contextmanager
 import os
 import logging
 import errno
+import zlib
+from StringIO import StringIO
+from shutil import rmtree
 from tempfile import mkdtemp, NamedTemporaryFile
 
+from webob import Request
+
 from swift.common import db_replicator
 from swift.common import utils
 from swift.common.utils import normalize_timestamp
@@ -106,8 +111,11 @@ class ReplHttp:
     replicated = False
     host = 'localhost'
 
-    def replicate(self, *args):
+    def send_replicate(self, *args):
         self.replicated = True
+        return True
+
+    def get_replicate_response(self):
 
         class Response:
             status = 200
@@ -117,6 +125,10 @@ class ReplHttp:
                 return self.response
         return Response()
 
+    def replicate(self, *args):
+        self.send_replicate(*args)
+        return self.get_replicate_response()
+
 
 class ChangingMtimesOs:
     def __init__(self):
@@ -142,6 +154,12 @@ class FakeBroker:
     def lock(self):
         yield True
 
+    def checkpoint(self, truncate=True):
+        pass
+
+    def has_pending_wal(self):
+        return False
+
     def get_sync(self, *args, **kwargs):
         return 5
 
@@ -166,8 +184,12 @@ class FakeBroker:
             return self.stub_replication_info
         return {'delete_timestamp': 0, 'put_timestamp': 1, 'count': 0}
 
-    def reclaim(self, item_timestamp, sync_timestamp):
-        pass
+    def reclaim(self, item_timestamp, sync_timestamp, batch_size=None,
+                time_budget=None):
+        return True
+
+    def build_reclaim_index(self):
+        return False
 
     def get_info(self):
         pass
@@ -211,6 +233,70 @@ class TestDBReplicator(unittest.TestCase):
         conn.request = other_req
         self.assertEquals(conn.replicate(1, 2, 3), None)
 
+    def test_repl_connection_deflate(self):
+        node = {'ip': '127.0.0.1', 'port': 80, 'device': 'sdb1'}
+        conn = db_replicator.ReplConnection(node, '1234567890', 'abcdefg',
+                    logging.getLogger())
+        sent = []
+        conn.request = lambda *args: sent.append(args)
+        big_args = ['merge_items', [{'name': 'o%d' % i} for i in xrange(500)]]
+        self.assertTrue(conn.send_replicate(*big_args))
+        conn.encodings = ['deflate']
+        self.assertTrue(conn.send_replicate('sync', 1))
+        self.assertTrue(conn.send_replicate(*big_args))
+        self.assert_('Content-Encoding' not in sent[0][3])
+        self.assert_('Content-Encoding' not in sent[1][3])
+        self.assertEquals(sent[2][3]['Content-Encoding'], 'deflate')
+        self.assert_(len(sent[2][2]) < len(sent[0][2]) / 4)
+        # whichever way they're sent, the server reads the same arguments
+        for (method, path, body, headers), args in zip(
+                sent, [big_args, ['sync', 1], big_args]):
+            req = Request.blank(path, environ={'REQUEST_METHOD': method,
+                                               'wsgi.input': StringIO(body)},
+                                headers=headers)
+            self.assertEquals(db_replicator.load_replicate_args(req), args)
+        req = Request.blank('/', environ={'wsgi.input': StringIO('junk')},
+                            headers={'Content-Encoding': 'deflate'})
+        self.assertRaises(ValueError, db_replicator.load_replicate_args, req)
+
+    def test_replicate_rows_encoding(self):
+        rows = [{'name': 'o1', 'created_at': '1.00000', 'size': 2 ** 40,
+                 'etag': None, 'deleted': 0, 'ROWID': 1},
+                {'name': u'\u2603', 'created_at': '2.00000', 'size': 0,
+                 'etag': 'x\x00y', 'deleted': 1, 'ROWID': 2 ** 64}]
+        args = ['merge_items', rows, 'abc', {'not': 'rows'}, []]
+        body = db_replicator.encode_replicate_rows(args)
+        decoded = db_replicator.decode_replicate_rows(body)
+        # strings come back UTF-8 encoded
+        rows[1]['name'] = '\xe2\x98\x83'
+        self.assertEquals(decoded, args)
+        for junk in ('', 'junk', body[:-2],
+                     zlib.compress('\x00\x00\x00\x02[]'),
+                     zlib.compress('\x00\x00\x00\x02{}')):
+            self.assertRaises(ValueError,
+                              db_replicator.decode_replicate_rows, junk)
+        # the server reads them from requests of that Content-Type
+        req = Request.blank('/', environ={'wsgi.input': StringIO(body)},
+            headers={'Content-Type': db_replicator.ROWS_CONTENT_TYPE})
+        self.assertEquals(db_replicator.load_replicate_args(req), args)
+
+    def test_repl_connection_rows(self):
+        node = {'ip': '127.0.0.1', 'port': 80, 'device': 'sdb1'}
+        conn = db_replicator.ReplConnection(node, '1234567890', 'abcdefg',
+                    logging.getLogger())
+        sent = []
+        conn.request = lambda *args: sent.append(args)
+        conn.encodings = ['deflate', 'rows']
+        self.assertTrue(conn.send_replicate('merge_items', [{'ROWID': 1}],
+                                            'abc'))
+        self.assertTrue(conn.send_replicate('sync', 1))
+        self.assertEquals(sent[0][3]['Content-Type'],
+                          db_replicator.ROWS_CONTENT_TYPE)
+        self.assertEquals(
+            db_replicator.decode_replicate_rows(sent[0][2]),
+            ['merge_items', [{'ROWID': 1}], 'abc'])
+        self.assertEquals(sent[1][3]['Content-Type'], 'application/json')
+
     def test_rsync_file(self):
         replicator = TestReplicator({})
         with _mock_process(-1):
@@ -228,6 +314,51 @@ class TestDBReplicator(unittest.TestCase):
         fake_device = {'ip': '127.0.0.1', 'device': 'sda1'}
         replicator._rsync_db(FakeBroker(), fake_device, ReplHttp(), 'abcd')
 
+    def test_rsync_throttled(self):
+        replicator = TestReplicator({'rsync_bwlimit': '1024',
+                                     'rsync_concurrency': '1'})
+        popen_args = []
+
+        class Process:
+            returncode = 0
+
+            def __init__(self, args):
+                popen_args.append(args)
+
+            def communicate(self):
+                pass
+        orig_popen = db_replicator.subprocess.Popen
+        try:
+            db_replicator.subprocess.Popen = Process
+            self.assertTrue(replicator._rsync_file('/a/file', 'remote:/b'))
+            self.assert_('--bwlimit=1024' in popen_args[0])
+            self.assert_('--partial' in popen_args[0])
+            # the limit is shared by the dbs rsynced at a time per device
+            shared = TestReplicator({'rsync_bwlimit': '1024',
+                                     'rsync_concurrency': '4'})
+            self.assertTrue(shared._rsync_file('/a/file', 'remote:/b'))
+            self.assert_('--bwlimit=256' in popen_args[1])
+            shared.rsync_bwlimit = 2
+            self.assertTrue(shared._rsync_file('/a/file', 'remote:/b'))
+            self.assert_('--bwlimit=1' in popen_args[2])
+        finally:
+            db_replicator.subprocess.Popen = orig_popen
+
+        # a db is rsynced in full only when the remote has none of it
+        rsyncs = []
+        replicator._rsync_file = lambda *args: rsyncs.append(args) or True
+        fake_device = {'ip': '127.0.0.1', 'device': 'sda1'}
+        replicator._rsync_db(FakeBroker(), fake_device, ReplHttp(), 'abcd')
+        self.assertEquals([False], [args[2] for args in rsyncs])
+        # one rsync at a time per device
+        self.assertEquals(replicator._rsync_semaphore('/srv/node/sda/db'),
+                          replicator._rsync_semaphore('/srv/node/sda/db2'))
+        self.assertNotEquals(
+            replicator._rsync_semaphore('/srv/node/sda/db'),
+            replicator._rsync_semaphore('/srv/node/sdb/db'))
+        self.assertEquals(1, replicator._rsync_semaphore(
+            '/srv/node/sda/db').balance)
+
     def test_in_sync(self):
         replicator = TestReplicator({})
         self.assertEquals(replicator._in_sync(
@@ -247,11 +378,116 @@ class TestDBReplicator(unittest.TestCase):
         replicator = TestReplicator({})
         replicator.run_once()
 
+    def test_replicate_devices(self):
+        replicator = TestReplicator({'device_concurrency': '2'})
+        replicator.logger = FakeLogger()
+        replicated = []
+
+        def replicate_dirs(dirs):
+            replicated.extend(dirs)
+            replicator.stats['attempted'] += 10
+            replicator.stats['success'] += dirs[0][1]
+            replicator.stats['pid'] = os.getpid()
+        replicator._replicate_dirs = replicate_dirs
+        replicator._zero_stats()
+        replicator._replicate_devices([('/srv/1', 1), ('/srv/2', 2),
+                                       ('/srv/3', 3)])
+        # each device was replicated by a child process of its own
+        self.assertEquals([], replicated)
+        self.assertEquals(30, replicator.stats['attempted'])
+        self.assertEquals(6, replicator.stats['success'])
+        self.assertNotEquals(os.getpid(), replicator.stats['pid'])
+        self.assertEquals([], replicator.logger.log_dict['exception'])
+
+    def test_replicate_dirs_replicated_index(self):
+        replicator = TestReplicator({})
+        temp_dir = mkdtemp()
+        try:
+            db_files = []
+            for part in ('0', '1'):
+                for hash_ in ('abc1', 'abc2', 'abc3'):
+                    hash_dir = os.path.join(temp_dir, part, 'abc', hash_)
+                    os.makedirs(hash_dir)
+                    db_files.append(os.path.join(hash_dir, hash_ + '.db'))
+                    with open(db_files[-1], 'w') as fp:
+                        fp.write('db')
+            loaded = []
+            written = []
+            load_replicated = replicator._load_replicated
+            replicator._load_replicated = \
+                lambda part_dir: loaded.append(part_dir) or \
+                load_replicated(part_dir)
+            write_replicated = replicator._write_replicated
+            replicator._write_replicated = \
+                lambda part_dir, replicated: written.append(part_dir) or \
+                write_replicated(part_dir, replicated)
+
+            def replicate_object(partition, object_file, node_id):
+                replicator._get_replicated(object_file)
+                replicator._set_replicated(object_file, {'time': 1})
+            replicator._replicate_object = replicate_object
+            replicator._replicate_dirs([(temp_dir, 1)])
+            # each partition's index was loaded and written once
+            part_dirs = [os.path.join(temp_dir, '0'),
+                         os.path.join(temp_dir, '1')]
+            self.assertEquals(part_dirs, sorted(loaded))
+            self.assertEquals(part_dirs, sorted(written))
+            self.assertEquals({}, replicator._replicated)
+            for db_file in db_files:
+                self.assertEquals(['abc1', 'abc2', 'abc3'], sorted(
+                    replicator._get_replicated(db_file).keys()))
+        finally:
+            rmtree(temp_dir)
+
     def test_usync(self):
         fake_http = ReplHttp()
         replicator = TestReplicator({})
         replicator._usync_db(0, FakeBroker(), fake_http, '12345', '67890')
 
+    def test_usync_pipelined(self):
+        calls = []
+
+        class Broker(FakeBroker):
+            def get_items_since(self, point, count):
+                calls.append(('get_items_since', point, count))
+                return [{'ROWID': row}
+                        for row in xrange(point + 1, min(point + count, 50))]
+
+            def merge_syncs(self, syncs, incoming=True):
+                calls.append(('merge_syncs', syncs))
+
+        class Http(ReplHttp):
+            def send_replicate(self, *args):
+                calls.append(('send', args[0], len(args[1])
+                              if args[0] == 'merge_items' else args[1]))
+                return True
+
+        replicator = TestReplicator({'per_diff': '4', 'max_per_diff': '16'})
+        self.assertTrue(replicator._usync_db(0, Broker(), Http(), '12345',
+                                             '67890'))
+        # each batch is read before the response to the one before it, and
+        # the batches grow while the remote server keeps up
+        self.assertEquals(calls, [
+            ('get_items_since', 0, 4), ('send', 'merge_items', 3),
+            ('get_items_since', 3, 4), ('send', 'merge_items', 3),
+            ('get_items_since', 6, 8), ('send', 'merge_items', 7),
+            ('get_items_since', 13, 16), ('send', 'merge_items', 15),
+            ('get_items_since', 28, 16), ('send', 'merge_items', 15),
+            ('get_items_since', 43, 16), ('send', 'merge_items', 6),
+            ('get_items_since', 49, 16), ('send', 'merge_syncs', []),
+            ('merge_syncs', [{'remote_id': '12345', 'sync_point': 49}])])
+
+    def test_next_per_diff(self):
+        replicator = TestReplicator({'per_diff': '100', 'max_per_diff': '400',
+                                     'node_timeout': '8'})
+        self.assertEquals(replicator._next_per_diff(100, 0.5), 200)
+        self.assertEquals(replicator._next_per_diff(300, 0.5), 400)
+        self.assertEquals(replicator._next_per_diff(300, 1.5), 300)
+        self.assertEquals(replicator._next_per_diff(400, 2.5), 200)
+        self.assertEquals(replicator._next_per_diff(150, 9), 100)
+        replicator = TestReplicator({'per_diff': '100'})
+        self.assertEquals(replicator.max_per_diff, 1000)
+
     def test_repl_to_node(self):
         replicator = TestReplicator({})
         fake_node = {'ip': '127.0.0.1', 'device': 'sda1', 'port': 1000}
@@ -278,6 +514,104 @@ class TestDBReplicator(unittest.TestCase):
         replicator._replicate_object('0', '/path/to/file', 'node_id')
         self.assertEquals([], self.delete_db_calls)
 
+    def test_maintain_db_reclaim_index(self):
+        built = []
+
+        class IndexBroker(FakeBroker):
+            def build_reclaim_index(self):
+                built.append(self)
+                if len(built) == 2:
+                    raise Exception('no such table: object')
+                return True
+
+        replicator = TestReplicator({})
+        replicator.logger = FakeLogger()
+        replicator._maintain_db(IndexBroker())
+        self.assertEquals(len(built), 1)
+        self.assertEquals(replicator.logger.log_dict['increment'],
+                          [(('reclaim_index_built',), {})])
+        # errors are logged, not raised
+        replicator._maintain_db(IndexBroker())
+        self.assertEquals(len(built), 2)
+        self.assertEquals(len(replicator.logger.log_dict['exception']), 1)
+        # once the pass's budget is spent the rest wait for the next pass
+        replicator._reclaim_index_time = replicator.reclaim_index_time_budget
+        replicator._maintain_db(IndexBroker())
+        self.assertEquals(len(built), 2)
+        replicator = TestReplicator({'reclaim_index_time_budget': '0'})
+        replicator._maintain_db(IndexBroker())
+        self.assertEquals(len(built), 2)
+
+    def test_replicate_object_unchanged(self):
+        db_replicator.ring = FakeRingWithNodes()
+        replicator = TestReplicator({})
+        replicator.logger = FakeLogger()
+        temp_dir = mkdtemp()
+        try:
+            hash_dir = os.path.join(temp_dir, '0', 'abc', 'abcdef')
+            os.makedirs(hash_dir)
+            db_file = os.path.join(hash_dir, 'abcdef.db')
+            with open(db_file, 'w') as fp:
+                fp.write('db')
+            replicated = []
+            replicator._repl_to_node = \
+                lambda node, *args: replicated.append(node['id']) or True
+
+            class Broker(FakeBroker):
+                get_repl_missing_table = False
+                stub_replication_info = {
+                    'delete_timestamp': 0, 'put_timestamp': 1, 'count': 1,
+                    'max_row': 10, 'hash': 'abc', 'id': 'a', 'created_at': 1}
+            Broker.db_file = db_file
+            replicator.brokerclass = Broker
+            replicator._replicate_object('0', db_file, 1)
+            self.assertEquals([2, 3], replicated)
+            self.assertEquals(0, replicator.stats['unchanged'])
+            self.assertEquals(['abcdef'], replicator._get_replicated(
+                db_file).keys())
+
+            # unchanged, and the peers agree: the db isn't even opened
+            replicator.brokerclass = None
+            synced = []
+
+            def http_connect(node, *args):
+                synced.append(node['id'])
+                return ReplHttp('{"id": "b", "point": 10, "hash": "abc"}')
+            replicator._http_connect = http_connect
+            replicator._replicate_object('0', db_file, 1)
+            self.assertEquals([2, 3], synced)
+            self.assertEquals([2, 3], replicated)
+            self.assertEquals(1, replicator.stats['unchanged'])
+            self.assertEquals(0, replicator.stats['failure'])
+            replicator.brokerclass = Broker
+
+            # a peer that is behind gets the db replicated in full
+            replicator._http_connect = lambda *args: ReplHttp(
+                '{"id": "b", "point": 5, "hash": "abd"}')
+            replicator._replicate_object('0', db_file, 1)
+            self.assertEquals([2, 3, 2, 3], replicated)
+            self.assertEquals(1, replicator.stats['unchanged'])
+
+            # as does a db that changed
+            with open(db_file + '.pending', 'w') as fp:
+                fp.write('pending')
+            replicator._http_connect = http_connect
+            replicator._replicate_object('0', db_file, 1)
+            self.assertEquals([2, 3, 2, 3, 2, 3], replicated)
+            replicator._replicate_object('0', db_file, 1)
+            self.assertEquals(2, replicator.stats['unchanged'])
+
+            # and one not replicated in full for too long
+            replicator.unchanged_recheck_interval = 0.000001
+            replicator._replicate_object('0', db_file, 1)
+            self.assertEquals([2, 3, 2, 3, 2, 3, 2, 3], replicated)
+            self.assertEquals(2, replicator.stats['unchanged'])
+
+            replicator.delete_db(db_file)
+            self.assertEquals({}, replicator._get_replicated(db_file))
+        finally:
+            rmtree(temp_dir)
+
     def test_replicate_object_quarantine(self):
         replicator = TestReplicator({})
         was_db_file = replicator.brokerclass.db_file
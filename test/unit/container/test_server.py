@@ -21,12 +21,14 @@ from StringIO import StringIO
 from time import time
 from tempfile import mkdtemp
 
-from eventlet import spawn, Timeout, listen
+from eventlet import GreenPile, spawn, sleep, Timeout, listen
 import simplejson
 from webob import Request
 
 from swift.container import server as container_server
-from swift.common.utils import normalize_timestamp, mkdirs
+from swift.common.exceptions import LockTimeout
+from swift.common.utils import normalize_timestamp, mkdirs, hash_path, \
+    lock_parent_directory
 
 
 class TestContainerController(unittest.TestCase):
@@ -46,6 +48,274 @@ class TestContainerController(unittest.TestCase):
         """ Tear down for testing swift.object_server.ObjectController """
         rmtree(os.path.dirname(self.testdir), ignore_errors=1)
 
+    def test_PUT_object_group_commit(self):
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        calls = []
+        orig_put_objects = container_server.ContainerBroker.put_objects
+
+        def put_objects(broker, records):
+            calls.append([rec['name'] for rec in records])
+            return orig_put_objects(broker, records)
+
+        def put(name, method='PUT', container='c'):
+            req = Request.blank('/sda1/p/a/%s/%s' % (container, name),
+                environ={'REQUEST_METHOD': method},
+                headers={'X-Timestamp': normalize_timestamp(
+                            method == 'PUT' and 2 or 3),
+                         'X-Size': '0', 'X-Content-Type': 'text/plain',
+                         'X-ETag': 'd41d8cd98f00b204e9800998ecf8427e'})
+            return getattr(self.controller, method)(req).status_int
+
+        container_server.ContainerBroker.put_objects = put_objects
+        try:
+            pile = GreenPile()
+            for name in ('o1', 'o2', 'o3'):
+                pile.spawn(put, name)
+            self.assertEquals(list(pile), [201, 201, 201])
+            self.assertEquals(calls, [['o1', 'o2', 'o3']])
+            self.assertEquals(self.controller.commit_groups, {})
+            del calls[:]
+            # requests for other DBs are not grouped with these
+            req = Request.blank('/sda1/p/a/c2',
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': '1'})
+            self.assertEquals(self.controller.PUT(req).status_int, 201)
+            pile = GreenPile()
+            pile.spawn(put, 'o4')
+            pile.spawn(put, 'o5', 'PUT', 'c2')
+            pile.spawn(put, 'o1', 'DELETE')
+            self.assertEquals(list(pile), [201, 201, 204])
+            self.assertEquals(calls, [['o4', 'o1'], ['o5']])
+        finally:
+            container_server.ContainerBroker.put_objects = orig_put_objects
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'GET',
+                            'QUERY_STRING': 'format=json'})
+        self.assertEquals(
+            [o['name'] for o in
+             simplejson.loads(self.controller.GET(req).body)],
+            ['o2', 'o3', 'o4'])
+
+    def test_PUT_object_group_commit_error(self):
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        orig_put_objects = container_server.ContainerBroker.put_objects
+
+        def put_objects(broker, records):
+            raise Exception('test')
+
+        def put(name):
+            req = Request.blank('/sda1/p/a/c/%s' % name,
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': normalize_timestamp(2),
+                         'X-Size': '0', 'X-Content-Type': 'text/plain',
+                         'X-ETag': 'd41d8cd98f00b204e9800998ecf8427e'})
+            statuses = []
+            self.controller(req.environ,
+                            lambda status, headers: statuses.append(status))
+            return statuses[0]
+
+        container_server.ContainerBroker.put_objects = put_objects
+        try:
+            pile = GreenPile()
+            for name in ('o1', 'o2'):
+                pile.spawn(put, name)
+            self.assertEquals([status[:3] for status in pile],
+                              ['500', '500'])
+            self.assertEquals(self.controller.commit_groups, {})
+        finally:
+            container_server.ContainerBroker.put_objects = orig_put_objects
+
+    def test_PUT_object_group_commit_lock_timeout(self):
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        orig_put_objects = container_server.ContainerBroker.put_objects
+
+        def put_objects(broker, records):
+            raise LockTimeout(None, broker.db_file)
+
+        def put(name):
+            req = Request.blank('/sda1/p/a/c/%s' % name,
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': normalize_timestamp(2),
+                         'X-Size': '0', 'X-Content-Type': 'text/plain',
+                         'X-ETag': 'd41d8cd98f00b204e9800998ecf8427e'})
+            statuses = []
+            self.controller(req.environ,
+                            lambda status, headers: statuses.append(status))
+            return statuses[0]
+
+        container_server.ContainerBroker.put_objects = put_objects
+        try:
+            pile = GreenPile()
+            for name in ('o1', 'o2'):
+                pile.spawn(put, name)
+            with Timeout(2):
+                self.assertEquals([status[:3] for status in pile],
+                                  ['500', '500'])
+            self.assertEquals(self.controller.commit_groups, {})
+        finally:
+            container_server.ContainerBroker.put_objects = orig_put_objects
+
+    def test_PUT_object_group_commit_wait_timeout(self):
+        self.controller.group_commit_timeout = 0.01
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        orig_put_objects = container_server.ContainerBroker.put_objects
+
+        def put_objects(broker, records):
+            sleep(0.1)
+            return orig_put_objects(broker, records)
+
+        def put(name, method='PUT'):
+            req = Request.blank('/sda1/p/a/c/%s' % name,
+                environ={'REQUEST_METHOD': method},
+                headers={'X-Timestamp': normalize_timestamp(2),
+                         'X-Size': '0', 'X-Content-Type': 'text/plain',
+                         'X-ETag': 'd41d8cd98f00b204e9800998ecf8427e'})
+            return getattr(self.controller, method)(req).status_int
+
+        container_server.ContainerBroker.put_objects = put_objects
+        try:
+            pile = GreenPile()
+            pile.spawn(put, 'o1')
+            pile.spawn(put, 'o2')
+            pile.spawn(put, 'o3', 'DELETE')
+            self.assertEquals(list(pile), [201, 503, 503])
+        finally:
+            container_server.ContainerBroker.put_objects = orig_put_objects
+
+    def test_PUT_DELETE_mark_dirty(self):
+        dirty_dir = os.path.join(self.testdir, 'sda1',
+                                 container_server.DIRTYDIR, 'p')
+        dirty_file = os.path.join(dirty_dir, hash_path('a', 'c'))
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        self.assert_(os.path.exists(dirty_file))
+        os.unlink(dirty_file)
+        req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '2', 'X-Size': '0',
+                                     'X-Content-Type': 'text/plain',
+                                     'X-ETag': 'x'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        self.assertEquals([hash_path('a', 'c')], os.listdir(dirty_dir))
+        os.unlink(dirty_file)
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'DELETE'},
+                            headers={'X-Timestamp': '3'})
+        self.assertEquals(self.controller.DELETE(req).status_int, 204)
+        self.assert_(os.path.exists(dirty_file))
+        os.unlink(dirty_file)
+        # a container that can't be marked is still updated
+        os.rmdir(dirty_dir)
+        with open(dirty_dir, 'w'):
+            pass
+        req = Request.blank('/sda1/p/a/c/o2',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '4', 'X-Size': '0',
+                                     'X-Content-Type': 'text/plain',
+                                     'X-ETag': 'x'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+
+    def test_mark_dirty_directory_removed(self):
+        db_file = os.path.join(self.testdir, 'sda1', 'containers', 'p',
+                               'abc', 'abcdef', 'abcdef.db')
+        dirty_dir = os.path.join(self.testdir, 'sda1',
+                                 container_server.DIRTYDIR, 'p')
+        made = []
+
+        def racing_mkdirs(path):
+            # the updater removes the first directory made before the mark
+            # is written into it
+            made.append(path)
+            if len(made) > 1:
+                mkdirs(path)
+        orig_mkdirs = container_server.mkdirs
+        container_server.mkdirs = racing_mkdirs
+        try:
+            container_server.mark_dirty(db_file)
+        finally:
+            container_server.mkdirs = orig_mkdirs
+        self.assertEquals([dirty_dir] * 2, made)
+        self.assertEquals(['abcdef'], os.listdir(dirty_dir))
+
+    def test_GET_merges_pending_entries(self):
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        for name in ('o1', 'o2'):
+            req = Request.blank('/sda1/p/a/c/%s' % name,
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': normalize_timestamp(2),
+                         'X-Size': '3', 'X-Content-Type': 'text/plain',
+                         'X-ETag': 'd41d8cd98f00b204e9800998ecf8427e'})
+            self.assertEquals(self.controller.PUT(req).status_int, 201)
+        broker = self.controller._get_container_broker('sda1', 'p', 'a', 'c')
+        with lock_parent_directory(broker.pending_file):
+            req = Request.blank('/sda1/p/a/c',
+                environ={'REQUEST_METHOD': 'GET',
+                         'QUERY_STRING': 'format=json'})
+            resp = self.controller.GET(req)
+            self.assertEquals(int(resp.headers['x-container-object-count']), 2)
+            self.assertEquals(int(resp.headers['x-container-bytes-used']), 6)
+            self.assertEquals([o['name'] for o in simplejson.loads(resp.body)],
+                              ['o1', 'o2'])
+            req = Request.blank('/sda1/p/a/c',
+                                environ={'REQUEST_METHOD': 'HEAD'})
+            resp = self.controller.HEAD(req)
+            self.assertEquals(int(resp.headers['x-container-object-count']), 2)
+        self.assert_(os.path.getsize(broker.pending_file))
+
+    def test_GET_streamed_listing(self):
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(self.controller.PUT(req).status_int, 201)
+        for name in ('a/1', 'a/2', 'b', 'c/1', 'd', 'e&f'):
+            req = Request.blank('/sda1/p/a/c/%s' % name,
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': normalize_timestamp(2),
+                         'X-Size': '3', 'X-Content-Type': 'text/plain',
+                         'X-ETag': 'd41d8cd98f00b204e9800998ecf8427e'})
+            self.assertEquals(self.controller.PUT(req).status_int, 201)
+        expected = {}
+        for query in ('format=json', 'format=xml', 'format=plain',
+                      'delimiter=/&format=json', 'delimiter=/',
+                      'path=a', 'limit=4&format=xml', 'marker=b&limit=3'):
+            req = Request.blank('/sda1/p/a/c',
+                environ={'REQUEST_METHOD': 'GET', 'QUERY_STRING': query})
+            resp = self.controller.GET(req)
+            self.assertEquals(len(resp.app_iter), 1)
+            expected[query] = resp.body
+        self.controller.listing_page_size = 2
+        for query, body in expected.iteritems():
+            req = Request.blank('/sda1/p/a/c',
+                environ={'REQUEST_METHOD': 'GET', 'QUERY_STRING': query})
+            resp = self.controller.GET(req)
+            self.assertEquals(resp.status_int, 200)
+            if query != 'path=a':   # that one still fits a page
+                self.assertFalse(isinstance(resp.app_iter, list))
+            self.assertEquals(resp.body, body)
+        self.assertEquals(simplejson.loads(expected['delimiter=/&format=json']),
+            [{'subdir': 'a/'}, simplejson.loads(expected['format=json'])[2],
+             {'subdir': 'c/'}] + simplejson.loads(expected['format=json'])[4:])
+        self.assertEquals(expected['path=a'], 'a/1\na/2\n')
+        self.assertEquals(expected['marker=b&limit=3'], 'c/1\nd\ne&f\n')
+        # a listing that fits a page is still sent whole
+        req = Request.blank('/sda1/p/a/c',
+            environ={'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'limit=2'})
+        resp = self.controller.GET(req)
+        self.assertEquals(resp.app_iter, ['a/1\na/2\n'])
+        req = Request.blank('/sda1/p/a/c',
+            environ={'REQUEST_METHOD': 'GET',
+                     'QUERY_STRING': 'marker=z&format=json'})
+        resp = self.controller.GET(req)
+        self.assertEquals(resp.body, '[]')
+
     def test_acl_container(self):
         # Ensure no acl by default
         req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
@@ -88,6 +88,13 @@ class TestContainerSync(unittest.TestCase):
         self.assertEquals(flo.read(), '')
         self.assertEquals(flo.read(2), '')
 
+        # Whole chunks are handed on as they are
+        chunks = ['a' * 10, 'b' * 10]
+        flo = sync._Iter2FileLikeObject(iter(chunks))
+        self.assertTrue(flo.read(10) is chunks[0])
+        self.assertTrue(flo.read(20) is chunks[1])
+        self.assertEquals(flo.read(10), '')
+
     def test_init(self):
         cring = FakeRing()
         oring = FakeRing()
@@ -603,11 +610,86 @@ class TestContainerSync(unittest.TestCase):
             sync.hash_path = orig_hash_path
             sync.delete_object = orig_delete_object
 
+    def test_container_sync_batches(self):
+        cring = FakeRing()
+        oring = FakeRing()
+        cs = sync.ContainerSync({'sync_batch_size': '4', 'concurrency': '3'},
+                                container_ring=cring, object_ring=oring)
+        orig_ContainerBroker = sync.ContainerBroker
+        orig_hash_path = sync.hash_path
+        orig_delete_object = sync.delete_object
+        orig_http_connection = sync.http_connection
+        try:
+            sync.hash_path = lambda *args, **kwargs: '\x00' * 16
+            fetches = []
+            set_calls = []
+
+            class Broker(FakeContainerBroker):
+
+                def get_items_since(self, sync_point, limit):
+                    fetches.append((sync_point, limit))
+                    return FakeContainerBroker.get_items_since(
+                        self, sync_point, limit)
+
+                def set_x_container_sync_points(self, sync_point1,
+                                                sync_point2):
+                    set_calls.append((sync_point1, sync_point2))
+
+            fcb = Broker('path',
+                info={'account': 'a', 'container': 'c',
+                      'x_container_sync_point1': -1,
+                      'x_container_sync_point2': -1},
+                metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                          'x-container-sync-key': ('key', 1)},
+                items_since=[{'ROWID': i, 'name': 'o%d' % i,
+                              'created_at': '1.2', 'deleted': True}
+                             for i in xrange(1, 11)])
+            sync.ContainerBroker = lambda p: fcb
+            made_conns = []
+
+            def fake_http_connection(url, proxy=None):
+                made_conns.append(url)
+                return object(), object()
+
+            deleted = []
+            used_conns = set()
+
+            def fake_delete_object(url, name=None, headers=None,
+                                   http_conn=None, proxy=None):
+                used_conns.add(id(http_conn))
+                if name == 'o7':
+                    raise ClientException('test', http_status=503)
+                deleted.append(name)
+
+            sync.http_connection = fake_http_connection
+            sync.delete_object = fake_delete_object
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.logger = FakeLogger()
+            cs.container_sync('isa.db')
+            self.assertEquals(fetches, [(-1, 4), (4, 4)])
+            # All of the second page was sent, but the sync point stops short
+            # of the row that failed and is only recorded once per page.
+            self.assertEquals(sorted(deleted),
+                              ['o1', 'o2', 'o3', 'o4', 'o5', 'o6', 'o8'])
+            self.assertEquals(set_calls, [(4, None), (6, None)])
+            self.assertEquals(cs.container_failures, 1)
+            self.assertEquals(cs.container_syncs, 0)
+            self.assertTrue(len(made_conns) <= 3)
+            self.assertEquals(len(used_conns), len(made_conns))
+        finally:
+            sync.ContainerBroker = orig_ContainerBroker
+            sync.hash_path = orig_hash_path
+            sync.delete_object = orig_delete_object
+            sync.http_connection = orig_http_connection
+
     def test_container_sync_row_delete(self):
         orig_delete_object = sync.delete_object
         try:
 
-            def fake_delete_object(path, name=None, headers=None, proxy=None):
+            def fake_delete_object(path, name=None, headers=None,
+                                   http_conn=None, proxy=None):
                 self.assertEquals(path, 'http://sync/to/path')
                 self.assertEquals(name, 'object')
                 self.assertEquals(headers,
@@ -626,7 +708,8 @@ class TestContainerSync(unittest.TestCase):
 
             exc = []
 
-            def fake_delete_object(path, name=None, headers=None, proxy=None):
+            def fake_delete_object(path, name=None, headers=None,
+                                   http_conn=None, proxy=None):
                 exc.append(Exception('test exception'))
                 raise exc[-1]
 
@@ -639,7 +722,8 @@ class TestContainerSync(unittest.TestCase):
             self.assertEquals(len(exc), 1)
             self.assertEquals(str(exc[-1]), 'test exception')
 
-            def fake_delete_object(path, name=None, headers=None, proxy=None):
+            def fake_delete_object(path, name=None, headers=None,
+                                   http_conn=None, proxy=None):
                 exc.append(ClientException('test client exception'))
                 raise exc[-1]
 
@@ -652,7 +736,8 @@ class TestContainerSync(unittest.TestCase):
             self.assertEquals(len(exc), 2)
             self.assertEquals(str(exc[-1]), 'test client exception')
 
-            def fake_delete_object(path, name=None, headers=None, proxy=None):
+            def fake_delete_object(path, name=None, headers=None,
+                                   http_conn=None, proxy=None):
                 exc.append(ClientException('test client exception',
                                            http_status=404))
                 raise exc[-1]
@@ -676,7 +761,8 @@ class TestContainerSync(unittest.TestCase):
             sync.shuffle = lambda x: x
 
             def fake_put_object(sync_to, name=None, headers=None,
-                                contents=None, proxy=None):
+                                contents=None, chunk_size=None, http_conn=None,
+                                proxy=None):
                 self.assertEquals(sync_to, 'http://sync/to/path')
                 self.assertEquals(name, 'object')
                 self.assertEquals(headers, {'x-container-sync-key': 'key',
@@ -764,7 +850,8 @@ class TestContainerSync(unittest.TestCase):
                         iter('contents'))
 
             def fake_put_object(sync_to, name=None, headers=None,
-                                contents=None, proxy=None):
+                                contents=None, chunk_size=None, http_conn=None,
+                                proxy=None):
                 raise ClientException('test client exception', http_status=401)
 
             sync.direct_get_object = fake_direct_get_object
@@ -780,7 +867,8 @@ class TestContainerSync(unittest.TestCase):
                                   cs.logger.log_dict['info'][0][0][0]))
 
             def fake_put_object(sync_to, name=None, headers=None,
-                                contents=None, proxy=None):
+                                contents=None, chunk_size=None, http_conn=None,
+                                proxy=None):
                 raise ClientException('test client exception', http_status=404)
 
             sync.put_object = fake_put_object
@@ -795,7 +883,8 @@ class TestContainerSync(unittest.TestCase):
                                   cs.logger.log_dict['info'][0][0][0]))
 
             def fake_put_object(sync_to, name=None, headers=None,
-                                contents=None, proxy=None):
+                                contents=None, chunk_size=None, http_conn=None,
+                                proxy=None):
                 raise ClientException('test client exception', http_status=503)
 
             sync.put_object = fake_put_object
@@ -814,5 +903,147 @@ class TestContainerSync(unittest.TestCase):
             sync.direct_get_object = orig_direct_get_object
 
 
+    def test_container_sync_row_put_replicas(self):
+        orig_shuffle = sync.shuffle
+        orig_put_object = sync.put_object
+        orig_direct_get_object = sync.direct_get_object
+        orig_direct_head_object = sync.direct_head_object
+        try:
+            sync.shuffle = lambda x: x
+            puts = []
+
+            def fake_put_object(sync_to, name=None, headers=None,
+                                contents=None, chunk_size=None, http_conn=None,
+                                proxy=None):
+                puts.append((headers, contents and contents.read()))
+
+            gets = []
+
+            def fake_direct_get_object(node, part, account, container, obj,
+                                       resp_chunk_size=1):
+                gets.append(node['ip'])
+                if len(gets) == 1:
+                    raise ClientException('test', http_status=404)
+                if len(gets) == 2:
+                    return ({'x-timestamp': '1.1'}, iter('old'))
+                return ({'x-timestamp': '1.2', 'etag': 'etagvalue'},
+                        iter('new'))
+
+            sync.put_object = fake_put_object
+            sync.direct_get_object = fake_direct_get_object
+            cs = sync.ContainerSync({}, container_ring=FakeRing(),
+                                    object_ring=FakeRing())
+            # The first replica is missing the object and the second is out
+            # of date, so it is sent from the third.
+            self.assertTrue(cs.container_sync_row({'deleted': False,
+                'name': 'object', 'created_at': '1.2'}, 'http://sync/to/path',
+                'key', FakeContainerBroker('broker'), {'account': 'a',
+                'container': 'c'}))
+            self.assertEquals(gets, ['10.0.0.0', '10.0.0.1', '10.0.0.2'])
+            self.assertEquals(puts, [({'x-container-sync-key': 'key',
+                                       'x-timestamp': '1.2',
+                                       'etag': 'etagvalue'}, 'new')])
+
+            puts = []
+            gets = []
+            large = {'x-timestamp': '1.2', 'etag': 'etagvalue',
+                     'content-length': '65536', 'x-object-meta-a': 'b'}
+
+            def fake_direct_get_object(node, part, account, container, obj,
+                                       resp_chunk_size=1):
+                gets.append('GET')
+                return dict(large), iter(['x' * 65536])
+
+            def fake_direct_head_object(node, part, account, container, obj):
+                gets.append('HEAD')
+                return dict(large)
+
+            sync.direct_get_object = fake_direct_get_object
+            sync.direct_head_object = fake_direct_head_object
+            row = {'deleted': False, 'name': 'object', 'created_at': '1.2',
+                   'etag': 'etagvalue', 'size': 65536}
+            # A large object the other side has never been sent is sent in
+            # full, without trying a copy
+            self.assertTrue(cs.container_sync_row(row, 'http://sync/to/path',
+                'key', FakeContainerBroker('broker'), {'account': 'a',
+                'container': 'c'}))
+            self.assertEquals(gets, ['GET'])
+            self.assertEquals(puts, [({'x-container-sync-key': 'key',
+                                       'x-timestamp': '1.2',
+                                       'x-object-meta-a': 'b',
+                                       'etag': 'etagvalue',
+                                       'content-length': '65536'},
+                                      'x' * 65536)])
+            self.assertEquals(cs.container_puts, 2)
+            # ... and once it has been, an update with the same contents is
+            # copied there, with only a HEAD of the local object
+            puts = []
+            gets = []
+            large['x-timestamp'] = '1.3'
+            self.assertTrue(cs.container_sync_row(dict(row, created_at='1.3'),
+                'http://sync/to/path', 'key', FakeContainerBroker('broker'),
+                {'account': 'a', 'container': 'c'}))
+            self.assertEquals(gets, ['HEAD'])
+            self.assertEquals(puts, [({'x-container-sync-key': 'key',
+                                       'x-timestamp': '1.3',
+                                       'x-object-meta-a': 'b',
+                                       'if-match': 'etagvalue',
+                                       'x-copy-from': 'path/object',
+                                       'x-fresh-metadata': 'true'}, None)])
+            self.assertEquals(cs.container_puts, 3)
+
+            def fake_put_object(sync_to, name=None, headers=None,
+                                contents=None, chunk_size=None, http_conn=None,
+                                proxy=None):
+                if 'x-copy-from' in headers:
+                    raise ClientException('test', http_status=412)
+                puts.append((headers, len(contents.read(chunk_size))))
+
+            sync.put_object = fake_put_object
+            puts = []
+            gets = []
+            # ... and sent in full when it has other contents there
+            self.assertTrue(cs.container_sync_row(row, 'http://sync/to/path',
+                'key', FakeContainerBroker('broker'), {'account': 'a',
+                'container': 'c'}))
+            self.assertEquals(gets, ['HEAD', 'GET'])
+            self.assertEquals(puts, [({'x-container-sync-key': 'key',
+                                       'x-timestamp': '1.2',
+                                       'x-object-meta-a': 'b',
+                                       'etag': 'etagvalue',
+                                       'content-length': '65536'}, 65536)])
+            self.assertEquals(cs.container_puts, 4)
+
+            # static large object manifests are never copied
+            large['x-timestamp'] = '1.5'
+            large['x-static-large-object'] = 'True'
+            puts = []
+            gets = []
+            for created_at in ('1.4', '1.5'):
+                self.assertTrue(cs.container_sync_row(
+                    dict(row, created_at=created_at), 'http://sync/to/path',
+                    'key', FakeContainerBroker('broker'),
+                    {'account': 'a', 'container': 'c'}))
+            self.assertEquals(gets, ['HEAD', 'GET', 'GET'])
+            self.assertEquals([headers.get('x-copy-from')
+                               for headers, length in puts], [None, None])
+
+            # the remembered ETags are bounded
+            cs.remote_etag_cache_size = 1
+            del large['x-static-large-object']
+            for name in ('o1', 'o2'):
+                self.assertTrue(cs.container_sync_row(
+                    dict(row, name=name), 'http://sync/to/path', 'key',
+                    FakeContainerBroker('broker'),
+                    {'account': 'a', 'container': 'c'}))
+            self.assertEquals(cs.remote_etags.keys(),
+                              [('http://sync/to/path', 'o2')])
+        finally:
+            sync.shuffle = orig_shuffle
+            sync.put_object = orig_put_object
+            sync.direct_get_object = orig_direct_get_object
+            sync.direct_head_object = orig_direct_head_object
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -28,7 +28,8 @@ from swift.container import updater as container_updater
 from swift.container import server as container_server
 from swift.common.db import ContainerBroker
 from swift.common.ring import RingData
-from swift.common.utils import normalize_timestamp
+from swift.common.utils import normalize_timestamp, hash_path, \
+    storage_directory, json
 
 
 class TestContainerUpdater(unittest.TestCase):
@@ -152,6 +153,181 @@ class TestContainerUpdater(unittest.TestCase):
         self.assertEquals(info['reported_object_count'], 1)
         self.assertEquals(info['reported_bytes_used'], 3)
 
+    def test_dirty_sweep(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'slowdown': '0',
+            'conn_timeout': '0.1',
+            })
+        db_files = []
+        for container in ('c1', 'c2'):
+            hsh = hash_path('a', container)
+            db_file = os.path.join(self.sda1, storage_directory(
+                container_server.DATADIR, '0', hsh), hsh + '.db')
+            cb = ContainerBroker(db_file, account='a', container=container)
+            cb.initialize(normalize_timestamp(1))
+            db_files.append(db_file)
+        container_server.mark_dirty(db_files[0])
+        dirty_dir = os.path.join(self.sda1, container_server.DIRTYDIR, '0')
+        self.assertEquals([hash_path('a', 'c1')], os.listdir(dirty_dir))
+
+        processed = []
+        orig_process_container = cu.process_container
+        cu.process_container = processed.append
+        cu.device_sweep(self.sda1, False)
+        self.assertEquals([db_files[0]], processed)
+        # the emptied partition directory is removed
+        self.assertFalse(os.path.exists(dirty_dir))
+        cu.device_sweep(self.sda1, False)
+        self.assertEquals([db_files[0]], processed)
+        cu.device_sweep(self.sda1)
+        self.assertEquals(sorted(db_files), sorted(processed[1:]))
+
+        # a container whose report fails is marked again
+        cu.process_container = orig_process_container
+        for dev in cu.get_account_ring().devs:
+            if dev is not None:
+                dev['port'] = 1
+        cu.process_container(db_files[1])
+        self.assertEquals(0, cu.failures)
+        cu.flush_reports()
+        self.assertEquals(1, cu.failures)
+        self.assertEquals([hash_path('a', 'c2')], os.listdir(dirty_dir))
+
+    def test_report_flushing(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'slowdown': '0',
+            'max_pending_reports': '2',
+            })
+        containers_dir = os.path.join(self.sda1, container_server.DATADIR)
+        for account in ('a1', 'a2', 'a3'):
+            subdir = os.path.join(containers_dir, '0', account)
+            os.makedirs(subdir)
+            cb = ContainerBroker(os.path.join(subdir, 'hash.db'),
+                                 account=account, container='c')
+            cb.initialize(normalize_timestamp(1))
+            cb.put_object('o', normalize_timestamp(2), 3, 'text/plain',
+                          '68b329da9893e34099c7d8ad5cb9c940')
+        flushed = []
+
+        def flush_reports(account=None):
+            flushed.append(cu.pending_report_count)
+            cu.pending_reports.clear()
+            cu.pending_report_count = 0
+        cu.flush_reports = flush_reports
+        cu.device_sweep(self.sda1)
+        # after the dirty containers, once max_pending_reports are queued
+        # across accounts, and after the partition
+        self.assertEquals([0, 2, 1], flushed)
+
+    def test_batched_reports(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'slowdown': '0',
+            'node_timeout': '15',
+            'account_update_batch_size': '2',
+            })
+        containers_dir = os.path.join(self.sda1, container_server.DATADIR)
+        brokers = []
+        for container in ('c1', 'c2', 'c3'):
+            # reports are sent after each partition, so batches only form
+            # within one
+            subdir = os.path.join(containers_dir, '0', container)
+            os.makedirs(subdir)
+            cb = ContainerBroker(os.path.join(subdir, 'hash.db'), account='a',
+                                 container=container)
+            cb.initialize(normalize_timestamp(1))
+            cb.put_object('o', normalize_timestamp(2), 3, 'text/plain',
+                          '68b329da9893e34099c7d8ad5cb9c940')
+            brokers.append(cb)
+        requests = []
+
+        def accept(sock, addr, update_status):
+            try:
+                with Timeout(3):
+                    inc = sock.makefile('rb')
+                    out = sock.makefile('wb')
+                    request_line = inc.readline()
+                    headers = {}
+                    line = inc.readline()
+                    while line and line != '\r\n':
+                        headers[line.split(':')[0].lower()] = \
+                            line.split(':')[1].strip()
+                        line = inc.readline()
+                    body = inc.read(int(headers.get('content-length', 0)))
+                    requests.append((request_line, body))
+                    status = 201
+                    if request_line.startswith('UPDATE'):
+                        status = update_status
+                    out.write('HTTP/1.1 %d OK\r\nContent-Length: 0\r\n\r\n'
+                              % status)
+                    out.flush()
+            except BaseException, err:
+                import traceback
+                traceback.print_exc()
+                return err
+            return None
+        bindsock = listen(('127.0.0.1', 0))
+
+        def spawn_accepts(count, update_status):
+            events = []
+            for _junk in xrange(count):
+                sock, addr = bindsock.accept()
+                events.append(spawn(accept, sock, addr, update_status))
+            return events
+        for dev in cu.get_account_ring().devs:
+            if dev is not None:
+                dev['port'] = bindsock.getsockname()[1]
+
+        # one UPDATE per account server for a full batch, a PUT for the rest
+        spawned = spawn(spawn_accepts, 4, 202)
+        cu.run_once()
+        for event in spawned.wait():
+            err = event.wait()
+            if err:
+                raise err
+        self.assertEquals(3, cu.successes)
+        self.assertEquals(
+            ['PUT /sda1/0/a/', 'PUT /sda1/0/a/',
+             'UPDATE /sda1/0/a HTTP/1.1\r\n',
+             'UPDATE /sda1/0/a HTTP/1.1\r\n'],
+            sorted(line if line.startswith('UPDATE') else line[:14]
+                   for line, body in requests))
+        for line, body in requests:
+            if line.startswith('UPDATE'):
+                records = json.loads(body)
+                self.assertEquals(2, len(records))
+                self.assertEquals([1, 1],
+                                  [rec['object_count'] for rec in records])
+        for cb in brokers:
+            self.assertEquals(1, cb.get_info()['reported_object_count'])
+
+        # an account server without UPDATE gets a PUT for each container
+        del requests[:]
+        for cb in brokers:
+            cb.put_object('o2', normalize_timestamp(3), 3, 'text/plain',
+                          '68b329da9893e34099c7d8ad5cb9c940')
+        spawned = spawn(spawn_accepts, 8, 405)
+        cu.run_once()
+        for event in spawned.wait():
+            err = event.wait()
+            if err:
+                raise err
+        self.assertEquals(3, cu.successes)
+        self.assertEquals(2, len([line for line, body in requests
+                                  if line.startswith('UPDATE')]))
+        self.assertEquals(6, len([line for line, body in requests
+                                  if line.startswith('PUT')]))
+        for cb in brokers:
+            self.assertEquals(2, cb.get_info()['reported_object_count'])
+
     def test_unicode(self):
         cu = container_updater.ContainerUpdater({
             'devices': self.devices_dir,
@@ -24,6 +24,8 @@ from time import gmtime, sleep, strftime, time
 from tempfile import mkdtemp
 from hashlib import md5
 
+import simplejson
+
 from eventlet import sleep, spawn, wsgi, listen, Timeout
 from webob import Request
 from test.unit import FakeLogger
@@ -1982,6 +1984,55 @@ class TestObjectController(unittest.TestCase):
         finally:
             object_server.time.time = orig_time
 
+    def test_BULK_DELETE(self):
+        for obj in ('o1', 'o2'):
+            req = Request.blank('/sda1/p/a/c/' + obj,
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': normalize_timestamp(1),
+                         'Content-Length': '4',
+                         'Content-Type': 'application/octet-stream'})
+            req.body = 'TEST'
+            resp = self.object_controller.PUT(req)
+            self.assertEquals(resp.status_int, 201)
+        given_args = []
+
+        def fake_async_update(*args):
+            given_args.append(args)
+
+        self.object_controller.async_update = fake_async_update
+
+        def entry(part, obj):
+            return {'partition': part, 'account': 'a', 'container': 'c',
+                    'obj': obj, 'container_host': '1.2.3.4:5',
+                    'container_partition': '6', 'container_device': 'sdb'}
+        body = simplejson.dumps([entry('p', 'o1'), entry('p', 'o3'),
+                                 entry('p', u'o\u2603'), entry('p', 'o2')])
+        req = Request.blank('/sda1', environ={'REQUEST_METHOD': 'BULK_DELETE'},
+                            body=body)
+        resp = self.object_controller.BULK_DELETE(req)
+        self.assertEquals(resp.status_int, 400)
+        req = Request.blank('/sda1', environ={'REQUEST_METHOD': 'BULK_DELETE'},
+                            headers={'X-Timestamp': normalize_timestamp(2)},
+                            body='[{"partition": "p"}]')
+        resp = self.object_controller.BULK_DELETE(req)
+        self.assertEquals(resp.status_int, 400)
+        req = Request.blank('/sda1', environ={'REQUEST_METHOD': 'BULK_DELETE'},
+                            headers={'X-Timestamp': normalize_timestamp(2)},
+                            body=body)
+        resp = self.object_controller.BULK_DELETE(req)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(simplejson.loads(resp.body), [204, 404, 404, 204])
+        for obj in ('o1', 'o2'):
+            req = Request.blank('/sda1/p/a/c/' + obj)
+            resp = self.object_controller.GET(req)
+            self.assertEquals(resp.status_int, 404)
+        self.assertEquals(
+            [('DELETE', 'a', 'c', obj, '1.2.3.4:5', '6', 'sdb',
+              {'x-timestamp': normalize_timestamp(2), 'x-trans-id': '-'},
+              'sda1')
+             for obj in ('o1', 'o3', 'o\xe2\x98\x83', 'o2')],
+            given_args)
+
     def test_DELETE_if_delete_at(self):
         test_time = time() + 10000
         req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
@@ -44,14 +44,16 @@ from swift.account import server as account_server
 from swift.container import server as container_server
 from swift.obj import server as object_server
 from swift.common import ring
-from swift.common.exceptions import ChunkReadTimeout
+from swift.common.exceptions import ChunkReadTimeout, \
+    ListingIterNotAuthorized, ListingIterNotFound
 from swift.common.constraints import MAX_META_NAME_LENGTH, \
     MAX_META_VALUE_LENGTH, MAX_META_COUNT, MAX_META_OVERALL_SIZE, MAX_FILE_SIZE
 from swift.common.utils import mkdirs, normalize_timestamp, NullLogger
 from swift.common.wsgi import monkey_patch_mimetools
-from swift.proxy.controllers.obj import SegmentedIterable
+from swift.proxy.controllers.obj import SegmentedIterable, \
+    StaticSegmentedIterable
 from swift.proxy.controllers.base import get_container_memcache_key, \
-    get_account_memcache_key
+    get_account_memcache_key, get_manifest_listing_memcache_key
 import swift.proxy.controllers
 
 # mocks
@@ -546,7 +548,7 @@ class TestController(unittest.TestCase):
 
         with save_globals():
             headers = {'x-container-read': self.read_acl,
-                'x-container-write': self.write_acl}
+                'x-container-write': self.write_acl, 'x-put-timestamp': '1'}
             proxy_server.Controller.account_info = account_info
             set_http_connect(200, headers=headers)
             ret = self.controller.container_info(self.account,
@@ -558,6 +560,7 @@ class TestController(unittest.TestCase):
             cache_value = self.memcache.get(cache_key)
             self.assertTrue(isinstance(cache_value, dict))
             self.assertEquals(200, cache_value.get('status'))
+            self.assertEquals('1', cache_value.get('put_timestamp'))
 
             set_http_connect()
             ret = self.controller.container_info(self.account,
@@ -602,6 +605,294 @@ class TestController(unittest.TestCase):
             test(404, 507, 503)
             test(503, 503, 503)
 
+    def test_info_local_cache(self):
+        self.controller.app.info_cache = proxy_server.InfoCache(30)
+        with save_globals():
+            set_http_connect(200)
+            self.controller.account_info(self.account)
+            self.memcache.store = {}
+            set_http_connect()
+            partition, nodes, count = \
+                self.controller.account_info(self.account)
+            self.check_account_info_return(partition, nodes)
+            self.assertEquals(count, 12345)
+
+            headers = {'x-container-read': self.read_acl,
+                       'x-container-write': self.write_acl}
+            set_http_connect(200, headers=headers)
+            self.controller.container_info(self.account, self.container)
+            self.memcache.store = {}
+            set_http_connect()
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.check_container_info_return(ret)
+
+            cache_key = get_container_memcache_key(self.account,
+                                                   self.container)
+            self.controller._delete_cached_info(cache_key)
+            set_http_connect(404, 404, 404)
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.check_container_info_return(ret, True)
+
+    def test_info_coalesced(self):
+        logger = FakeLogger()
+        self.controller.app.logger = logger
+        connects = []
+
+        def slow_connect(*args, **kwargs):
+            connects.append(args)
+            sleep(0.01)
+
+        def account_info(self, account, autocreate=False):
+            return True, True, 0
+
+        with save_globals():
+            proxy_server.Controller.account_info = account_info
+            headers = {'x-container-read': self.read_acl,
+                       'x-container-write': self.write_acl}
+            sets = []
+            memcache_set = self.memcache.set
+            self.memcache.set = lambda key, *args, **kwargs: \
+                sets.append(key) or memcache_set(key, *args, **kwargs)
+            set_http_connect(200, headers=headers, give_connect=slow_connect)
+            threads = [spawn(self.controller.container_info, self.account,
+                             self.container) for _junk in xrange(3)]
+            for thread in threads:
+                self.check_container_info_return(thread.wait())
+            self.assertEquals(len(connects), 1)
+            # only the greenthread that did the lookup cached it
+            self.assertEquals(sets, [get_container_memcache_key(
+                self.account, self.container)])
+            self.assertEquals(logger.log_dict['increment'],
+                [(('container_info.coalesced',), {})] * 2)
+            self.assertEquals(len(logger.log_dict['timing_since']), 2)
+
+    def test_container_info_stale_while_revalidate(self):
+        def account_info(self, account, autocreate=False):
+            return True, True, 0
+
+        self.controller.app.container_stale_time = 60
+        cache_key = get_container_memcache_key(self.account, self.container)
+        with save_globals():
+            proxy_server.Controller.account_info = account_info
+            headers = {'x-container-read': self.read_acl,
+                       'x-container-write': self.write_acl}
+            set_http_connect(200, headers=headers)
+            self.controller.container_info(self.account, self.container)
+            self.assert_(self.memcache.get(cache_key)['expires'] > time())
+
+            self.memcache.get(cache_key)['expires'] = time() - 1
+            set_http_connect(200, headers={'x-container-read': 'new_acl',
+                                           'x-container-write': 'new_acl'})
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.check_container_info_return(ret)
+            sleep()
+            self.assertEquals(self.memcache.get(cache_key)['read_acl'],
+                              'new_acl')
+            self.assert_(self.memcache.get(cache_key)['expires'] > time())
+
+            # a failed refresh keeps the stale info only with a backoff
+            self.memcache.get(cache_key)['expires'] = time() - 1
+            set_http_connect(503, 503, 503)
+            self.controller.container_info(self.account, self.container)
+            sleep()
+            self.assert_(self.memcache.get(cache_key)['expires'] < time())
+            self.controller.app.container_error_backoff = 10
+            set_http_connect(503, 503, 503)
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.assertEquals(ret[2], 'new_acl')
+            sleep()
+            cache_value = self.memcache.get(cache_key)
+            self.assertEquals(cache_value['read_acl'], 'new_acl')
+            self.assert_(cache_value['expires'] > time())
+
+    def test_container_info_stale_refreshed_once(self):
+        connects = []
+
+        def account_info(self, account, autocreate=False):
+            return True, True, 0
+
+        def give_connect(*args, **kwargs):
+            connects.append(args)
+
+        self.controller.app.container_stale_time = 60
+        cache_key = get_container_memcache_key(self.account, self.container)
+        with save_globals():
+            proxy_server.Controller.account_info = account_info
+            headers = {'x-container-read': self.read_acl,
+                       'x-container-write': self.write_acl}
+            set_http_connect(200, headers=headers)
+            self.controller.container_info(self.account, self.container)
+            self.memcache.get(cache_key)['expires'] = time() - 1
+            # requests that see the stale info before the refresh has had
+            # a chance to run do not spawn refreshes of their own
+            set_http_connect(200, 200, headers=headers,
+                             give_connect=give_connect)
+            for _junk in xrange(2):
+                self.check_container_info_return(
+                    self.controller.container_info(self.account,
+                                                   self.container))
+            sleep()
+            self.assertEquals(len(connects), 1)
+            self.assertEquals(self.controller.app.info_cache._refreshes,
+                              set())
+
+    def test_container_info_error_backoff(self):
+        connects = []
+
+        def account_info(self, account, autocreate=False):
+            return True, True, 0
+
+        def give_connect(*args, **kwargs):
+            connects.append(args)
+
+        self.controller.app.container_error_backoff = 10
+        cache_key = get_container_memcache_key(self.account, self.container)
+        with save_globals():
+            proxy_server.Controller.account_info = account_info
+            set_http_connect(503, 404, 404)
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.check_container_info_return(ret, True)
+            self.assertEquals(self.memcache.get(cache_key)['status'], -1)
+
+            set_http_connect(give_connect=give_connect)
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.check_container_info_return(ret, True)
+            self.assertEquals(connects, [])
+
+    def test_concurrent_info_lookups(self):
+        self.controller.app.concurrent_info_lookups = True
+        connects = []
+
+        def give_connect(*args, **kwargs):
+            connects.append(args)
+
+        with save_globals():
+            set_http_connect(404, 200, 404, give_connect=give_connect)
+            partition, nodes, count = \
+                self.controller.account_info(self.account)
+            self.check_account_info_return(partition, nodes)
+            self.assertEquals(count, 12345)
+            self.assertEquals(len(connects), 3)
+
+            for statuses, expected in (((503, 404, 404), -1),
+                                       ((404, 404, 503), -1),
+                                       ((404, 507, 404), 404),
+                                       ((503, 503, 503), -1),
+                                       ((404, 404, 404), 404)):
+                set_http_connect(*statuses)
+                self.assertEquals(self.controller._info_heads(
+                    partition, nodes, self.account_ring, '/a', 'Account',
+                    'error')[0], expected)
+
+    def test_concurrent_info_lookups_staggered(self):
+        self.controller.app.concurrent_info_lookups = True
+        self.controller.app.info_lookup_stagger = 0.01
+        connects = []
+
+        def give_connect(*args, **kwargs):
+            connects.append(args)
+            if len(connects) == 1:
+                sleep(0.1)
+
+        def account_info(self, account, autocreate=False):
+            return True, True, 0
+
+        with save_globals():
+            proxy_server.Controller.account_info = account_info
+            headers = {'x-container-read': self.read_acl,
+                       'x-container-write': self.write_acl}
+            set_http_connect(200, 200, 200, headers=headers,
+                             give_connect=give_connect)
+            start = time()
+            ret = self.controller.container_info(self.account,
+                                                 self.container)
+            self.assert_(time() - start < 0.1)
+            self.check_container_info_return(ret)
+            self.assertEquals(len(connects), 2)
+            sleep(0.1)
+
+
+class TestInfoCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = proxy_server.InfoCache(10)
+        self.assertEquals(cache.get('a'), None)
+        cache.set('a', {'status': 200})
+        self.assertEquals(cache.get('a'), {'status': 200})
+        cache.delete('a')
+        self.assertEquals(cache.get('a'), None)
+        cache.set('a', {'status': 200}, 0.001)
+        sleep(0.01)
+        self.assertEquals(cache.get('a'), None)
+
+    def test_disabled(self):
+        cache = proxy_server.InfoCache(0)
+        cache.set('a', {'status': 200})
+        self.assertEquals(cache.get('a'), None)
+
+    def test_timeout_capped_by_cache_time(self):
+        cache = proxy_server.InfoCache(0.001)
+        cache.set('a', {'status': 200}, 60)
+        sleep(0.01)
+        self.assertEquals(cache.get('a'), None)
+
+    def test_prune(self):
+        cache = proxy_server.InfoCache(10, max_entries=2)
+        cache.set('a', 1, 0.001)
+        cache.set('b', 2)
+        sleep(0.01)
+        cache.set('c', 3)
+        self.assertEquals(sorted(cache._entries), ['b', 'c'])
+        cache.set('d', 4)
+        self.assertEquals(sorted(cache._entries), ['d'])
+
+    def test_coalesce(self):
+        cache = proxy_server.InfoCache()
+        calls = []
+
+        def lookup():
+            calls.append(1)
+            sleep(0.01)
+            return 'value'
+
+        threads = [spawn(cache.coalesce, 'a', lookup) for _junk in xrange(3)]
+        results = [thread.wait() for thread in threads]
+        self.assertEquals(results, [('value', False), ('value', True),
+                                    ('value', True)])
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(cache.coalesce('a', lookup), ('value', False))
+        self.assertEquals(len(calls), 2)
+
+    def test_refresh(self):
+        cache = proxy_server.InfoCache()
+        self.assertTrue(cache.start_refresh('a'))
+        self.assertFalse(cache.start_refresh('a'))
+        cache.end_refresh('a')
+        self.assertTrue(cache.start_refresh('a'))
+
+    def test_coalesce_failure(self):
+        cache = proxy_server.InfoCache()
+        calls = []
+
+        def lookup():
+            calls.append(1)
+            sleep(0.01)
+            if len(calls) == 1:
+                raise Exception('boom')
+            return 'value'
+
+        threads = [spawn(cache.coalesce, 'a', lookup) for _junk in xrange(2)]
+        self.assertRaises(Exception, threads[0].wait)
+        self.assertEquals(threads[1].wait(), ('value', False))
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(cache._lookups, {})
+
 
 class TestProxyServer(unittest.TestCase):
 
@@ -619,6 +910,14 @@ class TestProxyServer(unittest.TestCase):
         resp = app.handle_request(req)
         self.assertEquals(resp.status_int, 500)
 
+    def test_container_info_times(self):
+        baseapp = proxy_server.Application({'container_stale_time': '2.5',
+                                            'container_error_backoff': '0.5'},
+            FakeMemcache(), container_ring=FakeRing(), object_ring=FakeRing(),
+            account_ring=FakeRing())
+        self.assertEquals(baseapp.container_stale_time, 2.5)
+        self.assertEquals(baseapp.container_error_backoff, 0.5)
+
     def test_internal_method_request(self):
         baseapp = proxy_server.Application({},
             FakeMemcache(), container_ring=FakeRing(), object_ring=FakeRing(),
@@ -3311,6 +3610,165 @@ class TestObjectController(unittest.TestCase):
         sock.close()
         self.assertEquals(before_request_instances, _request_instances)
 
+    def test_static_large_object(self):
+        prosrv = _test_servers[0]
+
+        def make_req(path, method, body=None, headers=None):
+            req = Request.blank(path, environ={'REQUEST_METHOD': method},
+                                headers=headers or {})
+            if body is not None:
+                req.body = body
+            return req.get_response(prosrv)
+
+        for name, body in (('slo_seg1', 'aaa'), ('slo_seg2', 'bbbb')):
+            resp = make_req('/v1/a/c/%s' % name, 'PUT', body,
+                            {'Content-Type': 'application/octet-stream'})
+            self.assertEquals(resp.status_int, 201)
+        manifest = [{'path': '/c/slo_seg1', 'etag': md5('aaa').hexdigest(),
+                     'size_bytes': 3},
+                    {'path': '/c/slo_seg2', 'etag': md5('bbbb').hexdigest(),
+                     'size_bytes': 4}]
+        slo_etag = md5(md5('aaa').hexdigest() +
+                       md5('bbbb').hexdigest()).hexdigest()
+
+        bad = [dict(manifest[0], etag='nope'), manifest[1]]
+        resp = make_req('/v1/a/c/slo?multipart-manifest=put', 'PUT',
+                        simplejson.dumps(bad))
+        self.assertEquals(resp.status_int, 400)
+        self.assert_('/c/slo_seg1: etag' in resp.body)
+        resp = make_req('/v1/a/c/slo?multipart-manifest=put', 'PUT',
+                        'not json')
+        self.assertEquals(resp.status_int, 400)
+        resp = make_req('/v1/a/c/slo?multipart-manifest=put', 'PUT',
+                        simplejson.dumps(manifest), {'Etag': 'wrong'})
+        self.assertEquals(resp.status_int, 422)
+
+        resp = make_req('/v1/a/c/slo?multipart-manifest=put', 'PUT',
+                        simplejson.dumps(manifest),
+                        {'Content-Type': 'text/jibberish'})
+        self.assertEquals(resp.status_int, 201)
+
+        resp = make_req('/v1/a/c/slo', 'GET')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, 'aaabbbb')
+        self.assertEquals(resp.headers['X-Static-Large-Object'], 'True')
+        self.assertEquals(resp.headers['Content-Type'], 'text/jibberish')
+        self.assertEquals(resp.etag, slo_etag)
+
+        resp = make_req('/v1/a/c/slo', 'GET', headers={'Range': 'bytes=2-4'})
+        self.assertEquals(resp.status_int, 206)
+        self.assertEquals(resp.body, 'abb')
+        resp = make_req('/v1/a/c/slo', 'GET', headers={'Range': 'bytes=4-'})
+        self.assertEquals(resp.status_int, 206)
+        self.assertEquals(resp.body, 'bbb')
+
+        resp = make_req('/v1/a/c/slo', 'HEAD')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_length, 7)
+        self.assertEquals(resp.etag, slo_etag)
+
+        resp = make_req('/v1/a/c/slo?multipart-manifest=get', 'GET')
+        self.assertEquals(resp.status_int, 200)
+        stored = simplejson.loads(resp.body)
+        self.assertEquals([(s['name'], s['bytes'], s['hash'])
+                           for s in stored],
+                          [('/c/slo_seg1', 3, md5('aaa').hexdigest()),
+                           ('/c/slo_seg2', 4, md5('bbbb').hexdigest())])
+
+        # the manifest survives a POST
+        resp = make_req('/v1/a/c/slo', 'POST',
+                        headers={'X-Object-Meta-Color': 'blue'})
+        self.assertEquals(resp.status_int, 202)
+        resp = make_req('/v1/a/c/slo', 'GET')
+        self.assertEquals(resp.body, 'aaabbbb')
+        self.assertEquals(resp.headers['X-Object-Meta-Color'], 'blue')
+
+        # clients can't mark plain objects as manifests
+        resp = make_req('/v1/a/c/slo_seg1', 'POST',
+                        headers={'X-Static-Large-Object': 'True'})
+        self.assertEquals(resp.status_int, 202)
+        resp = make_req('/v1/a/c/slo_seg1', 'GET')
+        self.assertEquals(resp.body, 'aaa')
+        self.assert_('X-Static-Large-Object' not in resp.headers)
+
+    def test_manifest_listing_cache(self):
+        listing = [{'name': 'seg/1', 'bytes': 1, 'hash': 'x',
+                    'last_modified': '2012-01-01T00:00:00.000000'}]
+        calls = []
+
+        def listing_iter(lcontainer, lprefix, env):
+            calls.append((lcontainer, lprefix))
+            return iter(listing)
+
+        container_infos = {'lc': {'status': 200, 'read_acl': 'read_acl',
+                                  'write_acl': None,
+                                  'put_timestamp': '1.00000'}}
+
+        def _container_info(account, container, account_autocreate=False):
+            return 1, [{}], container_infos[container]
+
+        controller = proxy_server.ObjectController(self.app, 'a', 'c', 'o')
+        controller._listing_iter = listing_iter
+        controller._container_info = _container_info
+        self.app.memcache.store = {}
+        self.app.logger = FakeLogger()
+
+        # disabled by default
+        self.assertEquals(
+            controller._manifest_listing('lc', 'seg/', {}), listing)
+        self.assertEquals(
+            controller._manifest_listing('lc', 'seg/', {}), listing)
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(self.app.memcache.keys(), [])
+
+        calls[:] = []
+        self.app.manifest_listing_cache_time = 10
+        self.assertEquals(
+            controller._manifest_listing('lc', 'seg/', {}), listing)
+        self.assertEquals(
+            controller._manifest_listing('lc', 'seg/', {}), listing)
+        self.assertEquals(calls, [('lc', 'seg/')])
+        cache_key = get_manifest_listing_memcache_key('a', 'lc', '1.00000',
+                                                      'seg/')
+        self.assertEquals(self.app.memcache.get(cache_key), listing)
+        self.assertEquals([args[0] for args, kwargs in
+                           self.app.logger.log_dict['increment']],
+            ['manifest_listing.cache_miss', 'manifest_listing.cache_hit'])
+
+        # a different prefix isn't served from the cache
+        controller._manifest_listing('lc', 'other/', {})
+        self.assertEquals(calls, [('lc', 'seg/'), ('lc', 'other/')])
+
+        # a recreated segment container gets a fresh listing
+        container_infos['lc'] = dict(container_infos['lc'],
+                                     put_timestamp='2.00000')
+        controller._manifest_listing('lc', 'seg/', {})
+        self.assertEquals(len(calls), 3)
+
+        # cached listings still get authorized against the read acl
+        acls = []
+
+        def authorize(req):
+            acls.append(req.acl)
+            return HTTPUnauthorized(request=req)
+
+        self.assertRaises(ListingIterNotAuthorized,
+            controller._manifest_listing, 'lc', 'seg/',
+            {'swift.authorize': authorize})
+        self.assertEquals(acls, ['read_acl'])
+        self.assertEquals(len(calls), 3)
+
+    def test_manifest_listing_cache_missing_container(self):
+        def _container_info(account, container, account_autocreate=False):
+            return 1, [{}], None
+
+        controller = proxy_server.ObjectController(self.app, 'a', 'c', 'o')
+        controller._container_info = _container_info
+        self.app.manifest_listing_cache_time = 10
+        self.assertRaises(ListingIterNotFound, controller._manifest_listing,
+                          'lc', 'seg/', {})
+
+
 class TestContainerController(unittest.TestCase):
     "Test swift.proxy_server.ContainerController"
 
@@ -3760,6 +4218,64 @@ class TestContainerController(unittest.TestCase):
             self.assertEquals(res.content_length, 0)
             self.assertTrue('transfer-encoding' not in res.headers)
 
+    def test_GETorHEAD_caches_info(self):
+        cache_key = get_container_memcache_key('account', 'container')
+        with save_globals():
+            controller = proxy_server.ContainerController(self.app, 'account',
+                                                          'container')
+            for method in ('GET', 'HEAD'):
+                self.app.memcache.store = {}
+                set_http_connect(200, 204, 204, 204, headers={
+                    'x-put-timestamp': '1234.56789',
+                    'x-container-object-count': '5'})
+                req = Request.blank('/a/c', {'REQUEST_METHOD': method})
+                self.app.update_request(req)
+                getattr(controller, method)(req)
+                info = self.app.memcache.get(cache_key)
+                self.assertEquals(info['status'], 200)
+                self.assertEquals(info['put_timestamp'], '1234.56789')
+                self.assertEquals(info['container_size'], '5')
+
+            self.app.memcache.store = {}
+            set_http_connect(200, 404, 404, 404)
+            req = Request.blank('/a/c')
+            self.app.update_request(req)
+            controller.GET(req)
+            self.assertEquals(self.app.memcache.get(cache_key)['status'], 404)
+            # errors are only cached with container_error_backoff
+            self.app.memcache.store = {}
+            set_http_connect(200, 503, 503, 503)
+            req = Request.blank('/a/c')
+            self.app.update_request(req)
+            controller.GET(req)
+            self.assertEquals(self.app.memcache.get(cache_key), None)
+
+            # the entry is written as container_info writes it
+            self.app.container_stale_time = 60
+            self.app.container_error_backoff = 10
+            set_http_connect(200, 200, 200, 200, headers={
+                'x-container-read': 'acl'})
+            req = Request.blank('/a/c')
+            self.app.update_request(req)
+            controller.GET(req)
+            info = self.app.memcache.get(cache_key)
+            self.assert_(info['expires'] > time())
+            self.assertEquals(info['read_acl'], 'acl')
+            # the account info is cached by now
+            set_http_connect(503, 503, 503)
+            req = Request.blank('/a/c')
+            self.app.update_request(req)
+            controller.GET(req)
+            info = self.app.memcache.get(cache_key)
+            self.assertEquals(info['status'], 200)
+            self.assertEquals(info['read_acl'], 'acl')
+            self.app.memcache.store = {}
+            set_http_connect(200, 503, 503, 503)
+            req = Request.blank('/a/c')
+            self.app.update_request(req)
+            controller.GET(req)
+            self.assertEquals(self.app.memcache.get(cache_key)['status'], -1)
+
     def test_GET_calls_authorize(self):
         called = [False]
 
@@ -4139,6 +4655,8 @@ class FakeObjectController(object):
         self.node_timeout = 1
         self.rate_limit_after_segment = 3
         self.rate_limit_segments_per_sec = 2
+        self.slo_segment_concurrency = 2
+        self.thread_locals = None
 
     def exception(self, *args):
         self.exception_args = args
@@ -4155,6 +4673,8 @@ class FakeObjectController(object):
                 (start, stop) = r
                 body = data[start:stop]
         resp = Response(app_iter=iter(body))
+        resp.content_length = len(body)
+        resp.etag = md5(data).hexdigest()
         return resp
 
     def iter_nodes(self, partition, nodes, ring):
@@ -4401,6 +4921,111 @@ class TestSegmentedIterable(unittest.TestCase):
         self.assertEquals(''.join(segit.app_iter_range(5, 7)), '34')
 
 
+class TestStaticSegmentedIterable(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = FakeObjectController()
+        self.listing = [self.segment('/lc/o1', 1),
+                        self.segment('/lc/o2', 2),
+                        self.segment('/lc2/o3', 3),
+                        self.segment('/lc2/o4', 4),
+                        self.segment('/lc/o5', 5)]
+
+    def segment(self, name, size):
+        return {'name': name, 'bytes': size,
+                'hash': md5(name[-1] * size).hexdigest()}
+
+    def test_iter(self):
+        segit = StaticSegmentedIterable(self.controller, self.listing)
+        segit.response = Stub()
+        self.assertEquals(''.join(segit), '122333444455555')
+        self.assertEquals(self.controller.GETorHEAD_base_args[4], '/a/lc/o5')
+        self.assertEquals(segit.length, 15)
+
+    def test_iter_with_no_segments(self):
+        segit = StaticSegmentedIterable(self.controller, [])
+        self.assertEquals(''.join(segit), '')
+
+    def test_prefetches_next_segments(self):
+        paths = []
+
+        def GETorHEAD_base(*args):
+            paths.append(args[4])
+            return FakeObjectController.GETorHEAD_base(self.controller, *args)
+
+        self.controller.GETorHEAD_base = GETorHEAD_base
+        segit = StaticSegmentedIterable(self.controller, self.listing)
+        segit._load_next_segment()
+        sleep()
+        self.assertEquals(paths, ['/a/lc/o1', '/a/lc/o2'])
+        self.assertEquals(len(segit.prefetched), 1)
+        segit._load_next_segment()
+        sleep()
+        self.assertEquals(paths, ['/a/lc/o1', '/a/lc/o2', '/a/lc2/o3'])
+
+    def test_get_error(self):
+
+        def local_GETorHEAD_base(*args):
+            return HTTPNotFound()
+
+        self.controller.GETorHEAD_base = local_GETorHEAD_base
+        self.assertRaises(Exception, ''.join,
+            StaticSegmentedIterable(self.controller, self.listing))
+        self.assertEquals(str(self.controller.exception_info[1]),
+            'Could not load object segment /a/lc/o1: 404')
+
+    def test_segment_changed(self):
+        for changed in (self.segment('/lc/o2', 3),
+                        dict(self.segment('/lc/o2', 2), hash='bad')):
+            listing = list(self.listing)
+            listing[1] = changed
+            segit = StaticSegmentedIterable(self.controller, listing)
+            segit.response = Stub()
+            chunks = []
+            # what came before is sent, then the response stops short
+            self.assertRaises(Exception, lambda: [
+                chunks.append(chunk) for chunk in segit])
+            self.assertEquals(''.join(chunks), '1')
+            self.assert_(str(self.controller.exception_info[1]).startswith(
+                'Object segment /a/lc/o2 no longer matches the manifest'))
+            self.assertEquals(segit.response.status_int, 503)
+        # ranges are checked against what is left of the segment
+        segit = StaticSegmentedIterable(self.controller, self.listing)
+        segit.response = Stub()
+        self.assertEquals(''.join(segit.app_iter_range(2, 4)), '23')
+
+    def test_app_iter_range(self):
+        for start, stop, expected in ((None, None, '122333444455555'),
+                                      (3, None, '333444455555'),
+                                      (5, None, '3444455555'),
+                                      (None, 6, '122333'),
+                                      (3, 7, '3334'),
+                                      (5, 7, '34'),
+                                      (14, None, '5'),
+                                      (15, None, ''),
+                                      (20, 25, '')):
+            segit = StaticSegmentedIterable(self.controller, self.listing)
+            segit.response = Stub()
+            self.assertEquals(''.join(segit.app_iter_range(start, stop)),
+                              expected)
+            self.assertFalse(segit.prefetched)
+
+    def test_app_iter_range_seeks_directly(self):
+        segit = StaticSegmentedIterable(self.controller, self.listing)
+        segit.response = Stub()
+        self.assertEquals(''.join(segit.app_iter_range(11, 12)), '5')
+        self.assertEquals(self.controller.GETorHEAD_base_args[4], '/a/lc/o5')
+        self.assertEquals(str(self.controller.GETorHEAD_base_args[0].range),
+                          'bytes=1-')
+
+    def test_zero_byte_segments(self):
+        listing = [self.segment('/lc/o1', 1), self.segment('/lc/o0', 0),
+                   self.segment('/lc/o2', 2)]
+        segit = StaticSegmentedIterable(self.controller, listing)
+        segit.response = Stub()
+        self.assertEquals(''.join(segit.app_iter_range(1, None)), '22')
+
+
 if __name__ == '__main__':
     setup()
     try: